@@ -0,0 +1 @@
+""" Benchmarks for todoistcli, run with python -m benchmarks.<name> """
@@ -0,0 +1,63 @@
+""" Times todo complete on a 10k task account and checks that completing takes
+under TARGET_MS on top of starting python """
+import os
+import subprocess
+import sys
+import tempfile
+import todoistcli
+from benchmarks.synthetic import fake_api
+
+SIZE = 10000
+TARGET_MS = 20
+# Runs timed, the fastest counts since starting processes is noisy
+REPEAT = 20
+
+# Command lines completed, the last word being the one completed
+WORDS = (["add", "project 1"], ["list", "label", "la"], ["done", "12"], ["move", "5", "p"])
+
+# Runs bin/todo complete in a fresh python and writes how long it took, from
+# after python started to the answer, to stderr
+CHILD = """
+import os, runpy, sys, time
+start = time.perf_counter()
+sys.argv = ["todo", "complete", *sys.argv[1:]]
+sys.stdout = open(os.devnull, "w")
+try:
+    runpy.run_path("bin/todo", run_name="__main__")
+except SystemExit:
+    pass
+sys.stderr.write(str((time.perf_counter() - start) * 1000))
+"""
+
+
+def complete_ms(words, env):
+    """ Returns the fastest time in milliseconds todo complete took for words """
+    times = []
+    for _ in range(REPEAT):
+        result = subprocess.run([sys.executable, "-c", CHILD, *words], env=env, check=True,
+                                stderr=subprocess.PIPE, universal_newlines=True)
+        times.append(float(result.stderr))
+    return min(times)
+
+
+def main():
+    """ Runs the benchmark and exits non zero if completing is too slow """
+    with tempfile.TemporaryDirectory() as home:
+        os.makedirs(os.path.join(home, ".config", "todoist"))
+        todoistcli.sync(fake_api(SIZE), os.path.join(home, ".config", "todoist", "cache"))
+        env = {**os.environ, "HOME": home, "PYTHONPATH": os.getcwd()}
+
+        slowest = 0
+        for words in WORDS:
+            ms = complete_ms(words, env)
+            slowest = max(slowest, ms)
+            print(f"{' '.join(words):<22} {ms:8.2f} ms")
+
+    if slowest > TARGET_MS:
+        print(f"completing takes {slowest:.2f} ms, more than {TARGET_MS} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+""" Measures the peak memory of exporting 10k and 100k tasks, which should stay
+about the same as the account grows, next to loading every item at once """
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import todoistcli
+import todoistcli.export
+from benchmarks.synthetic import fake_api
+
+SIZES = (10000, 100000)
+
+
+def export(cache_file):
+    """ Writes a csv export of cache_file nowhere """
+    for _ in todoistcli.export.iter_export(cache_file, "csv"):
+        pass
+
+
+def load(cache_file):
+    """ Reads every item of cache_file into memory as export did not """
+    todoistcli.read_cache(cache_file, ["resources"])
+
+
+def measure(func, cache_file):
+    """ Returns the peak bytes allocated and seconds taken by func(cache_file) """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(cache_file)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, seconds
+
+
+def main():
+    """ Prints the peak memory of exporting and loading each size """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in SIZES:
+            cache_file = os.path.join(tmpdir, f"cache{size}")
+            # Raw resources are only cached for apis that sync incrementally
+            api = fake_api(size)
+            api.sync_token = "token"
+            todoistcli.sync(api, cache_file)
+            for func in (export, load):
+                peak, seconds = measure(func, cache_file)
+                print(f"{func.__name__:<6} {size:>6} tasks {peak / 1e6:8.2f} MB peak "
+                      f"{seconds:6.2f} s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
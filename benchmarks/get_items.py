@@ -0,0 +1,32 @@
+""" Times get_items from 1k to 100k items and checks that it scales linearly """
+import sys
+import timeit
+import todoistcli
+from benchmarks.synthetic import fake_api
+
+SIZES = (1000, 10000, 100000)
+
+# Largest allowed growth in per item cost between the smallest and largest size
+MAX_GROWTH = 3
+
+
+def main():
+    """ Runs the benchmark and exits non zero if scaling is not linear """
+    per_item = []
+    for size in SIZES:
+        api = fake_api(size)
+        seconds = min(timeit.repeat(lambda: todoistcli.get_items(api), number=1, repeat=3))
+        per_item.append(seconds / size)
+        print(f"get_items {size:>7} items: {seconds * 1000:9.2f} ms "
+              f"({seconds / size * 1e6:.2f} us/item)")
+
+    growth = per_item[-1] / per_item[0]
+    print(f"per item growth {SIZES[0]} -> {SIZES[-1]}: {growth:.2f}x")
+    if growth > MAX_GROWTH:
+        print("get_items does not scale linearly")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
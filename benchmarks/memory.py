@@ -0,0 +1,51 @@
+""" Measures the memory the items of 100k tasks take as a task store and as
+the nested dicts get_items returned before """
+import gc
+import sys
+import tracemalloc
+import todoistcli
+from benchmarks.synthetic import fake_api
+
+SIZE = 100000
+
+
+def dict_items(api):
+    """ Returns the items of api as nested dicts, as get_items did before the
+    task store """
+    items = {}
+    for item in api.state['items']:
+        if item['is_deleted'] or item['in_history'] or item['is_archived']:
+            continue
+        items.setdefault(item['project_id'], {})[item['id']] = {
+            "content": item['content'], "labels": item['labels']}
+    index = 1
+    for proj_items in items.values():
+        for item in proj_items.values():
+            item["index"] = index
+            index += 1
+    return items
+
+
+def measure(func, api):
+    """ Returns the bytes allocated and still held by func(api) """
+    gc.collect()
+    tracemalloc.start()
+    result = func(api)
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return held
+
+
+def main():
+    """ Prints the memory per 100k tasks of both shapes """
+    api = fake_api(SIZE)
+    before = measure(dict_items, api)
+    after = measure(todoistcli.get_items, api)
+    print(f"dicts {before / 1e6:8.2f} MB per {SIZE} tasks")
+    print(f"store {after / 1e6:8.2f} MB per {SIZE} tasks ({after / before:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
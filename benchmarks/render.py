@@ -0,0 +1,55 @@
+""" Times rendering list rows with 500 labels and 50k items, comparing a scan
+of every label per row against the label id to name map """
+import sys
+import timeit
+import todoistcli
+from benchmarks.synthetic import fake_api
+
+ITEMS = 50000
+LABELS = 500
+
+
+def scan_labels(data):
+    """ Renders every row by testing every label against the row's labels """
+    rows = []
+    for proj_id, items in data['items'].items():
+        for item in items.values():
+            i_labels = ' '.join(['@' + key for key, value in data['labels'].items()
+                                 if value in item['labels']])
+            rows.append(f"[{item['index']}] {data['projects'][proj_id]['name']} - "
+                        f"{item['content']} {i_labels}")
+    return rows
+
+
+def label_map(data):
+    """ Renders every row with format_item """
+    label_names = data['lookups']['label_names']
+    return [todoistcli.format_item(item, data['projects'][proj_id]['name'], label_names)
+            for proj_id, items in data['items'].items() for item in items.values()]
+
+
+def best(func):
+    """ Returns the best of three runs of func in milliseconds """
+    return min(timeit.repeat(func, number=1, repeat=3)) * 1000
+
+
+def main():
+    """ Runs the benchmark and exits non zero if the label map is not at least
+    five times faster than scanning every label """
+    snap = todoistcli.Snapshot(fake_api(ITEMS, labels=LABELS, label_density=5))
+    data = snap.data
+
+    scan = best(lambda: scan_labels(data))
+    mapped = best(lambda: label_map(data))
+    listing = best(lambda: list(todoistcli.iter_items_all(snap)))
+    by_label = best(lambda: list(todoistcli.iter_items_label(snap, "label 250")))
+
+    print(f"scan {LABELS} labels per row, {ITEMS} items: {scan:8.2f} ms")
+    print(f"label id to name map:                {mapped:8.2f} ms")
+    print(f"list:                                {listing:8.2f} ms")
+    print(f"list label label 250:                {by_label:8.2f} ms")
+    return 0 if mapped * 5 < scan else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
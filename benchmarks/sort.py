@@ -0,0 +1,48 @@
+""" Compares sorting 100k list rows with natural_sort on formatted lines
+against sorting records on precomputed keys """
+import sys
+import timeit
+import todoistcli
+from benchmarks.synthetic import fake_api
+
+ROWS = 100000
+
+
+def formatted_lines(data):
+    """ Returns every item formatted the way list_items_all prints it """
+    return [f"[{item['index']}] {data['projects'][proj_id]['name']} - {item['content']}"
+            for proj_id, items in data['items'].items() for item in items.values()]
+
+
+def records(data, sort):
+    """ Returns every item as a record keyed on sort """
+    return [(todoistcli.item_key(data, sort, proj_id, item), proj_id, item)
+            for proj_id, items in data['items'].items() for item in items.values()]
+
+
+def best(func):
+    """ Returns the best of three runs of func in milliseconds """
+    return min(timeit.repeat(func, number=1, repeat=3)) * 1000
+
+
+def main():
+    """ Runs the benchmark and exits non zero if records sort slower than lines """
+    data = todoistcli.build_state(fake_api(ROWS))
+    lines = formatted_lines(data)
+    by_index = records(data, "index")
+    by_project = records(data, "project")
+
+    natural = best(lambda: sorted(lines, key=todoistcli.natural_sort))
+    index = best(lambda: todoistcli.sort_records(by_index))
+    project = best(lambda: todoistcli.sort_records(by_project))
+    limited = best(lambda: todoistcli.sort_records(by_index, 20))
+
+    print(f"natural_sort on {len(lines)} formatted lines: {natural:8.2f} ms")
+    print(f"records on index:                 {index:8.2f} ms")
+    print(f"records on project rank, index:   {project:8.2f} ms")
+    print(f"first 20 records on index:        {limited:8.2f} ms")
+    return 0 if max(index, project) < natural else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
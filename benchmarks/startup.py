@@ -0,0 +1,89 @@
+""" Measures import time of every todo action with python -X importtime and
+checks that offline actions stay within a budget and never import the sdk """
+import os
+import subprocess
+import sys
+import tempfile
+import todoistcli
+from benchmarks.synthetic import fake_api
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TODO = os.path.join(ROOT, "bin", "todo")
+
+# Actions answered from the cache without touching the network
+OFFLINE = (
+    [],
+    ["help"],
+    ["cache", "projects"],
+    ["list"],
+    ["list", "project", "project 1"],
+    ["list", "label", "label 1"],
+    ["projects"],
+    ["labels"],
+    ["search", "item"],
+    ["query", "item", "or", "@label"],
+    ["export"]
+)
+
+# Actions that connect, they fail without an api key but have imported the sdk
+NETWORK = (
+    ["sync"],
+    ["add", "project 1", "task"],
+    ["done", "1"],
+    ["move", "1", "project 2"],
+    ["archive", "project 1"],
+    ["delete", "label", "label 1"],
+    ["batch"]
+)
+
+# Milliseconds of imports, beyond a bare interpreter, offline actions may spend
+BUDGET = float(os.environ.get("TODOIST_STARTUP_BUDGET", 25))
+
+# Modules offline actions must never import
+FORBIDDEN = ("todoist", "requests")
+
+
+def import_times(args, env):
+    """ Returns {module: cumulative microseconds} for the top level imports of
+    running python with args """
+    result = subprocess.run([sys.executable, "-X", "importtime"] + args, env=env,
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True, check=False)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not name.startswith("  "):
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    """ Runs the benchmark and exits non zero if an offline action is over budget """
+    home = tempfile.mkdtemp()
+    os.makedirs(os.path.join(home, ".config", "todoist"))
+    todoistcli.sync(fake_api(1000), os.path.join(home, ".config", "todoist", "cache"))
+
+    env = dict(os.environ, HOME=home, PYTHONPATH=ROOT, TODOIST_CACHE_MAX_AGE="3600")
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    baseline = import_times(["-c", "pass"], env)
+
+    failed = False
+    for args in OFFLINE + NETWORK:
+        # Run twice so the second run uses compiled bytecode
+        import_times([TODO] + args, env)
+        times = import_times([TODO] + args, env)
+        extra = sum(us for name, us in times.items() if name not in baseline) / 1000
+        loaded = [name for name in times if name.split(".")[0] in FORBIDDEN]
+        status = ""
+        if args in OFFLINE and (extra > BUDGET or loaded):
+            status = " over budget" if extra > BUDGET else f" imported {', '.join(loaded)}"
+            failed = True
+        print(f"todo {' '.join(args):<28} {extra:7.2f} ms imports{status}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+""" Times every state, list and lookup path on a synthetic account and compares
+the results with a stored baseline.
+
+    python -m benchmarks.suite                      compare with the baseline
+    python -m benchmarks.suite --save               store the results as the baseline
+    python -m benchmarks.suite --history FILE       also append the results to FILE
+    python -m benchmarks.suite --items 100000 --projects 200 --labels 50 --density 3
+
+A case fails when it is more than --threshold times its baseline and at least
+MIN_SLOWDOWN_MS slower, so tiny cases do not fail on timer noise. Baselines
+only hold for the machine they were saved on, save one on the machine that
+runs the comparison. """
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+import todoistcli
+import todoistcli.query
+from benchmarks.synthetic import fake_api
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# Ignore slowdowns smaller than this however large the ratio
+MIN_SLOWDOWN_MS = 2
+
+
+def cases(api, cache_file):
+    """ Returns each case's name and function for api, whose state is also
+    saved in cache_file """
+    data = todoistcli.build_state(api)
+    middle = len(data['lookups']['index']) // 2
+    content = todoistcli.get_item(data, middle)[2]['content']
+    project = data['projects'][next(iter(data['projects']))]['name']
+    label = next(iter(data['labels']))
+    save_file = cache_file + ".save"
+
+    def offline():
+        return todoistcli.Snapshot(None, cache_file)
+
+    return {
+        "get_projects": lambda: todoistcli.get_projects(api),
+        "get_labels": lambda: todoistcli.get_labels(api),
+        "get_items": lambda: todoistcli.get_items(api),
+        "build_lookups": lambda: todoistcli.build_lookups(
+            data['projects'], data['items'], data['labels']),
+        "sync": lambda: todoistcli.sync(api, save_file),
+        "save_state": lambda: todoistcli.save_state(
+            data['projects'], data['items'], data['labels'], save_file,
+            lookups=data['lookups']),
+        "load_state": lambda: todoistcli.load_state(cache_file),
+        # Offline cases go through a Snapshot, as bin/todo runs them
+        "list_projects": lambda: todoistcli.list_projects(offline()),
+        "list_labels": lambda: todoistcli.list_labels(offline()),
+        "list_items_all": lambda: todoistcli.list_items_all(offline()),
+        "list_items_all_limit": lambda: todoistcli.list_items_all(offline(), limit=20),
+        "list_items_all_project": lambda: todoistcli.list_items_all(offline(), sort="project"),
+        "list_items_project": lambda: todoistcli.list_items_project(offline(), project),
+        "list_items_label": lambda: todoistcli.list_items_label(offline(), label),
+        "search": lambda: todoistcli.query.search(offline(), "item", limit=20),
+        "done_lookup": lambda: todoistcli.select_items(offline(), f"{middle}-{middle + 9}"),
+        "move_lookup": lambda: (todoistcli.select_items(offline(), content),
+                                todoistcli.get_proj_id(offline(), project)),
+    }
+
+
+def run(params, repeat):
+    """ Returns the best time in milliseconds of each case """
+    api = fake_api(params["items"], params["projects"], params["labels"], params["density"])
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache_file = os.path.join(temp_dir, "cache")
+        todoistcli.sync(api, cache_file)
+        for name, func in cases(api, cache_file).items():
+            seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+            results[name] = round(seconds * 1000, 3)
+            print(f"{name:<24} {results[name]:10.2f} ms", flush=True)
+    return results
+
+
+def regressions(results, baseline, threshold):
+    """ Returns a message for each case slower than its baseline allows """
+    failed = []
+    for name, ms in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if ms > base * threshold and ms - base > MIN_SLOWDOWN_MS:
+            failed.append(f"{name}: {ms:.2f} ms against {base:.2f} ms "
+                          f"({ms / base:.2f}x, allowed {threshold:.2f}x)")
+    return failed
+
+
+def commit():
+    """ Returns the current git commit, or None outside a checkout """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    """ Runs the suite and exits non zero on regressions """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=20000)
+    parser.add_argument("--projects", type=int, default=50)
+    parser.add_argument("--labels", type=int, default=20)
+    parser.add_argument("--density", type=int, default=2,
+                        help="most labels on one item")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=1.5)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--history", help="append the results to this json lines file")
+    args = parser.parse_args(argv)
+
+    params = {"items": args.items, "projects": args.projects, "labels": args.labels,
+              "density": args.density}
+    results = run(params, args.repeat)
+    record = {"commit": commit(), "python": platform.python_version(), "params": params,
+              "results": results}
+
+    if args.history:
+        with open(args.history, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            f.write(json.dumps(record, indent=2) + "\n")
+        print(f"saved baseline to {args.baseline}")
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"no baseline in {args.baseline}, run with --save to store one")
+        return 0
+    if baseline["params"] != params:
+        print(f"baseline in {args.baseline} was saved for {baseline['params']}, not compared")
+        return 0
+
+    failed = regressions(results, baseline["results"], args.threshold)
+    print(f"compared with {baseline.get('commit')}: "
+          f"{len(failed)} of {len(results)} cases regressed")
+    for message in failed:
+        print(f"  {message}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
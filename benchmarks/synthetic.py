@@ -0,0 +1,32 @@
+""" Synthetic todoist states shaped like the mock api in tests/test_todo.py """
+import random
+
+
+class FakeAPI:
+    """ Mock api holding a generated state """
+    def __init__(self, state):
+        self.state = state
+
+
+def fake_api(items, projects=50, labels=20, label_density=2, seed=0):
+    """ Returns a FakeAPI with the given number of items, projects and labels.
+    label_density is the most labels any one item has. """
+    rand = random.Random(seed)
+    state = {
+        "projects": [{"id": i, "name": f"project {i}", "is_archived": 0, "is_deleted": 0}
+                     for i in range(1, projects + 1)],
+        "labels": [{"id": i, "name": f"label {i}", "is_deleted": 0}
+                   for i in range(1, labels + 1)],
+        "items": []
+    }
+    for i in range(1, items + 1):
+        state["items"].append({
+            "id": i,
+            "project_id": rand.randint(1, projects),
+            "content": f"item {i}",
+            "is_archived": int(rand.random() < 0.05),
+            "in_history": int(rand.random() < 0.05),
+            "is_deleted": 0,
+            "labels": rand.sample(range(1, labels + 1), rand.randint(0, label_density))
+        })
+    return FakeAPI(state)
@@ -0,0 +1,14 @@
+# bash completion for todo, source this file from ~/.bashrc
+#
+# Completions come from todo complete, which only reads the small index
+# written next to the cache, so tab never waits on todoist.
+
+_todo() {
+    local IFS=$'\n' value
+    COMPREPLY=()
+    for value in $(todo complete "${COMP_WORDS[@]:1:COMP_CWORD}" 2>/dev/null | cut -f1); do
+        COMPREPLY+=("$(printf '%q' "$value")")
+    done
+}
+
+complete -F _todo todo
@@ -1,4 +1,4 @@
 from setuptools import setup, find_packages
 
-setup(name="todoistcli", packages=find_packages(),
+setup(name="todoistcli", packages=find_packages(exclude=["benchmarks"]),
       scripts=['bin/todo'])
@@ -0,0 +1,192 @@
+""" Fixtures shared by the tests """
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+import pytest
+
+
+class FakeTodoist(http.server.ThreadingHTTPServer):
+    """ A local stand in for the todoist sync api. accounts maps api tokens to
+    their projects, items and labels, requests records each sync's form data
+    and most_active is the most syncs that were answered at the same time.
+    pending holds the objects changed by change for the next sync of their
+    account. failures holds the errors fail queued for the next requests and
+    headers is sent with every reply. Commands are run once per uuid, like
+    todoist, so resending them is safe. """
+    daemon_threads = True
+
+    def __init__(self, delay=0):
+        super().__init__(("127.0.0.1", 0), FakeTodoistHandler)
+        self.delay = delay
+        self.accounts = {}
+        self.pending = {}
+        self.failures = []
+        self.headers = {}
+        self.applied = {}
+        self.temp_ids = {}
+        self.requests = []
+        self.active = 0
+        self.most_active = 0
+        self.lock = threading.Lock()
+
+    def add_account(self, token, label, projects):
+        """ Adds an account with one item labelled label in each of projects """
+        state = {"projects": [], "items": [],
+                 "labels": [{"id": 1, "name": label, "is_deleted": 0}]}
+        for proj_id, project in enumerate(projects, 1):
+            state["projects"].append({"id": proj_id, "name": project, "is_archived": 0,
+                                      "is_deleted": 0})
+            state["items"].append({"id": proj_id, "project_id": proj_id,
+                                   "content": f"{label} item {proj_id}", "is_archived": 0,
+                                   "in_history": 0, "is_deleted": 0, "labels": [1]})
+        self.accounts[token] = state
+
+    def change(self, token, resource, obj_id, **fields):
+        """ Changes fields of an object as another client would, adding the
+        object if there is none with obj_id """
+        objs = {obj["id"]: obj for obj in self.accounts[token][resource]}
+        if obj_id not in objs:
+            objs[obj_id] = {"id": obj_id, "is_deleted": 0, "is_archived": 0}
+            if resource == "items":
+                objs[obj_id].update(in_history=0, labels=[])
+            self.accounts[token][resource].append(objs[obj_id])
+        objs[obj_id].update(fields)
+        self.pending.setdefault(token, {}).setdefault(resource, []).append(objs[obj_id])
+
+    def fail(self, status, times=1, retry_after=None, applied=False, headers=None):
+        """ Answers the next times requests with status, asking clients to
+        wait retry_after seconds. With applied their commands still run, as
+        when a reply is lost on its way back. """
+        body = {"error": "Request failed", "http_code": status}
+        if retry_after is not None:
+            body["error_extra"] = {"retry_after": retry_after}
+        self.failures += [{"status": status, "body": body, "applied": applied,
+                           "headers": headers or {}}] * times
+
+    @property
+    def endpoint(self):
+        """ The api_endpoint to pass to the sdk """
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def sync(self, form):
+        """ Returns the reply to a sync request after applying its commands """
+        state = self.accounts[form["token"]]
+        full_sync = form["sync_token"] == "*"
+        pending = self.pending.pop(form["token"], {})
+        changed = {name: list(pending.get(name, [])) for name in ("projects", "items", "labels")}
+        status, mapping = {}, {}
+        for command in json.loads(form.get("commands", "[]")):
+            if command["uuid"] not in self.applied:
+                self.applied[command["uuid"]] = self.apply(state, command, changed,
+                                                           self.temp_ids)
+            status[command["uuid"]] = self.applied[command["uuid"]]
+            if command.get("temp_id") in self.temp_ids:
+                mapping[command["temp_id"]] = self.temp_ids[command["temp_id"]]
+
+        reply = {"sync_token": f"{form['token']}-{len(self.requests)}", "full_sync": full_sync,
+                 "sync_status": status, "temp_id_mapping": mapping}
+        for name in changed:
+            reply[name] = state[name] if full_sync else changed[name]
+        return reply
+
+    @staticmethod
+    def apply(state, command, changed, mapping):
+        """ Applies a command to state like todoist does, noting the objects it
+        changes, and returns its status """
+        args = command["args"]
+        kind, _, action = command["type"].partition("_")
+        name = kind + "s"
+        objs = {obj["id"]: obj for obj in state[name]}
+
+        def real(obj_id):
+            return mapping.get(obj_id, obj_id)
+
+        if action == "add":
+            obj = {"id": max(objs, default=0) + 1, "is_deleted": 0, "is_archived": 0}
+            obj.update({key: value for key, value in args.items()})
+            if name == "items":
+                obj.update(project_id=real(obj["project_id"]), in_history=0,
+                           labels=[real(label_id) for label_id in obj.get("labels", [])])
+            state[name].append(obj)
+            mapping[command["temp_id"]] = obj["id"]
+            changed[name].append(obj)
+            return "ok"
+
+        if action == "move":
+            targets = [int(i) for ids in args["project_items"].values() for i in ids]
+        elif action == "complete":
+            targets = args["ids"]
+        else:
+            targets = [args["id"]]
+        targets = [real(obj_id) for obj_id in targets]
+        if any(obj_id not in objs for obj_id in targets):
+            return {"error_code": 22, "error": "Item not found"}
+        for obj_id in targets:
+            obj = objs[obj_id]
+            if action == "move":
+                obj["project_id"] = real(args["to_project"])
+            elif action == "complete":
+                obj["in_history"] = obj["checked"] = 1
+            elif action == "archive":
+                obj["is_archived"] = 1
+            elif action == "delete":
+                obj["is_deleted"] = 1
+            changed[name].append(obj)
+        return "ok"
+
+
+class FakeTodoistHandler(http.server.BaseHTTPRequestHandler):
+    """ Answers sync requests for FakeTodoist """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ Answers a sync, slowly when the server has a delay """
+        length = int(self.headers["Content-Length"])
+        form = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        server = self.server
+        with server.lock:
+            server.requests.append(form)
+            server.active += 1
+            server.most_active = max(server.most_active, server.active)
+        try:
+            time.sleep(server.delay)
+            with server.lock:
+                failure = server.failures.pop(0) if server.failures else None
+            headers = server.headers
+            if form.get("token") not in server.accounts:
+                status, body = 403, {"error": "Invalid token"}
+            elif failure is None:
+                status, body = 200, server.sync(form)
+            else:
+                if failure["applied"]:
+                    server.sync(form)
+                status, body, headers = failure["status"], failure["body"], failure["headers"]
+        finally:
+            with server.lock:
+                server.active -= 1
+
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """ Keeps the test output quiet """
+
+
+@pytest.fixture
+def todoist_server():
+    """ Runs a FakeTodoist on a local port """
+    server = FakeTodoist()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
@@ -0,0 +1,85 @@
+""" Tests for syncing several accounts """
+import pytest
+import todoistcli
+import todoistcli.accounts
+
+
+@pytest.fixture
+def accounts(tmpdir, todoist_server):
+    """ Configures three accounts served by todoist_server """
+    accounts_dir = tmpdir.mkdir('accounts')
+    for name, projects in (("work", ["Inbox", "Ops"]), ("home", ["Inbox"]),
+                           ("team", ["Inbox", "Roadmap"])):
+        accounts_dir.join(name).write(f"{name}-token\n")
+        todoist_server.add_account(f"{name}-token", name, projects)
+    return str(accounts_dir)
+
+
+def test_load_accounts(accounts):
+    """ Validates that accounts are found by name with their cache files """
+    actual = todoistcli.accounts.load_accounts(accounts)
+
+    assert list(actual) == ["home", "team", "work"]
+    assert actual["work"] == (f"{accounts}/work", f"{accounts}/work.cache")
+
+
+def test_load_accounts_missing(tmpdir):
+    """ Validates that there are no accounts without an accounts directory """
+    assert todoistcli.accounts.load_accounts(str(tmpdir.join('missing'))) == {}
+
+
+def test_account_unknown(accounts):
+    """ Validates that unknown accounts raise AccountError """
+    with pytest.raises(todoistcli.accounts.AccountError):
+        todoistcli.accounts.account("play", accounts)
+
+
+def test_connect_all(accounts, todoist_server):
+    """ Validates that accounts sync at the same time and each is cached """
+    todoist_server.delay = 0.5
+    configured = todoistcli.accounts.load_accounts(accounts)
+
+    snaps = todoistcli.accounts.connect_all(configured, todoist_server.endpoint)
+
+    assert todoist_server.most_active == 3
+    assert sorted(form["token"] for form in todoist_server.requests) == \
+        ["home-token", "team-token", "work-token"]
+    for name, (_, cache_file) in configured.items():
+        assert todoistcli.list_items_all(None, cache_file) == \
+            todoistcli.list_items_all(snaps[name])
+    assert todoistcli.list_items_all(None, configured["home"][1]) == \
+        ["[1] Inbox - home item 1 @home"]
+
+
+def test_snapshots(accounts, todoist_server):
+    """ Validates that only expired accounts are synced, from their sync token """
+    configured = todoistcli.accounts.load_accounts(accounts)
+    todoistcli.accounts.connect_all(configured, todoist_server.endpoint)
+    del todoist_server.requests[:]
+
+    snaps = todoistcli.accounts.snapshots(configured, max_age=60,
+                                          api_endpoint=todoist_server.endpoint)
+
+    assert todoist_server.requests == []
+    assert all(snap.api is None for snap in snaps.values())
+
+    snaps = todoistcli.accounts.snapshots(configured, refresh=True,
+                                          api_endpoint=todoist_server.endpoint)
+
+    assert len(todoist_server.requests) == 3
+    assert all(form["sync_token"] != "*" for form in todoist_server.requests)
+    assert todoistcli.list_items_all(snaps["team"]) == \
+        ["[1] Inbox - team item 1 @team", "[2] Roadmap - team item 2 @team"]
+
+
+def test_iter_merged(accounts, todoist_server):
+    """ Validates that each account's lines are listed tagged with it """
+    snaps = todoistcli.accounts.connect_all(todoistcli.accounts.load_accounts(accounts),
+                                            todoist_server.endpoint)
+
+    actual = list(todoistcli.accounts.iter_merged(snaps, todoistcli.iter_projects))
+
+    assert actual == ["home: Inbox (1)", "team: Inbox (1)", "team: Roadmap (1)",
+                      "work: Inbox (1)", "work: Ops (1)"]
+    assert list(todoistcli.accounts.iter_merged(snaps, todoistcli.iter_projects, 2)) == \
+        ["home: Inbox (1)", "team: Inbox (1)"]
@@ -0,0 +1,117 @@
+""" Tests for shell completion """
+import os
+import subprocess
+import sys
+import pytest
+import todoistcli
+import todoistcli.complete
+
+
+class api:
+    """ Mock api """
+    state = {
+        "items": [
+            {"id": 1, "project_id": 1, "content": "Fix the\tprinter", "is_archived": 0,
+             "in_history": 0, "is_deleted": 0, "labels": [1]},
+            {"id": 2, "project_id": 2, "content": "Buy paper", "is_archived": 0,
+             "in_history": 0, "is_deleted": 0, "labels": []}
+        ] + [
+            {"id": i, "project_id": 2, "content": f"item {i}", "is_archived": 0,
+             "in_history": 0, "is_deleted": 0, "labels": []} for i in range(3, 13)
+        ],
+        "labels": [
+            {"id": 1, "name": "urgent", "is_deleted": 0},
+            {"id": 2, "name": "Errands", "is_deleted": 0}
+        ],
+        "projects": [
+            {"id": 1, "name": "Work", "is_archived": 0, "is_deleted": 0},
+            {"id": 2, "name": "Home Office", "is_archived": 0, "is_deleted": 0},
+            {"id": 3, "name": "Homework", "is_archived": 0, "is_deleted": 0}
+        ]
+    }
+
+
+@pytest.fixture
+def home(tmpdir):
+    """ A home directory whose cache and completion index hold the mock api """
+    config = tmpdir.mkdir('.config').mkdir('todoist')
+    todoistcli.sync(api, str(config.join('cache')))
+    return tmpdir
+
+
+@pytest.mark.parametrize("words, expected", [
+    ([""], [[action] for action in todoistcli.complete.ACTIONS]),
+    (["d"], [["daemon"], ["delete"], ["done"]]),
+    (["q"], [["query"]]),
+    (["add", "ho"], [["Home Office"], ["Homework"]]),
+    (["list", ""], [["label"], ["project"]]),
+    (["list", "label", "e"], [["Errands"]]),
+    (["watch", "project", "W"], [["Work"]]),
+    (["delete", "l"], [["label"]]),
+    (["cache", "r"], [["requests"]]),
+    (["done", "1"], [["1", "Fix the printer"], ["10", "item 10"], ["11", "item 11"],
+                     ["12", "item 12"]]),
+    (["move", "2", "w"], [["Work"]]),
+    (["--limit", "5", "done", "2"], [["2", "Buy paper"]]),
+    (["list", "--so"], [["--sort"]]),
+    (["list", "--sort", ""], [["project"]]),
+    (["export", "--format", "c"], [["csv"]]),
+    (["export", "--label", "u"], [["urgent"]]),
+    (["export", "--project", "wo", "--fo"], [["--format"]]),
+    (["search", "fix"], []),
+])
+def test_candidates(home, monkeypatch, words, expected):
+    """ Validates completions for each part of a command line """
+    monkeypatch.setenv("HOME", str(home))
+
+    assert todoistcli.complete.candidates(words) == expected
+
+
+def test_candidates_without_index(tmpdir):
+    """ Validates that nothing is offered before the first sync """
+    assert todoistcli.complete.candidates(["done", ""], str(tmpdir.join('cache'))) == []
+
+
+def test_candidates_account(home, monkeypatch):
+    """ Validates that --account completes account names and uses its cache """
+    monkeypatch.setenv("HOME", str(home))
+    accounts = home.join('.config').join('todoist').mkdir('accounts')
+    accounts.join('work').write("token")
+    todoistcli.sync(api, str(accounts.join('work.cache')))
+
+    assert todoistcli.complete.candidates(["--account", "w"]) == [["work"]]
+    assert todoistcli.complete.candidates(["--account", "work", "add", "wo"]) == [["Work"]]
+
+
+def test_complete_skips_sdk(home):
+    """ Validates that todo complete answers without loading the sdk """
+    script = ("import runpy, sys\n"
+              "sys.argv = ['todo', 'complete', 'done', '2']\n"
+              "try:\n"
+              "    runpy.run_path('bin/todo', run_name='__main__')\n"
+              "except SystemExit:\n"
+              "    pass\n"
+              "print(sorted({'todoist', 'requests'} & set(sys.modules)))\n")
+    env = {**os.environ, "HOME": str(home), "PYTHONPATH": os.getcwd()}
+
+    result = subprocess.run([sys.executable, "-c", script], env=env, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+
+    assert result.stdout == "2\tBuy paper\n[]\n"
+
+
+def test_bash_completion(home):
+    """ Validates the bash completion script, quoting names with spaces """
+    shim = home.mkdir('bin').join('todo')
+    shim.write(f"#!/bin/sh\nexec {sys.executable} {os.path.abspath('bin/todo')} \"$@\"\n")
+    shim.chmod(0o755)
+    script = ("source completion/todo.bash\n"
+              "COMP_WORDS=(todo add Ho); COMP_CWORD=2; _todo\n"
+              "printf '%s\\n' \"${COMPREPLY[@]}\"\n")
+    env = {**os.environ, "HOME": str(home), "PYTHONPATH": os.getcwd(),
+           "PATH": f"{home.join('bin')}:{os.environ['PATH']}"}
+
+    result = subprocess.run(["bash", "-c", script], env=env, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+
+    assert result.stdout == "Home\\ Office\nHomework\n"
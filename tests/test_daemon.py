@@ -0,0 +1,68 @@
+""" Tests for the todo daemon """
+import threading
+import pytest
+import todoistcli.daemon
+
+
+@pytest.fixture
+def server(tmpdir):
+    """ Runs a daemon server that echoes argv on a socket in tmpdir """
+    socket_path = str(tmpdir.join('daemon.sock'))
+    syncs = []
+
+    def dispatch(argv):
+        print(' '.join(argv))
+        if argv[-1] == "fail":
+            exit(3)
+
+    test_server = todoistcli.daemon.make_server(dispatch, lambda: syncs.append("sync"),
+                                                threading.Lock(), socket_path,
+                                                lambda: syncs.append("refresh"))
+    thread = threading.Thread(target=test_server.serve_forever)
+    thread.start()
+    yield socket_path, syncs
+    test_server.shutdown()
+    test_server.server_close()
+    thread.join()
+
+
+def test_request(server):
+    """ Validates that the output of the command is returned """
+    socket_path, syncs = server
+
+    assert todoistcli.daemon.request(["todo", "list"], socket_path=socket_path) == \
+        ("todo list\n", 0)
+    assert syncs == []
+
+
+def test_request_exit_status(server):
+    """ Validates that the exit status of the command is returned """
+    socket_path, _ = server
+
+    assert todoistcli.daemon.request(["todo", "fail"], socket_path=socket_path) == \
+        ("todo fail\n", 3)
+
+
+def test_request_refresh(server):
+    """ Validates that refresh runs the refresh sync before the command """
+    socket_path, syncs = server
+
+    todoistcli.daemon.request(["todo", "list"], True, socket_path)
+
+    assert syncs == ["refresh"]
+
+
+def test_request_no_daemon(tmpdir):
+    """ Returns None when no daemon is listening """
+    socket_path = str(tmpdir.join('daemon.sock'))
+
+    assert todoistcli.daemon.request(["todo", "list"], socket_path=socket_path) is None
+    assert not todoistcli.daemon.listening(socket_path)
+
+
+def test_run_error():
+    """ Validates that errors are reported instead of stopping the daemon """
+    def dispatch(argv):
+        raise ValueError(argv[0])
+
+    assert todoistcli.daemon.run(dispatch, ["bad"]) == ("Error: bad\n", 1)
@@ -0,0 +1,118 @@
+""" Tests for exporting items """
+import csv
+import json
+import os
+import subprocess
+import sys
+import pytest
+import todoistcli
+import todoistcli.export
+
+
+@pytest.fixture
+def cache_file(tmpdir, todoist_server):
+    """ A cache synced from an account with a due date, labels on only one
+    item and a checked item """
+    todoist_server.add_account("token", "home", ["Inbox", "Chores"])
+    todoist_server.change("token", "labels", 2, name="Errands")
+    todoist_server.change("token", "items", 1, priority=4, labels=[1, 2],
+                          due={"date": "2026-10-20", "string": "tue"})
+    todoist_server.change("token", "items", 2, labels=[])
+    todoist_server.change("token", "items", 3, project_id=1, content="old", in_history=1)
+    config = tmpdir.mkdir('.config').mkdir('todoist')
+    config.join('api_key').write("token")
+    cache = str(config.join('cache'))
+    api = todoistcli.connect(cache, str(config.join('api_key')),
+                             api_endpoint=todoist_server.endpoint)
+    todoistcli.Snapshot(api, cache).save()
+    return cache
+
+
+def test_ndjson(cache_file):
+    """ Validates that every field todoist sent is exported with the project
+    and label names, leaving out completed items """
+    lines = list(todoistcli.export.iter_export(cache_file))
+    records = [json.loads(line) for line in lines]
+
+    assert [record['id'] for record in records] == [1, 2]
+    assert records[0]['project'] == "Inbox"
+    assert records[0]['label_names'] == ["home", "Errands"]
+    assert records[0]['priority'] == 4
+    assert records[0]['due'] == {"date": "2026-10-20", "string": "tue"}
+    assert records[1]['label_names'] == []
+
+
+def test_csv(cache_file):
+    """ Validates the csv columns, with due dates and label names flattened """
+    rows = list(csv.DictReader(todoistcli.export.iter_export(cache_file, "csv")))
+
+    assert list(rows[0]) == list(todoistcli.export.CSV_FIELDS)
+    assert [row['content'] for row in rows] == ["home item 1", "home item 2"]
+    assert rows[0]['due_date'] == "2026-10-20"
+    assert rows[0]['due_string'] == "tue"
+    assert rows[0]['label_names'] == "home,Errands"
+    assert rows[1]['due_date'] == ""
+
+
+@pytest.mark.parametrize("project, label, expected", [
+    ("Chores", None, [2]),
+    ("in", None, [1]),
+    (None, "Errands", [1]),
+    ("Chores", "Errands", []),
+])
+def test_filters(cache_file, project, label, expected):
+    """ Validates that --project and --label select the exported items """
+    lines = todoistcli.export.iter_export(cache_file, project=project, label=label)
+
+    assert [json.loads(line)['id'] for line in lines] == expected
+
+
+def test_unknown_format(cache_file):
+    """ Validates that an unknown format fails before anything is written """
+    with pytest.raises(ValueError, match="unknown format xml"):
+        todoistcli.export.iter_export(cache_file, "xml")
+
+
+def test_no_raw_items(tmpdir):
+    """ Validates that caches saved without a sync token, and so without raw
+    items, fail rather than export nothing """
+    cache = str(tmpdir.join('cache'))
+    data = todoistcli.load_state('tests/test_state.json')
+    todoistcli.save_state(data['projects'], data['items'], data['labels'], cache)
+
+    with pytest.raises(ValueError, match="run todo sync first"):
+        todoistcli.export.iter_export(cache)
+    with pytest.raises(ValueError, match="run todo sync first"):
+        todoistcli.export.iter_export('tests/test_state.json')
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 16])
+def test_iter_array(cache_file, chunk_size):
+    """ Validates that items decode the same whatever the size of each read """
+    items = todoistcli.read_cache(cache_file, ["resources"])['resources']['items']
+
+    assert list(todoistcli.iter_array(cache_file, "resources.items", chunk_size)) == items
+
+
+def test_iter_array_unsplit(tmpdir):
+    """ Validates that caches written before resources was split still export """
+    resources = {"items": [{"id": 1, "content": "a"}], "projects": []}
+    cache = str(tmpdir.join('cache'))
+    with open(cache, "w") as cache_fh:
+        json.dump({"resources": resources}, cache_fh)
+
+    assert list(todoistcli.iter_array(cache, "resources.items")) == resources['items']
+    assert list(todoistcli.iter_array(cache, "resources.notes")) == []
+
+
+def test_export_command(cache_file, tmpdir):
+    """ Validates todo export from the cache, without reaching todoist """
+    env = {**os.environ, "HOME": str(tmpdir), "PYTHONPATH": os.getcwd()}
+
+    result = subprocess.run([sys.executable, "bin/todo", "export", "--format", "csv",
+                             "--project", "Chores"], env=env, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+
+    lines = result.stdout.splitlines()
+    assert len(lines) == 2
+    assert lines[1].startswith("2,2,Chores,")
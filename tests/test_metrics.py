@@ -0,0 +1,108 @@
+""" Tests for timing todo commands """
+import json
+import os
+import pstats
+import subprocess
+import sys
+import pytest
+import todoistcli
+import todoistcli.metrics
+
+
+@pytest.fixture
+def sink(tmpdir, monkeypatch):
+    """ Profiles to a file in tmpdir and returns a function reading its lines """
+    monkeypatch.setattr(todoistcli.metrics, "SINK", None)
+    output = tmpdir.join('metrics.jsonl')
+    todoistcli.metrics.enable(str(output))
+    yield lambda: [json.loads(line) for line in output.readlines()]
+    todoistcli.metrics.SINK.close()
+
+
+@pytest.fixture
+def home(tmpdir, todoist_server):
+    """ A home directory with a fresh cache of an account on todoist_server """
+    config = tmpdir.mkdir('.config').mkdir('todoist')
+    todoist_server.add_account("token", "home", ["Inbox", "Chores"])
+    config.join('api_key').write("token")
+    todoistcli.sync(todoistcli.connect(str(config.join('cache')), str(config.join('api_key')),
+                                       api_endpoint=todoist_server.endpoint),
+                    str(config.join('cache')))
+    return tmpdir
+
+
+def todo(home, *args, **env):
+    """ Runs bin/todo with home as HOME """
+    env = {**os.environ, "HOME": str(home), "PYTHONPATH": os.getcwd(), **env}
+    return subprocess.run([sys.executable, "bin/todo", *args], env=env, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+
+def test_phase_disabled(monkeypatch):
+    """ Validates that nothing is measured while profiling is off """
+    monkeypatch.setattr(todoistcli.metrics, "SINK", None)
+
+    with todoistcli.metrics.phase("test", size=1) as fields:
+        fields["rows"] = 2
+
+    assert fields == {"size": 1, "rows": 2}
+    assert not todoistcli.metrics.enabled()
+
+
+def test_phase(sink):
+    """ Validates that phases are written once they end with their fields """
+    with todoistcli.metrics.phase("outer", size=1) as fields:
+        with todoistcli.metrics.phase("inner"):
+            pass
+        fields["rows"] = 2
+    todoistcli.metrics.emit("event", hit=True)
+
+    actual = sink()
+
+    assert [line["phase"] for line in actual] == ["inner", "outer", "event"]
+    assert actual[1]["size"] == 1 and actual[1]["rows"] == 2
+    assert actual[1]["ms"] >= actual[0]["ms"] >= 0
+    assert actual[2] == {"phase": "event", "hit": True}
+
+
+def test_sync_metrics(sink, home, todoist_server):
+    """ Validates that syncs report their requests and payload sizes """
+    config = home.join('.config').join('todoist')
+
+    api = todoistcli.connect(str(config.join('cache')), str(config.join('api_key')),
+                             api_endpoint=todoist_server.endpoint)
+    todoistcli.sync(api, str(config.join('cache')))
+
+    actual = {line["phase"]: line for line in sink()}
+    assert actual["http"]["url"] == "/API/v7/sync"
+    assert actual["http"]["bytes"] > 0
+    assert actual["sync"]["incremental"] is True
+    assert actual["sync"]["items"] == 0
+    assert actual["build_state"]["items"] == 2
+    assert actual["write_cache"]["bytes"] == os.path.getsize(str(config.join('cache')))
+
+
+def test_profile(home):
+    """ Validates that --profile writes json lines to stderr and leaves stdout alone """
+    result = todo(home, "list", "--profile")
+
+    assert result.stdout == "[1] Inbox - home item 1 @home\n[2] Chores - home item 2 @home\n"
+    actual = [json.loads(line) for line in result.stderr.splitlines()]
+    phases = [line["phase"] for line in actual]
+    assert phases[0] == "startup" and phases[-1] == "total"
+    assert {"phase": "cache", "hit": True, "refresh": False} in actual
+    assert {"read_cache", "sort", "print", "action"} <= set(phases)
+
+
+def test_profile_env(home):
+    """ Validates that TODOIST_PROFILE and --cprofile write to files """
+    metrics = home.join('metrics.jsonl')
+
+    result = todo(home, "projects", "--cprofile", str(home.join('todo.prof')),
+                  TODOIST_PROFILE=str(metrics))
+
+    assert result.stdout == "Chores (1)\nInbox (1)\n"
+    assert result.stderr == ""
+    assert json.loads(metrics.readlines()[-1])["action"] == "projects"
+    assert pstats.Stats(str(home.join('todo.prof'))).total_calls > 0
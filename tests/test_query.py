@@ -0,0 +1,215 @@
+""" Tests for searching cached items """
+import pytest
+import todoistcli
+import todoistcli.query
+
+
+class api:
+    """ Mock api """
+    state = {
+        "items": [
+            {"id": 1, "project_id": 1, "content": "Fix the printer", "is_archived": 0,
+             "in_history": 0, "is_deleted": 0, "labels": [1]},
+            {"id": 2, "project_id": 1, "content": "Buy printer paper", "is_archived": 0,
+             "in_history": 0, "is_deleted": 0, "labels": [2]},
+            {"id": 3, "project_id": 2, "content": "Fix the bike", "is_archived": 0,
+             "in_history": 0, "is_deleted": 0, "labels": [1, 2]},
+            {"id": 4, "project_id": 3, "content": "Read a book", "is_archived": 0,
+             "in_history": 0, "is_deleted": 0, "labels": []}
+        ],
+        "labels": [
+            {"id": 1, "name": "urgent", "is_deleted": 0},
+            {"id": 2, "name": "errands", "is_deleted": 0}
+        ],
+        "projects": [
+            {"id": 1, "name": "Work", "is_archived": 0, "is_deleted": 0},
+            {"id": 2, "name": "Home", "is_archived": 0, "is_deleted": 0},
+            {"id": 3, "name": "Homework", "is_archived": 0, "is_deleted": 0}
+        ]
+    }
+
+
+@pytest.fixture
+def cache(tmpdir):
+    """ A cache file holding the mock api's state """
+    output = tmpdir.join('test_cache')
+    todoistcli.sync(api, output)
+    return output
+
+
+def test_parse():
+    """ Validates that queries parse into a tree """
+    actual = todoistcli.query.parse('fix (project:"my work" or @urgent) -label:x pri*')
+
+    assert actual == ("and", ("and", ("and", ("word", "fix"),
+                                      ("or", ("project", "my work"), ("label", "urgent"))),
+                              ("not", ("label", "x"))),
+                      ("prefix", "pri"))
+
+
+@pytest.mark.parametrize("query", ["", "(fix", "fix or", "and fix", "fix )", "!!!"])
+def test_parse_error(query):
+    """ Validates that bad queries raise QueryError """
+    with pytest.raises(todoistcli.query.QueryError):
+        todoistcli.query.parse(query)
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("fix", ["[1] Work - Fix the printer @urgent", "[3] Home - Fix the bike @urgent @errands"]),
+    ("fix project:work", ["[1] Work - Fix the printer @urgent"]),
+    ("printer and not @urgent", ["[2] Work - Buy printer paper @errands"]),
+    ("#home", ["[3] Home - Fix the bike @urgent @errands"]),
+    ("project:hom", ["[3] Home - Fix the bike @urgent @errands",
+                     "[4] Homework - Read a book "]),
+    ("book* or (bike and @errands)", ["[3] Home - Fix the bike @urgent @errands",
+                                      "[4] Homework - Read a book "]),
+    ("-fix -printer", ["[4] Homework - Read a book "]),
+    ("missing", []),
+])
+def test_search(cache, query, expected):
+    """ Validates search results from the cache and from an api """
+    assert todoistcli.query.search(None, query, cache) == expected
+    assert todoistcli.query.search(todoistcli.Snapshot(api, cache), query) == expected
+
+
+def test_search_snapshot(cache, monkeypatch):
+    """ Validates that a snapshot read from the cache searches the cache's
+    search index without reading the whole state """
+    monkeypatch.setattr(todoistcli, "load_state", None)
+    snap = todoistcli.Snapshot(None, cache)
+
+    assert todoistcli.query.search(snap, "bike or book") == \
+        ["[3] Home - Fix the bike @urgent @errands", "[4] Homework - Read a book "]
+    assert not snap.loaded
+
+
+def test_search_limit(cache):
+    """ Validates that only the first limit matches are listed """
+    assert todoistcli.query.search(None, "fix or book", cache, limit=1) == \
+        ["[1] Work - Fix the printer @urgent"]
+
+
+def test_search_old_cache(tmpdir):
+    """ Validates that caches without a search index are still searched """
+    assert todoistcli.query.search(None, "item 2", 'tests/test_state.json') == \
+        ["[2] project 1 - item 2 @label 2"]
+
+
+def test_update_search():
+    """ Validates that only the sections with postings of changed items are
+    decoded and rebuilt """
+    def task(content, index, labels=()):
+        return todoistcli.store.Task(content, labels, index)
+
+    previous = {1: {1: task("old words", 1, [5]), 2: task("same words", 2)}}
+    search = todoistcli.update_search(None, previous)
+
+    assert search == {"w:ol": {"old": [[1, "1", "1"]]},
+                      "w:wo": {"words": [[1, "1", "1"], [2, "1", "2"]]},
+                      "w:sa": {"same": [[2, "1", "2"]]},
+                      "p:1": [[1, "1", "1"], [2, "1", "2"]],
+                      "l:5": [[1, "1", "1"]]}
+
+    raw = {name: todoistcli.encode_section(value) for name, value in search.items()}
+    actual = todoistcli.update_search(raw, {1: {1: task("new words", 1),
+                                                2: task("same words", 2)}}, previous)
+
+    assert actual["w:sa"] is raw["w:sa"]
+    assert "w:ol" not in actual and "l:5" not in actual
+    assert actual["w:ne"] == {"new": [[1, "1", "1"]]}
+    assert actual["w:wo"] == {"words": [[2, "1", "2"], [1, "1", "1"]]}
+    assert actual["p:1"] == [[2, "1", "2"], [1, "1", "1"]]
+    assert todoistcli.update_search(raw, previous, previous) == raw
+
+
+def test_search_after_save(cache):
+    """ Validates that saving only updates the postings of changed items """
+    data = todoistcli.load_state(cache)
+    data['items']['1']['2']['content'] = "Buy bike lights"
+    del data['items']['3']
+    todoistcli.save_state(data['projects'], data['items'], data['labels'], cache)
+
+    assert todoistcli.query.search(None, "bike or book or paper", cache) == \
+        ["[2] Work - Buy bike lights @errands", "[3] Home - Fix the bike @urgent @errands"]
+    assert todoistcli.query.search(None, "not fix", cache) == \
+        ["[2] Work - Buy bike lights @errands"]
+
+
+@pytest.mark.parametrize("selection, expected", [
+    ("3", ({3}, [])),
+    ("3-40,52", ({52}, [(3, 40)])),
+    (" 1 2,5-6 ", ({1, 2}, [(5, 6)])),
+    ("@urgent", None),
+    ("3-", None),
+])
+def test_parse_indexes(selection, expected):
+    """ Validates that index selections parse and queries do not """
+    assert todoistcli.query.parse_indexes(selection) == expected
+
+
+@pytest.mark.parametrize("selection, expected", [
+    ("1,3-10", [1, 3, 4]),
+    ("2-100", [2, 3, 4]),
+    ("2 1", [1, 2]),
+    ("@errands", [2, 3]),
+    ("project:hom and not @urgent", [4]),
+    ("missing", []),
+])
+def test_select(cache, selection, expected):
+    """ Validates that selections resolve to items in index order """
+    actual = todoistcli.query.select(selection, todoistcli.load_state(cache), confirmed=True)
+
+    assert [index for index, _, _, _ in actual] == expected
+    assert all(item['index'] == index for index, _, _, item in actual)
+
+
+def test_select_cached_search(cache):
+    """ Validates that a snapshot read from the cache selects with the cache's
+    search index until its state changes """
+    snap = todoistcli.Snapshot(None, cache)
+
+    with snap.search() as search:
+        assert isinstance(search, todoistcli.query.CachedSearch)
+        actual = todoistcli.query.select("@errands", snap.data, True, search)
+    assert [index for index, _, _, _ in actual] == [2, 3]
+
+    _, proj_id, item_id, _ = actual[0]
+    snap.remove_item(proj_id, item_id)
+    with snap.search() as search:
+        assert isinstance(search, dict)
+        actual = todoistcli.query.select("@errands", snap.data, True, search)
+    assert [index for index, _, _, _ in actual] == [3]
+
+
+def test_select_missing(cache):
+    """ Validates that an index listed alone must exist """
+    with pytest.raises(todoistcli.query.QueryError, match=r"\[7\] does not exist"):
+        todoistcli.query.select("1,7,8-9", todoistcli.load_state(cache))
+
+
+@pytest.mark.parametrize("selection", ["-3", "3,", "3-", "1-2-3", " - "])
+def test_select_malformed(cache, selection):
+    """ Validates that selections made like indexes must parse as indexes
+    rather than be searched for """
+    with pytest.raises(todoistcli.query.QueryError, match="is not a list of indexes"):
+        todoistcli.query.select(selection, todoistcli.load_state(cache))
+
+
+@pytest.mark.parametrize("selection, expected", [
+    ("book", [4]),
+    ("fix", None),
+    ("not fix", None),
+    ("-fix -printer", None),
+    ("book or not fix", None),
+    ("book -fix", [4]),
+])
+def test_select_unconfirmed(cache, selection, expected):
+    """ Validates that queries matching several items or rooted in not need
+    confirming """
+    data = todoistcli.load_state(cache)
+    if expected is None:
+        with pytest.raises(todoistcli.query.QueryError, match="add --yes"):
+            todoistcli.query.select(selection, data)
+    else:
+        assert [index for index, _, _, _ in todoistcli.query.select(selection, data)] == \
+            expected
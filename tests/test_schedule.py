@@ -0,0 +1,180 @@
+""" Tests for pacing, coalescing and retrying requests to todoist """
+import json
+import pytest
+import todoistcli
+import todoistcli.schedule
+
+
+class Clock:
+    """ A clock that only moves when something sleeps on it """
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        """ Moves the clock on by seconds """
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def account(tmpdir, todoist_server):
+    """ An api connected to the fake server whose scheduler sleeps on a fake
+    clock, and the clock """
+    todoist_server.add_account("token", "home", ["Inbox", "Chores"])
+    tmpdir.join('api_key').write("token")
+    cache_file = str(tmpdir.join('cache'))
+    api = todoistcli.connect(cache_file, str(tmpdir.join('api_key')),
+                             api_endpoint=todoist_server.endpoint)
+    # Start from a full bucket on the fake clock
+    tmpdir.join('cache.rate').remove()
+    clock = Clock()
+    bucket = todoistcli.schedule.Bucket(cache_file + ".rate", rate=1, burst=3, clock=clock)
+    api.scheduler = todoistcli.schedule.Scheduler(api, bucket, retries=2, sleep=clock.sleep,
+                                                  clock=clock)
+    del todoist_server.requests[:]
+    return api, clock
+
+
+def commands(todoist_server):
+    """ Returns the uuids of the commands in each request the server received """
+    return [[command["uuid"] for command in json.loads(form["commands"])]
+            for form in todoist_server.requests]
+
+
+def test_bucket(tmpdir):
+    """ Validates that a burst goes straight out and later requests are paced,
+    across every bucket sharing the file """
+    clock = Clock()
+    path = str(tmpdir.join('cache.rate'))
+    first = todoistcli.schedule.Bucket(path, rate=2, burst=3, clock=clock)
+    second = todoistcli.schedule.Bucket(path, rate=2, burst=3, clock=clock)
+
+    assert [first.take(), second.take(), first.take(), second.take(), first.take()] == \
+        [0, 0, 0, 0.5, 1]
+    clock.now += 10
+    assert first.take() == 0
+    second.pause(4)
+    assert first.take() == 4
+
+
+def test_retry_throttled(account, todoist_server):
+    """ Validates that a 429 holds requests off for as long as todoist asks
+    and the commit is sent again with the same command """
+    api, clock = account
+    todoist_server.fail(429, times=2, retry_after=3)
+    api.items.add("new", 1)
+
+    todoistcli.schedule.commit(api)
+
+    sent = commands(todoist_server)
+    assert len(sent) == 3 and sent[0] == sent[1] == sent[2]
+    assert clock.slept == [3, 3]
+    assert api.queue == []
+    assert [item["content"] for item in todoist_server.accounts["token"]["items"]] == \
+        ["home item 1", "home item 2", "new"]
+    assert api.scheduler.counters == {"requests": 1, "commands": 1, "coalesced": 0,
+                                      "retries": 2, "throttled": 2, "failed": 0, "waited": 6}
+
+
+def test_retry_lost_reply(account, todoist_server):
+    """ Validates that a command todoist ran before its reply was lost runs
+    once and still gets its real id """
+    api, clock = account
+    todoist_server.fail(502, applied=True)
+    temp_id = api.items.add("new", 1)["id"]
+
+    todoistcli.schedule.commit(api)
+
+    assert clock.slept == [todoistcli.schedule.BACKOFF]
+    assert len(todoist_server.accounts["token"]["items"]) == 3
+    assert api.temp_ids[temp_id] == 3
+
+
+def test_retry_exhausted(account, todoist_server):
+    """ Validates that a commit still failing after its retries raises and
+    drops its commands so they are not sent later """
+    api, clock = account
+    todoist_server.fail(503, times=5)
+    api.items.add("new", 1)
+
+    with pytest.raises(todoistcli.schedule.RequestError, match="after 2 retries"):
+        todoistcli.schedule.commit(api)
+
+    assert len(todoist_server.requests) == 3
+    assert clock.slept == [1, 2]
+    assert api.queue == []
+    assert api.scheduler.counters["failed"] == 1
+
+
+def test_refused(account, todoist_server):
+    """ Validates that errors retrying cannot fix are raised at once """
+    api, clock = account
+    todoist_server.fail(400)
+    api.items.add("new", 1)
+
+    with pytest.raises(todoistcli.schedule.RequestError, match="refused"):
+        todoistcli.schedule.commit(api)
+
+    assert len(todoist_server.requests) == 1
+    assert clock.slept == []
+
+
+def test_rate_limit_headers(account, todoist_server):
+    """ Validates that a reply saying no requests are left pauses the next
+    until the limit resets """
+    api, clock = account
+    todoist_server.headers = {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "20"}
+
+    todoistcli.schedule.sync(api)
+    todoistcli.schedule.sync(api, window=0)
+
+    assert clock.slept == [20]
+
+
+def test_coalesce(account, todoist_server):
+    """ Validates that syncs right after a reply need no request and a sync
+    with queued commands is sent as their commit """
+    api, clock = account
+    todoistcli.schedule.sync(api)
+    todoistcli.schedule.sync(api)
+    assert len(todoist_server.requests) == 1
+
+    api.items.add("new", 1)
+    todoistcli.schedule.sync(api)
+    assert [len(uuids) for uuids in commands(todoist_server)] == [0, 1]
+    assert api.queue == []
+
+    clock.now += todoistcli.schedule.WINDOW
+    todoistcli.schedule.sync(api)
+    assert len(todoist_server.requests) == 3
+    assert api.scheduler.counters["coalesced"] == 1
+
+
+def test_mutation_throttled(account, todoist_server, tmpdir):
+    """ Validates that commands like create_project survive a 429 """
+    api, _ = account
+    todoist_server.fail(429, retry_after=1)
+    snap = todoistcli.Snapshot(api, str(tmpdir.join('cache')))
+    assert len(snap.data['projects']) == 2
+
+    proj_id = todoistcli.create_project(snap, "Errands")
+
+    assert proj_id == 3
+    assert [project["name"] for project in todoist_server.accounts["token"]["projects"]] == \
+        ["Inbox", "Chores", "Errands"]
+
+
+def test_iter_totals(account, todoist_server, tmpdir):
+    """ Validates the running totals kept next to the cache """
+    api, _ = account
+    todoist_server.fail(429, retry_after=1)
+    todoistcli.schedule.sync(api)
+    todoistcli.schedule.sync(api)
+
+    assert list(todoistcli.schedule.iter_totals(str(tmpdir.join('cache')))) == [
+        "requests: 1", "commands: 0", "coalesced: 1", "retries: 1", "throttled: 1",
+        "failed: 0", "waited: 1.0"]
@@ -0,0 +1,83 @@
+""" Tests for the compact task store """
+import json
+import pytest
+import todoistcli
+from todoistcli import store
+
+
+class api:
+    """ Mock api """
+    state = {
+        "items": [
+            {"id": 1, "project_id": 1, "content": "item 1", "is_archived": 0,
+             "in_history": 0, "is_deleted": 0, "labels": [1, 2]},
+            {"id": 2, "project_id": 2, "content": "item 2", "is_archived": 0,
+             "in_history": 0, "is_deleted": 0, "labels": [2]},
+            {"id": 3, "project_id": 1, "content": "item 3", "is_archived": 0,
+             "in_history": 0, "is_deleted": 0, "labels": [1, 2]}
+        ],
+        "labels": [
+            {"id": 1, "name": "urgent", "is_deleted": 0},
+            {"id": 2, "name": "errands", "is_deleted": 0}
+        ],
+        "projects": [
+            {"id": 1, "name": "Work", "is_archived": 0, "is_deleted": 0},
+            {"id": 2, "name": "Home", "is_archived": 0, "is_deleted": 0}
+        ]
+    }
+
+
+def test_task_reads_like_a_dict():
+    """ Validates that tasks are read and written like the dicts they replace """
+    task = store.Task("content", [1, 2], 3)
+
+    task['index'] = 4
+    task['labels'] = [2]
+
+    assert (task['content'], task['labels'], task['index']) == ("content", (2,), 4)
+    assert task.get('missing') is None
+    assert dict(task.items()) == {"content": "content", "labels": (2,), "index": 4}
+    assert task == {"content": "content", "labels": [2], "index": 4}
+    assert json.loads(json.dumps(task, default=store.as_json)) == \
+        {"content": "content", "labels": [2], "index": 4}
+
+
+def test_task_only_has_its_fields():
+    """ Validates that only the task fields can be read like dict keys """
+    task = store.Task("content", [1], 2)
+
+    for key in ("missing", "__class__", "as_dict"):
+        with pytest.raises(KeyError):
+            task[key]  # pylint: disable=pointless-statement
+
+
+def test_labels_shared():
+    """ Validates that tasks with the same labels share one tuple """
+    items = todoistcli.get_items(api)
+
+    assert items[1][1]['labels'] is items[1][3]['labels']
+
+
+def test_views():
+    """ Validates the views by project and label and the dict accessor """
+    items = todoistcli.get_items(api)
+
+    assert list(items.project(1)) == [1, 3]
+    assert items.project(3) == {}
+    assert [item_id for _, item_id, _ in items.label(1)] == [1, 3]
+    assert items.as_dicts() == {
+        1: {1: {"content": "item 1", "labels": [1, 2], "index": 1},
+            3: {"content": "item 3", "labels": [1, 2], "index": 2}},
+        2: {2: {"content": "item 2", "labels": [2], "index": 3}}}
+
+
+def test_cache_unchanged(tmpdir):
+    """ Validates that tasks are cached as the dicts they replace """
+    cache_file = str(tmpdir.join('cache'))
+    data = todoistcli.build_state(api)
+
+    todoistcli.save_state(data['projects'], data['items'], data['labels'], cache_file,
+                          lookups=data['lookups'])
+
+    assert todoistcli.read_cache(cache_file, ["items"])["items"] == \
+        json.loads(json.dumps(data['items'].as_dicts()))
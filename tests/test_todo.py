@@ -1,5 +1,10 @@
 """ Basic tests for todoistcli """
 import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import pytest
 import todoistcli
 
 
@@ -96,10 +101,9 @@ def test_save_state(tmpdir):
     expected = json.load(fh)
     fh.close()
 
-    fh = open(output)
-    actual = json.load(fh)
-    fh.close()
+    actual = todoistcli.read_cache(output)
 
+    assert output.read_binary().startswith(todoistcli.CACHE_MAGIC)
     assert actual == expected
 
 
@@ -255,3 +259,936 @@ def test_list_projects_cache():
     actual = todoistcli.list_cache_projects(test_data)
 
     assert actual == ["project 1", "project 2", "project 3"]
+
+
+def test_cache_expired_missing(tmpdir):
+    """ A missing cache file is always expired """
+    assert todoistcli.cache_expired(tmpdir.join('missing'), 60)
+
+
+def test_cache_expired(tmpdir):
+    """ Validates that the cache expires once it is older than max_age """
+    output = tmpdir.join('test_cache')
+    todoistcli.sync(api, output)
+
+    assert not todoistcli.cache_expired(output, 60)
+    assert todoistcli.cache_expired(output, -1)
+
+
+def test_cache_max_age(monkeypatch):
+    """ Validates that the max age is read from the environment """
+    monkeypatch.setenv("TODOIST_CACHE_MAX_AGE", "120")
+    assert todoistcli.cache_max_age() == 120
+    monkeypatch.setenv("TODOIST_CACHE_MAX_AGE", "invalid")
+    assert todoistcli.cache_max_age() == 60
+
+
+def test_list_items_all_offline():
+    """ Validates that items are listed from the cache when there is no api """
+    test_data = 'tests/test_state.json'
+    actual = todoistcli.list_items_all(None, test_data)
+
+    assert actual == ["[1] project 1 - item 1 @label 1",
+                      "[2] project 1 - item 2 @label 2",
+                      "[3] project 3 - item 3 "]
+
+
+def test_list_projects_offline():
+    """ Validates that projects are listed from the cache when there is no api """
+    test_data = 'tests/test_state.json'
+    actual = todoistcli.list_projects(None, test_data)
+
+    assert actual == ["project 1 (2)", "project 2 (0)", "project 3 (1)"]
+
+
+def test_list_without_lookups(tmpdir):
+    """ Validates that plain json caches written before lookups are still
+    listed """
+    output = tmpdir.join('test_cache')
+    data = json.loads(open('tests/test_state.json').read())
+    del data['lookups']
+    output.write(json.dumps(data))
+
+    assert todoistcli.list_projects(None, output) == \
+        ["project 1 (2)", "project 2 (0)", "project 3 (1)"]
+    assert todoistcli.list_labels(todoistcli.Snapshot(None, output)) == \
+        ["label 1 (1)", "label 2 (1)", "label 3 (0)"]
+
+
+class delta_api:
+    """ Mock api whose sync only returns changes made since sync_token """
+    def __init__(self, changes, full_sync=False):
+        self.sync_token = '*'
+        self.state = {"projects": [], "items": [], "labels": []}
+        self.changes = changes
+        self.full_sync = full_sync
+
+    def sync(self):
+        """ Replies with the changes and, like the sdk starting from an empty
+        state, only keeps those not deleted in the state """
+        self.state = {name: [obj for obj in self.changes.get(name, []) if not obj.get('is_deleted')]
+                      for name in ("projects", "items", "labels")}
+        self.sync_token = 'token 2'
+        return {"full_sync": self.full_sync, **self.changes}
+
+
+def test_merge_resources():
+    """ Validates that adds, updates and deletes are merged into the resources """
+    resources = {"items": [{"id": 1, "content": "item 1", "in_history": 0},
+                           {"id": 2, "content": "item 2", "in_history": 0}]}
+    changes = {"items": [{"id": 1, "in_history": 1},
+                         {"id": 2, "is_deleted": 1},
+                         {"id": 3, "content": "item 3", "in_history": 0}]}
+
+    actual = todoistcli.merge_resources(resources, changes)
+
+    assert actual["items"] == [{"id": 1, "content": "item 1", "in_history": 1},
+                               {"id": 3, "content": "item 3", "in_history": 0}]
+    assert actual["projects"] == []
+    assert actual["labels"] == []
+
+
+def test_sync_saves_sync_token(tmpdir):
+    """ Validates that sync stores the sync token and raw resources """
+    output = tmpdir.join('test_cache')
+    test_api = delta_api({"projects": api.state["projects"],
+                          "items": api.state["items"],
+                          "labels": api.state["labels"]})
+    test_api.sync()
+
+    todoistcli.sync(test_api, output)
+    actual = todoistcli.load_state(output)
+
+    assert actual["sync_token"] == 'token 2'
+    assert "resources" not in actual
+    assert todoistcli.read_cache(output, ["resources"])["resources"]["items"] == \
+        [item for item in api.state["items"] if not item["is_deleted"]]
+
+
+def test_incremental_sync(tmpdir):
+    """ Validates that only changes are pulled and merged into the cached state """
+    output = tmpdir.join('test_cache')
+    full_api = delta_api({"projects": api.state["projects"],
+                          "items": api.state["items"],
+                          "labels": api.state["labels"]})
+    full_api.sync()
+    todoistcli.sync(full_api, output)
+
+    changes = {"items": [{"id": 2, "in_history": 1},
+                         {"id": 1, "is_deleted": 1},
+                         {"id": 7, "project_id": 3, "content": "item 7", "is_archived": 0,
+                          "in_history": 0, "is_deleted": 0, "labels": [3]}]}
+    test_api = delta_api(changes)
+    todoistcli.incremental_sync(test_api, output)
+
+    assert test_api.sync_token == 'token 2'
+    assert todoistcli.get_items(test_api) == {
+        3: {3: {'content': 'item 3', 'index': 1, "labels": []},
+            7: {'content': 'item 7', 'index': 2, "labels": [3]}}}
+
+
+def test_incremental_sync_full(tmpdir):
+    """ Validates that a full sync from the server replaces the cached state """
+    output = tmpdir.join('test_cache')
+    full_api = delta_api({"items": api.state["items"]})
+    full_api.sync()
+    todoistcli.sync(full_api, output)
+
+    test_api = delta_api({"items": api.state["items"][2:3]}, full_sync=True)
+    todoistcli.incremental_sync(test_api, output)
+
+    assert todoistcli.get_items(test_api) == {
+        3: {3: {'content': 'item 3', 'index': 1, "labels": []}}}
+
+
+def test_get_items_interleaved():
+    """ Validates that items are numbered in project order when projects interleave """
+    class interleaved_api:
+        """ Mock api with items from two projects interleaved """
+        state = {"items": [
+            {"id": 1, "project_id": 1, "content": "item 1", "is_archived": 0,
+             "in_history": 0, "is_deleted": 0, "labels": []},
+            {"id": 2, "project_id": 2, "content": "item 2", "is_archived": 0,
+             "in_history": 0, "is_deleted": 0, "labels": []},
+            {"id": 3, "project_id": 1, "content": "item 3", "is_archived": 0,
+             "in_history": 0, "is_deleted": 0, "labels": []}
+        ]}
+
+    items = todoistcli.get_items(interleaved_api)
+    assert items == {1: {1: {'content': 'item 1', 'index': 1, "labels": []},
+                         3: {'content': 'item 3', 'index': 2, "labels": []}},
+                     2: {2: {'content': 'item 2', 'index': 3, "labels": []}}}
+
+
+def test_build_lookups():
+    """ Validates the lookup tables built from the todoist state """
+    projects = todoistcli.get_projects(api)
+    items = todoistcli.get_items(api)
+    labels = todoistcli.get_labels(api)
+
+    actual = todoistcli.build_lookups(projects, items, labels)
+
+    assert actual == {"index": {"1": [1, 1], "2": [1, 2], "3": [3, 3]},
+                      "label_items": {"1": [[1, 1]], "2": [[1, 2]]},
+                      "project_names": {"project 1": 1, "project 2": 2, "project 3": 3},
+                      "label_names": {"1": "label 1", "2": "label 2", "3": "label 3"},
+                      "project_rank": {"1": 0, "2": 1, "3": 2},
+                      "label_rank": {"1": 0, "2": 1, "3": 2}}
+
+
+def test_build_lookups_rank():
+    """ Validates that names are ranked in natural order """
+    projects = {1: {"name": "project 10"}, 2: {"name": "Project 9"}, 3: {"name": "a"}}
+    labels = {"label 10": 1, "label 2": 2}
+
+    actual = todoistcli.build_lookups(projects, {}, labels)
+
+    assert actual["project_rank"] == {"3": 0, "2": 1, "1": 2}
+    assert actual["label_rank"] == {"2": 0, "1": 1}
+
+
+def test_load_state_without_lookups(tmpdir):
+    """ Validates that lookups are built for caches written before they existed """
+    output = tmpdir.join('test_cache')
+    data = todoistcli.load_state('tests/test_state.json')
+    expected = data.pop("lookups")
+    output.write(json.dumps(data))
+
+    actual = todoistcli.load_state(output)
+
+    assert actual["lookups"]["index"] == {"1": ["1", "1"], "2": ["1", "2"], "3": ["3", "3"]}
+    assert actual["lookups"]["label_names"] == expected["label_names"]
+
+
+def test_get_item():
+    """ Validates that get_item returns the item with the index """
+    data = todoistcli.load_state('tests/test_state.json')
+
+    actual = todoistcli.get_item(data, 2)
+
+    assert actual == (1, 2, {"content": "item 2", "index": 2, "labels": [2]})
+    assert todoistcli.get_item(data, 10) is None
+
+
+def test_get_proj_id(tmpdir):
+    """ Validates that project names are looked up case insensitively """
+    snap = todoistcli.Snapshot(api, tmpdir.join('test_cache'))
+
+    assert todoistcli.get_proj_id(snap, "Project 3") == 3
+    assert todoistcli.get_proj_id(snap, "invalid") is None
+
+
+def test_get_label_id(tmpdir):
+    """ Validates that labels are looked up by name """
+    snap = todoistcli.Snapshot(api, tmpdir.join('test_cache'))
+
+    assert todoistcli.get_label_id(snap, "label 2") == 2
+    assert todoistcli.get_label_id(snap, "invalid") is None
+
+
+def test_snapshot_builds_once(tmpdir, monkeypatch):
+    """ Validates that a snapshot builds its state once and saves it once """
+    output = tmpdir.join('test_cache')
+    calls = []
+    build_state = todoistcli.build_state
+    monkeypatch.setattr(todoistcli, "build_state",
+                        lambda test_api, *args: calls.append(test_api) or
+                        build_state(test_api, *args))
+    snap = todoistcli.Snapshot(api, output)
+
+    todoistcli.list_projects(snap)
+    todoistcli.list_labels(snap)
+    todoistcli.list_items_all(snap)
+
+    assert len(calls) == 1
+    assert not output.exists()
+    assert snap.save()
+    assert not snap.save()
+    assert todoistcli.load_state(output)["labels"] == {"label 1": 1, "label 2": 2, "label 3": 3}
+
+
+def test_snapshot_offline():
+    """ Validates that a snapshot without an api reads the cache and never saves """
+    snap = todoistcli.Snapshot(None, 'tests/test_state.json')
+
+    assert todoistcli.list_projects(snap) == ["project 1 (2)", "project 2 (0)", "project 3 (1)"]
+    assert not snap.save()
+
+
+def test_list_projects_reads_lookups(monkeypatch):
+    """ Validates that projects and labels are listed from the cache without
+    reading its items """
+    read_cache = todoistcli.read_cache
+    read = []
+    monkeypatch.setattr(todoistcli, "read_cache",
+                        lambda *args: read.extend(args[1]) or read_cache(*args))
+    snap = todoistcli.Snapshot(None, 'tests/test_state.json')
+
+    assert todoistcli.list_projects(snap) == ["project 1 (2)", "project 2 (0)", "project 3 (1)"]
+    assert todoistcli.list_labels(snap) == ["label 1 (1)", "label 2 (1)", "label 3 (0)"]
+    assert not snap.loaded
+    assert not any(name.startswith("items") for name in read)
+
+
+class fake_manager:
+    """ Mock sdk manager that queues commands and adds objects to the state
+    like the sdk does """
+    def __init__(self, test_api, name):
+        self.api = test_api
+        self.name = name
+
+    def add(self, name, *args, **kwargs):
+        """ Adds an object with a temporary id """
+        temp_id = f"temp {len(self.api.queue)}"
+        obj = {"id": temp_id, "name": name, "content": name, "labels": [],
+               "project_id": args[0] if args else None,
+               "is_deleted": 0, "is_archived": 0, "in_history": 0}
+        obj.update(kwargs)
+        self.api.state[self.name].append(obj)
+        self.api.queue.append((self.name, "add", name, args, kwargs))
+        return obj
+
+    def __getattr__(self, command):
+        return lambda *args: self.api.queue.append((self.name, command, args))
+
+
+class commit_api:
+    """ Mock api that assigns real ids when committing """
+    def __init__(self):
+        self.state = {"projects": [], "items": [], "labels": []}
+        self.projects = fake_manager(self, "projects")
+        self.labels = fake_manager(self, "labels")
+        self.items = fake_manager(self, "items")
+        self.queue = []
+        self.commits = []
+        self.temp_ids = {}
+
+    def commit(self):
+        """ Replace temporary ids like the sdk does """
+        if not self.queue:
+            return
+        self.commits.append(self.queue[:])
+        del self.queue[:]
+        for name in self.state:
+            for obj in self.state[name]:
+                if str(obj["id"]).startswith("temp"):
+                    self.temp_ids[obj["id"]] = 100 + len(self.temp_ids)
+                    obj["id"] = self.temp_ids[obj["id"]]
+
+
+def test_create_project(tmpdir):
+    """ Validates that create_project returns the id from the commit """
+    snap = todoistcli.Snapshot(commit_api(), tmpdir.join('test_cache'))
+    assert snap.data["projects"] == {}
+
+    assert todoistcli.create_project(snap, "new project") == 100
+    assert todoistcli.get_proj_id(snap, "new project") == 100
+
+
+def test_create_label(tmpdir):
+    """ Validates that create_label returns the id from the commit """
+    snap = todoistcli.Snapshot(commit_api(), tmpdir.join('test_cache'))
+
+    assert todoistcli.create_label(snap, "new label") == 100
+    assert todoistcli.get_label_id(snap, "new label") == 100
+
+
+def test_batch(tmpdir, capsys):
+    """ Validates that batch queues every command and commits them once """
+    output = tmpdir.join('test_cache')
+    todoistcli.sync(api, output)
+    test_api = commit_api()
+    test_api.state = {name: [dict(obj) for obj in objs] for name, objs in api.state.items()}
+    lines = ['add "new project" task one @new @"label 1"',
+             'add "New Project" task two @new',
+             '# comment',
+             '',
+             'done 2',
+             'move 1 project 3',
+             'archive "project 1"',
+             'done 10',
+             'invalid']
+
+    count = todoistcli.batch(todoistcli.Snapshot(test_api, output), lines)
+    out, _ = capsys.readouterr()
+
+    assert count == 5
+    assert len(test_api.commits) == 1
+    assert test_api.commits[0] == [
+        ("projects", "add", "new project", (), {}),
+        ("labels", "add", "new", (), {}),
+        ("items", "add", "task one", ("temp 0",), {"labels": ["temp 1", 1]}),
+        ("items", "add", "task two", ("temp 0",), {"labels": ["temp 1"]}),
+        ("items", "complete", ([2],)),
+        ("items", "move", ({1: [1]}, 3)),
+        ("projects", "archive", (1,))]
+    assert "Error: line 8: [10] does not exist." in out
+    assert "Error: line 9: cannot parse invalid" in out
+
+
+def test_batch_without_cache(tmpdir, capsys):
+    """ Validates that batch resolves indexes from its state when there is no
+    cache yet, and sees the changes of earlier lines """
+    test_api = commit_api()
+    test_api.state = {name: [dict(obj) for obj in objs] for name, objs in api.state.items()}
+
+    count = todoistcli.batch(todoistcli.Snapshot(test_api, tmpdir.join('test_cache')),
+                             ["done 2", "move 1 project 3", "done 2"])
+    out, _ = capsys.readouterr()
+
+    assert count == 2
+    assert test_api.commits[0] == [("items", "complete", ([2],)),
+                                   ("items", "move", ({1: [1]}, 3))]
+    assert "Error: line 3: [2] does not exist." in out
+
+
+def test_batch_chunks(tmpdir, monkeypatch):
+    """ Validates that commands sharing a temporary id are committed together """
+    output = tmpdir.join('test_cache')
+    todoistcli.sync(api, output)
+    monkeypatch.setattr(todoistcli, "BATCH_SIZE", 3)
+    test_api = commit_api()
+    lines = ["add project task", "add other task @label", "add other task"]
+
+    todoistcli.batch(todoistcli.Snapshot(test_api, output), lines)
+
+    assert [len(commands) for commands in test_api.commits] == [2, 3, 1]
+    assert test_api.commits[2] == [("items", "add", "task", (102,), {})]
+
+
+def test_lazy_sdk_import():
+    """ Validates that importing todoistcli does not import the todoist sdk """
+    code = "import sys, todoistcli, todoistcli.daemon; print('todoist' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+
+    assert result.stdout == "False\n"
+
+
+def test_read_cache_sections(tmpdir):
+    """ Validates that single sections can be read from the cache """
+    output = tmpdir.join('test_cache')
+    todoistcli.sync(api, output)
+
+    assert todoistcli.read_cache(output, ["labels"]) == {"labels": {"label 1": 1,
+                                                                    "label 2": 2,
+                                                                    "label 3": 3}}
+    assert todoistcli.read_cache(output, ["items.3"]) == {
+        "items": {"3": {"3": {"content": "item 3", "index": 3, "labels": []}}}}
+    assert todoistcli.read_cache(output, ["lookups.index"])["lookups"] == {
+        "index": {"1": [1, 1], "2": [1, 2], "3": [3, 3]}}
+
+
+def test_read_cache_json():
+    """ Validates that sections can be read from a plain json cache """
+    test_data = 'tests/test_state.json'
+
+    actual = todoistcli.read_cache(test_data, ["items.1", "projects"])
+
+    assert actual == {"projects": {"1": {"name": "project 1"},
+                                   "2": {"name": "project 2"},
+                                   "3": {"name": "project 3"}},
+                      "items": {"1": {"1": {"content": "item 1", "index": 1, "labels": [1]},
+                                      "2": {"content": "item 2", "index": 2, "labels": [2]}}}}
+
+
+def test_read_cache_truncated(tmpdir):
+    """ Validates that a truncated cache raises ValueError """
+    output = tmpdir.join('test_cache')
+    todoistcli.sync(api, output)
+    output.write_binary(output.read_binary()[:30])
+
+    with pytest.raises(ValueError):
+        todoistcli.read_cache(output)
+
+
+def test_migrate_cache(tmpdir):
+    """ Validates that a json cache is rewritten in the sectioned format """
+    output = tmpdir.join('test_cache')
+    data = json.loads(open('tests/test_state.json').read())
+    resources = {"items": api.state["items"]}
+    output.write(json.dumps(dict(data, sync_token="token", resources=resources)))
+
+    assert todoistcli.migrate_cache(output)
+    assert output.read_binary().startswith(todoistcli.CACHE_MAGIC)
+    assert todoistcli.load_state(output) == \
+        dict(todoistcli.load_state('tests/test_state.json'), sync_token="token")
+    assert todoistcli.read_cache(output, ["resources"])["resources"] == resources
+    assert not todoistcli.migrate_cache(output)
+
+
+def test_get_item_sectioned(tmpdir):
+    """ Validates that get_item finds items read from the sectioned cache """
+    output = tmpdir.join('test_cache')
+    todoistcli.sync(api, output)
+    data = todoistcli.load_state(output)
+
+    assert todoistcli.get_item(data, 3) == (3, 3, {"content": "item 3", "index": 3,
+                                                   "labels": []})
+    assert todoistcli.get_item(data, 10) is None
+
+
+def stress_api(size):
+    """ Returns a mock api with size items spread over three projects """
+    class sized_api:
+        """ Mock api with a state of the given size """
+        state = {
+            "projects": api.state["projects"],
+            "labels": api.state["labels"],
+            "items": [{"id": i, "project_id": i % 3 + 1, "content": f"item {i}",
+                       "is_archived": 0, "in_history": 0, "is_deleted": 0, "labels": [1]}
+                      for i in range(size)]
+        }
+    return sized_api
+
+
+def stress_writer(cache_file, size, rounds):
+    """ Syncs a state of the given size into cache_file over and over """
+    test_api = stress_api(size)
+    for _ in range(rounds):
+        todoistcli.sync(test_api, cache_file)
+
+
+def stress_reader(cache_file, sizes, rounds, errors):
+    """ Loads cache_file over and over and records any partial state """
+    for _ in range(rounds):
+        try:
+            data = todoistcli.load_state(cache_file)
+            count = sum(len(items) for items in data["items"].values())
+            if count not in sizes or len(data["lookups"]["index"]) != count:
+                errors.put(f"partial state with {count} items")
+        except (OSError, ValueError) as e:
+            errors.put(repr(e))
+
+
+def test_save_state_concurrent(tmpdir):
+    """ Validates that readers never see a partial cache while many processes
+    write it at once """
+    output = str(tmpdir.join('test_cache'))
+    sizes = (500, 3000)
+    todoistcli.sync(stress_api(sizes[0]), output)
+    errors = multiprocessing.Queue()
+
+    processes = [multiprocessing.Process(target=stress_writer, args=(output, size, 15))
+                 for size in sizes * 3]
+    processes += [multiprocessing.Process(target=stress_reader,
+                                          args=(output, sizes, 40, errors))
+                  for _ in range(6)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert all(process.exitcode == 0 for process in processes)
+    assert errors.empty(), errors.get()
+    assert not [f for f in os.listdir(str(tmpdir)) if f.startswith(".test_cache")]
+
+
+def test_print_formatted_output_generator(capsys):
+    """ Verify that lines from a generator are printed """
+    todoistcli.print_formatted_output(f"line {i}" for i in range(1, 3))
+    out, _ = capsys.readouterr()
+    assert out == "line 1\nline 2\n"
+
+
+def test_print_formatted_output_closed_pipe():
+    """ Verify that output stops quietly, without producing every line, once
+    the reader closes the pipe """
+    code = ("import sys, todoistcli\n"
+            "produced = []\n"
+            "lines = (produced.append(i) or f'line {i}' for i in range(1000000))\n"
+            "todoistcli.print_formatted_output(lines)\n"
+            "sys.stderr.write(str(len(produced)))\n")
+    process = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, universal_newlines=True)
+    assert process.stdout.readline() == "line 0\n"
+    process.stdout.close()
+    _, err = process.communicate()
+
+    assert process.returncode == 0
+    assert int(err) < 1000000
+
+
+def test_list_items_all_limit(tmpdir):
+    """ Validates that only the first limit items are listed """
+    output = tmpdir.join('test_cache')
+    actual = todoistcli.list_items_all(api, output, limit=2)
+
+    assert actual == ["[1] project 1 - item 1 @label 1",
+                      "[2] project 1 - item 2 @label 2"]
+
+
+def test_iter_labels_limit(tmpdir):
+    """ Validates that labels are yielded up to limit """
+    output = tmpdir.join('test_cache')
+    actual = todoistcli.iter_labels(api, output, limit=1)
+
+    assert next(actual) == "label 1 (1)"
+    assert list(actual) == []
+
+
+def test_list_items_all_sort_project(tmpdir):
+    """ Validates that items can be sorted by project name and then index """
+    class sort_api:
+        """ Mock api whose project names sort differently from their items """
+        state = {
+            "projects": [{"id": 1, "name": "project 10", "is_archived": 0, "is_deleted": 0},
+                         {"id": 2, "name": "project 9", "is_archived": 0, "is_deleted": 0}],
+            "labels": [],
+            "items": [{"id": 1, "project_id": 1, "content": "item 1", "is_archived": 0,
+                       "in_history": 0, "is_deleted": 0, "labels": []},
+                      {"id": 2, "project_id": 2, "content": "item 2", "is_archived": 0,
+                       "in_history": 0, "is_deleted": 0, "labels": []}]
+        }
+
+    output = tmpdir.join('test_cache')
+
+    assert todoistcli.list_items_all(sort_api, output, sort="project") == [
+        "[2] project 9 - item 2 ", "[1] project 10 - item 1 "]
+    assert todoistcli.list_items_all(sort_api, output) == [
+        "[1] project 10 - item 1 ", "[2] project 9 - item 2 "]
+
+
+def test_format_item():
+    """ Validates that an item row shows its own labels and skips unknown ones """
+    item = {"content": "item 1", "index": 4, "labels": [2, 9, 1]}
+    label_names = {"1": "label 1", "2": "label 2"}
+
+    actual = todoistcli.format_item(item, "project 1", label_names)
+
+    assert actual == "[4] project 1 - item 1 @label 2 @label 1"
+
+
+@pytest.fixture
+def server_cache(tmpdir, todoist_server):
+    """ A cache of an account on todoist_server with one item in each of three
+    projects, and a function connecting to it like a mutation does """
+    todoist_server.add_account("token", "home", ["Inbox", "Chores", "Errands"])
+    key_file = tmpdir.join('api_key')
+    key_file.write("token")
+    cache_file = str(tmpdir.join('test_cache'))
+    todoistcli.sync(todoistcli.connect(cache_file, str(key_file),
+                                       api_endpoint=todoist_server.endpoint), cache_file)
+    del todoist_server.requests[:]
+
+    def mutation_snapshot():
+        test_api = todoistcli.connect(cache_file, str(key_file),
+                                      api_endpoint=todoist_server.endpoint, sync=False)
+        return todoistcli.Snapshot(test_api, cache_file, cached=True)
+
+    return cache_file, mutation_snapshot
+
+
+def test_done_failed_refresh(server_cache, todoist_server, monkeypatch):
+    """ Validates that a commit failing for good leaves nothing queued and
+    that refreshing the snapshot undoes the change made ahead of it """
+    _, mutation_snapshot = server_cache
+    snap = mutation_snapshot()
+    snap.api.scheduler.sleep = lambda seconds: None
+    todoist_server.fail(503, times=5)
+    monkeypatch.setattr(sys, "argv", ["todo", "done", "1"])
+
+    with pytest.raises(todoistcli.schedule.RequestError, match="did not answer"):
+        todoistcli.done(snap)
+    snap.refresh()
+
+    assert snap.api.queue == []
+    assert todoistcli.list_items_all(snap)[0] == "[1] Inbox - home item 1 @home"
+
+
+def test_connect_without_sync(server_cache, todoist_server):
+    """ Validates that mutations start from the cache without a request """
+    _, mutation_snapshot = server_cache
+
+    snap = mutation_snapshot()
+
+    assert todoist_server.requests == []
+    assert snap.api.sync_token != '*'
+    assert [item['content'] for item in snap.api.state['items']] == \
+        ["home item 1", "home item 2", "home item 3"]
+
+
+def test_sync_deletions(server_cache, todoist_server, tmpdir):
+    """ Validates that items and projects deleted elsewhere leave the cache
+    on the next incremental sync """
+    cache_file, _ = server_cache
+    todoist_server.change("token", "items", 1, is_deleted=1)
+    todoist_server.change("token", "projects", 3, is_deleted=1)
+
+    todoistcli.sync(todoistcli.connect(cache_file, str(tmpdir.join('api_key')),
+                                       api_endpoint=todoist_server.endpoint), cache_file)
+
+    assert todoist_server.requests[0]["sync_token"] != "*"
+    assert todoistcli.list_items_all(None, cache_file) == ["[2] Chores - home item 2 @home"]
+    assert todoistcli.list_projects(None, cache_file) == ["Chores (1)", "Inbox (0)"]
+
+
+def test_done_keeps_indexes(server_cache, todoist_server, monkeypatch):
+    """ Validates that done commits once and leaves the other indexes alone """
+    cache_file, mutation_snapshot = server_cache
+    snap = mutation_snapshot()
+    monkeypatch.setattr(sys, "argv", ["todo", "done", "2"])
+
+    todoistcli.done(snap)
+    snap.save()
+
+    assert len(todoist_server.requests) == 1
+    assert todoistcli.list_items_all(None, cache_file) == \
+        ["[1] Inbox - home item 1 @home", "[3] Errands - home item 3 @home"]
+
+
+def test_done_selection(server_cache, todoist_server, monkeypatch, capsys):
+    """ Validates that done completes a selection with one command and commit """
+    cache_file, mutation_snapshot = server_cache
+    snap = mutation_snapshot()
+    monkeypatch.setattr(sys, "argv", ["todo", "done", "1,3-9"])
+
+    todoistcli.done(snap)
+    snap.save()
+    out, _ = capsys.readouterr()
+
+    commands = json.loads(todoist_server.requests[0]["commands"])
+    assert len(todoist_server.requests) == 1
+    assert [command["args"]["ids"] for command in commands] == [[1, 3]]
+    assert out == "Marking [1] home item 1 as done\nMarking [3] home item 3 as done\n"
+    assert todoistcli.list_items_all(None, cache_file) == ["[2] Chores - home item 2 @home"]
+
+
+def test_done_missing(server_cache, todoist_server, monkeypatch, capsys):
+    """ Validates that nothing is completed when a listed index is missing """
+    _, mutation_snapshot = server_cache
+    monkeypatch.setattr(sys, "argv", ["todo", "done", "1", "7"])
+
+    with pytest.raises(SystemExit):
+        todoistcli.done(mutation_snapshot())
+    out, _ = capsys.readouterr()
+
+    assert out == "Error: [7] does not exist.\n"
+    assert todoist_server.requests == []
+
+
+def test_done_refreshed(server_cache, todoist_server, tmpdir, monkeypatch, capsys):
+    """ Validates that done --refresh selects from the synced state rather
+    than the cache it started from """
+    cache_file, _ = server_cache
+    todoist_server.change("token", "items", 4, project_id=2, content="remote item")
+    test_api = todoistcli.connect(cache_file, str(tmpdir.join('api_key')),
+                                  api_endpoint=todoist_server.endpoint)
+    monkeypatch.setattr(sys, "argv", ["todo", "done", "remote"])
+
+    todoistcli.done(todoistcli.Snapshot(test_api, cache_file))
+    out, _ = capsys.readouterr()
+
+    assert out == "Marking [4] remote item as done\n"
+
+
+def test_add_item_provisional_index(server_cache, todoist_server, monkeypatch, capsys):
+    """ Validates that added items take the next index and keep it once the
+    commit gives them a real id """
+    cache_file, mutation_snapshot = server_cache
+    snap = mutation_snapshot()
+    monkeypatch.setattr(sys, "argv", ["todo", "add", "Chores", "new", "task", "@home"])
+
+    todoistcli.add_item(snap)
+    snap.save()
+    out, _ = capsys.readouterr()
+
+    assert out == "Task added as [4]\n"
+    assert len(todoist_server.requests) == 1
+    assert todoistcli.get_item(todoistcli.load_state(cache_file), 4) == \
+        (2, 4, {"content": "new task", "labels": [1], "index": 4})
+    assert todoistcli.list_items_project(None, "Chores", cache_file) == \
+        ["[2] Chores - home item 2 @home", "[4] Chores - new task @home"]
+
+
+def test_add_item_after_done(server_cache, monkeypatch, capsys):
+    """ Validates that an added item does not take the held index of an item
+    just done, and that adds built from the same cache print the indexes
+    they are saved with """
+    cache_file, mutation_snapshot = server_cache
+    monkeypatch.setattr(sys, "argv", ["todo", "done", "3"])
+    todoistcli.done(mutation_snapshot())
+    capsys.readouterr()
+
+    first, second = mutation_snapshot(), mutation_snapshot()
+    assert first.data['lookups']['index'] == second.data['lookups']['index']
+    for snap, task in ((first, "first"), (second, "second")):
+        monkeypatch.setattr(sys, "argv", ["todo", "add", "Chores", task])
+        todoistcli.add_item(snap)
+    out, _ = capsys.readouterr()
+
+    assert out == "Task added as [4]\nTask added as [5]\n"
+    assert todoistcli.list_items_project(None, "Chores", cache_file)[-1] == \
+        "[5] Chores - second"
+
+
+def test_move_and_archive(server_cache, monkeypatch):
+    """ Validates that moved items keep their index and archived projects go """
+    cache_file, mutation_snapshot = server_cache
+    snap = mutation_snapshot()
+    monkeypatch.setattr(sys, "argv", ["todo", "move", "3", "Inbox"])
+    todoistcli.move(snap)
+    snap.save()
+
+    snap = mutation_snapshot()
+    monkeypatch.setattr(sys, "argv", ["todo", "archive", "Chores"])
+    todoistcli.archive_project(snap)
+    snap.save()
+
+    assert todoistcli.list_items_all(None, cache_file) == \
+        ["[1] Inbox - home item 1 @home", "[3] Inbox - home item 3 @home"]
+    assert todoistcli.list_projects(None, cache_file) == ["Errands (0)", "Inbox (2)"]
+
+
+def test_move_selection(server_cache, todoist_server, monkeypatch):
+    """ Validates that move moves the items matching a query with one command,
+    once confirmed with --yes """
+    cache_file, mutation_snapshot = server_cache
+    snap = mutation_snapshot()
+    monkeypatch.setattr(sys, "argv", ["todo", "move", "#chores or #errands", "Inbox"])
+    with pytest.raises(SystemExit):
+        todoistcli.move(snap)
+    assert todoist_server.requests == []
+
+    monkeypatch.setattr(sys, "argv", ["todo", "move", "--yes", "#chores or #errands", "Inbox"])
+    todoistcli.move(snap)
+    snap.save()
+
+    commands = json.loads(todoist_server.requests[0]["commands"])
+    assert len(todoist_server.requests) == 1
+    assert [command["type"] for command in commands] == ["item_move"]
+    assert todoistcli.list_items_all(None, cache_file) == \
+        ["[1] Inbox - home item 1 @home", "[2] Inbox - home item 2 @home",
+         "[3] Inbox - home item 3 @home"]
+
+
+def test_delete_label(server_cache):
+    """ Validates that deleted labels leave the cache and their items """
+    cache_file, mutation_snapshot = server_cache
+    snap = mutation_snapshot()
+
+    todoistcli.delete_label(snap, "home")
+    snap.save()
+
+    assert todoistcli.list_labels(None, cache_file) == []
+    assert todoistcli.list_items_all(None, cache_file)[0] == "[1] Inbox - home item 1 "
+
+
+def test_snapshot_applies_before_commit(tmpdir):
+    """ Validates that queued changes show in the state before they commit """
+    output = tmpdir.join('test_cache')
+    todoistcli.sync(api, output)
+    snap = todoistcli.Snapshot(commit_api(), output, cached=True)
+
+    item_id = todoistcli.queue_add(snap, "project 2", ["task", "@label 1"],
+                                   dict(snap.data['lookups']['project_names']),
+                                   dict(snap.data['labels']))
+    snap.remove_item(1, 1)
+
+    assert snap.index_of(item_id) == 4
+    assert todoistcli.list_items_all(snap) == ["[2] project 1 - item 2 @label 2",
+                                               "[3] project 3 - item 3 ",
+                                               "[4] project 2 - task @label 1"]
+
+
+def test_snapshot_updates_lookups(tmpdir, monkeypatch):
+    """ Validates that queued changes keep the lookups as build_lookups would
+    build them without rebuilding them """
+    output = tmpdir.join('test_cache')
+    todoistcli.sync(api, output)
+    snap = todoistcli.Snapshot(commit_api(), output, cached=True)
+    data = snap.data
+
+    def normalized(lookups):
+        tables = {table: {key: str(value) if table == "project_names" else value
+                          for key, value in lookups[table].items()}
+                  for table in todoistcli.LOOKUP_TABLES}
+        tables["index"] = {key: list(map(str, value)) for key, value in tables["index"].items()}
+        tables["label_items"] = {key: sorted([str(p), str(i)] for p, i in value)
+                                 for key, value in tables["label_items"].items() if value}
+        return tables
+
+    with monkeypatch.context() as patch:
+        patch.setattr(todoistcli, "build_lookups", None)
+        todoistcli.queue_add(snap, "project 9", ["task", "@label 9", "@label 1"],
+                             dict(data['lookups']['project_names']), dict(data['labels']))
+        snap.move_item(1, 2, 3)
+        snap.remove_item(1, 1)
+        snap.remove_label("label 1")
+        snap.add_project("temp project", "Another")
+        snap.remove_project(3)
+
+    assert normalized(data['lookups']) == \
+        normalized(todoistcli.build_lookups(data['projects'], data['items'], data['labels']))
+    assert list(data['lookups']['index']) == ["4"]
+
+
+def test_assign_indexes(monkeypatch):
+    """ Validates that items keep their index and freed ones are held """
+    monkeypatch.setenv("TODOIST_INDEX_HOLD", "60")
+    index = {"1": [1, 1], "2": [1, 2], "3": [1, 3], "4": [2, "temp"]}
+
+    def state():
+        return {1: {1: {}, 3: {}}, 2: {9: {}, 7: {}}}
+
+    items = state()
+    freed = todoistcli.assign_indexes(items, index, temp_ids={"temp": 9}, now=1000)
+
+    assert todoistcli.item_indexes(items) == {"1": 1, "3": 3, "9": 4, "7": 5}
+    assert freed == {"2": [1000, "2"]}
+
+    items = state()
+    todoistcli.assign_indexes(items, index, {"2": [939, "2"]}, {"temp": 9}, now=1000)
+
+    assert todoistcli.item_indexes(items)["7"] == 2
+
+    items = {1: {1: {}, 2: {}}}
+    freed = todoistcli.assign_indexes(items, {"1": [1, 1]}, {"2": [999, "2"]}, now=1000)
+
+    assert todoistcli.item_indexes(items) == {"1": 1, "2": 2}
+    assert freed == {}
+
+
+def test_sync_keeps_indexes(tmpdir):
+    """ Validates that syncs leave the indexes of unchanged items alone """
+    output = tmpdir.join('test_cache')
+    todoistcli.sync(api, output)
+    test_api = commit_api()
+    test_api.state = {name: [dict(obj) for obj in objs] for name, objs in api.state.items()}
+    test_api.state["items"][1]["in_history"] = 1
+    test_api.state["items"].append({"id": 7, "project_id": 1, "content": "item 7",
+                                    "is_archived": 0, "in_history": 0, "is_deleted": 0,
+                                    "labels": []})
+
+    todoistcli.sync(test_api, output)
+
+    assert todoistcli.list_items_all(None, output) == ["[1] project 1 - item 1 @label 1",
+                                                       "[3] project 3 - item 3 ",
+                                                       "[4] project 1 - item 7 "]
+    assert list(todoistcli.load_state(output)["freed_indexes"]) == ["2"]
+
+
+def test_save_state_renumbers_against_cache(tmpdir):
+    """ Validates that a state built before another todo wrote the cache does
+    not reuse the numbers that todo gave out """
+    output = tmpdir.join('test_cache')
+    todoistcli.sync(api, output)
+    previous = todoistcli.load_state(output)
+
+    def added(item_id):
+        test_api = commit_api()
+        test_api.state = {name: [dict(obj) for obj in objs]
+                          for name, objs in api.state.items()}
+        test_api.state["items"].append({"id": item_id, "project_id": 1,
+                                        "content": f"item {item_id}", "is_archived": 0,
+                                        "in_history": 0, "is_deleted": 0, "labels": []})
+        return todoistcli.build_state(test_api, previous)
+
+    first, second = added(7), added(8)
+    for data in (first, second):
+        todoistcli.save_state(data["projects"], data["items"], data["labels"], output,
+                              lookups=data["lookups"])
+
+    assert todoistcli.get_item(todoistcli.load_state(output), 4) is None
+    assert todoistcli.get_item(todoistcli.load_state(output), 5)[1] == 8
+    assert todoistcli.item_indexes(second["items"])["8"] == 5
@@ -0,0 +1,59 @@
+""" Tests for watching todoist for changes """
+import todoistcli
+import todoistcli.watch
+
+
+def test_next_interval():
+    """ Validates that polls back off while nothing changes """
+    assert todoistcli.watch.next_interval(2, False) == 4
+    assert todoistcli.watch.next_interval(4, None) == 8
+    assert todoistcli.watch.next_interval(40, False) == 60
+    assert todoistcli.watch.next_interval(60, True) == 2
+
+
+def test_diff():
+    """ Validates that only changed rows are listed, marked by change """
+    before = ({"1": "[1] Inbox - a ", "2": "[2] Inbox - b ", "3": "[3] Inbox - c "},
+              {"1": "1", "2": "1", "3": "1"})
+    after = ({"2": "[2] Inbox - b2 ", "3": "[3] Chores - c ", "4": "[4] Inbox - d "},
+             {"2": "1", "3": "2", "4": "1"})
+
+    assert list(todoistcli.watch.diff(before, after)) == \
+        ["- [1] Inbox - a ", "~ [2] Inbox - b2 ", "> [3] Chores - c ", "+ [4] Inbox - d "]
+
+
+def test_watch(tmpdir, todoist_server, capsys):
+    """ Validates that watch prints the list, then the rows each change makes,
+    backing off while nothing changes and saving the cache after changes """
+    todoist_server.add_account("token", "home", ["Inbox", "Chores", "Errands"])
+    tmpdir.join('api_key').write("token")
+    cache_file = str(tmpdir.join('cache'))
+    snap = todoistcli.Snapshot(todoistcli.connect(cache_file, str(tmpdir.join('api_key')),
+                                                  api_endpoint=todoist_server.endpoint),
+                               cache_file)
+    slept = []
+
+    def sleep(interval):
+        slept.append(interval)
+        if len(slept) == 2:
+            todoist_server.change("token", "items", 1, in_history=1)
+            todoist_server.change("token", "items", 2, content="home item 2 edited")
+            todoist_server.change("token", "items", 3, project_id=1)
+            todoist_server.change("token", "items", 4, project_id=2, content="new", labels=[1])
+
+    assert todoistcli.watch.watch(snap, todoistcli.iter_items_all, polls=3, sleep=sleep)
+    out, _ = capsys.readouterr()
+
+    assert out.splitlines() == [
+        "[1] Inbox - home item 1 @home",
+        "[2] Chores - home item 2 @home",
+        "[3] Errands - home item 3 @home",
+        "- [1] Inbox - home item 1 @home",
+        "~ [2] Chores - home item 2 edited @home",
+        "> [3] Inbox - home item 3 @home",
+        "+ [4] Chores - new @home",
+    ]
+    assert slept == [2, 4, 2]
+    assert len(todoist_server.requests) == 4
+    assert todoistcli.list_items_project(None, "Inbox", cache_file) == \
+        ["[3] Inbox - home item 3 @home"]
@@ -1,30 +1,74 @@
 #!/usr/bin/env python3
 """ lists and adds tasks to todoist """
 
+import codecs
+import collections
+import contextlib
+import fcntl
+import heapq
 import json
+import mmap
+import operator
 import os
 import re
+import shlex
+import struct
 import sys
-import todoist
+import time
+from todoistcli import complete, metrics, query, schedule, store
 
 
 def print_help():
     """ Prints out help """
     msg = "add [project] [task] - adds task to project\n"
     msg += "archive [project] - archives project\n"
+    msg += "batch - runs add, done, move and archive commands read from stdin, one per line\n"
+    msg += "cache requests - shows how many requests todoist answered, retried and throttled\n"
+    msg += "daemon - keeps todoist in memory and answers other todo commands quickly\n"
     msg += "delete label [tag] - deletes a label\n"
-    msg += "done [task index] - marks task as done\n"
+    msg += "done [selection] - marks tasks as done, selected by index, ranges\n"
+    msg += "    such as 3-40,52, or a search query such as @someday\n"
+    msg += "export [--format ndjson|csv] [--project name] [--label name] - writes every\n"
+    msg += "    task with all its fields\n"
     msg += "labels - lists labels\n"
     msg += "list - lists all projects and their items\n"
     msg += "list label [label] - lists items associated with that label\n"
     msg += "list project [project] - lists items associated with that project\n"
-    msg += "projects - lists projects"
+    msg += "move [selection] [project] - moves tasks to project, quote queries with spaces\n"
+    msg += "projects - lists projects\n"
+    msg += "search [query] - lists items matching words, project:[name] and label:[name],\n"
+    msg += "    combined with and, or, not and parentheses\n"
+    msg += "watch - lists all items and then the rows that change, as they change\n"
+    msg += "watch label|project [name] - watches the items of a label or project\n"
+    msg += "\n"
+    msg += "--account [name] - use the account in ~/.config/todoist/accounts/[name]\n"
+    msg += "--accounts - sync, or list projects, items or labels, of every account\n"
+    msg += "--profile - write the time, sizes and counts of each step to stderr as json\n"
+    msg += "--cprofile [file] - write cProfile stats to file\n"
+    msg += "--refresh - sync with todoist even if the cache is fresh\n"
+    msg += "--limit [n] - only list the first n lines\n"
+    msg += "--yes - let done and move change the tasks of a query matching several\n"
+    msg += "    of them or starting with not\n"
+    msg += "--sort project - list items by project name instead of by index"
     print(msg)
 
 
 def print_formatted_output(output):
-    """ This will eventually handle formatting the output of data. """
-    print('\n'.join(output))
+    """ Prints each line of output as soon as it is produced. Stops quietly,
+    and stops producing lines, once stdout is closed, as it is by head. """
+    with metrics.phase("print") as fields:
+        fields["lines"] = 0
+        try:
+            for line in output:
+                sys.stdout.write(line + "\n")
+                fields["lines"] += 1
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # Point stdout at devnull so flushing it at exit does not fail again
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            return False
+    return True
 
 
 def natural_sort(s, nsre=re.compile('([0-9]+)')):
@@ -33,19 +77,108 @@ def natural_sort(s, nsre=re.compile('([0-9]+)')):
             for text in nsre.split(s)]
 
 
-def connect():
-    """ Connect to todoist """
+# Raw resources kept in the cache so later syncs only pull changes
+RESOURCES = ("projects", "items", "labels")
+
+
+def connect(cache_file="~/.config/todoist/cache", api_key_file="~/.config/todoist/api_key",
+            session=None, api_endpoint="https://todoist.com", sync=True):
+    """ Connect to todoist. Accounts synced together share one session so its
+    connections are reused. Without sync the api starts from the cache and
+    the first commit brings it up to date, commands that only change todoist
+    need no sync of their own. """
+    # The sdk and requests are slow to import, so only load them when needed
+    with metrics.phase("import_todoist"):
+        import todoist  # pylint: disable=import-outside-toplevel
+
     # Get API Token for todoist
-    api_file = open(os.path.expanduser("~/.config/todoist/api_key"), "r")
-    api_key = api_file.read()
+    api_file = open(os.path.expanduser(api_key_file), "r")
+    api_key = api_file.read().strip()
     api_file.close()
 
-    # Connect to todoist
-    api = todoist.TodoistAPI(api_key)
-    api.sync()
+    # Connect to todoist, the cache file replaces the sdk's own cache
+    api = todoist.TodoistAPI(api_key, api_endpoint=api_endpoint, session=session, cache=None)
+    if metrics.enabled() and metrics.http_hook not in api.session.hooks["response"]:
+        api.session.hooks["response"].append(metrics.http_hook)
+    # Every sync and commit from here on is paced and retried by its scheduler
+    schedule.attach(api, cache_file)
+    if sync or not prime(api, cache_file):
+        incremental_sync(api, cache_file)
+    return api
+
+
+def merge_resources(resources, changes):
+    """ Merges objects changed since the last sync into the cached resources """
+    merged = {}
+    for name in RESOURCES:
+        objs = {obj['id']: obj for obj in resources.get(name, [])}
+        for obj in changes.get(name, []):
+            obj = getattr(obj, 'data', obj)
+            if obj.get('is_deleted'):
+                objs.pop(obj['id'], None)
+            elif obj['id'] in objs:
+                objs[obj['id']] = {**objs[obj['id']], **obj}
+            else:
+                objs[obj['id']] = obj
+        merged[name] = list(objs.values())
+    return merged
+
+
+def incremental_sync(api, cache_file="~/.config/todoist/cache"):
+    """ Syncs api, only pulling what changed since the cached sync token """
+    try:
+        state = read_cache(cache_file, ["resources", "sync_token"])
+    except (OSError, ValueError):
+        state = {}
+
+    sync_token = state.get('sync_token')
+    if sync_token:
+        api.sync_token = sync_token
+
+    with metrics.phase("sync", incremental=bool(sync_token)) as fields:
+        response = schedule.sync(api)
+        if metrics.enabled() and isinstance(response, dict):
+            fields["full_sync"] = response.get("full_sync")
+            fields.update({name: len(response.get(name, [])) for name in RESOURCES})
+
+    if not sync_token or (isinstance(response, dict) and response.get('full_sync')):
+        return api
+
+    # Merge the reply rather than api.state, the sdk drops deletions of
+    # objects it does not hold and it started out holding none
+    restore(api, merge_resources(state.get('resources', {}), response))
     return api
 
 
+def restore(api, resources):
+    """ Replaces the projects, items and labels in api.state with resources
+    wrapped in the sdk's models """
+    import todoist.models  # pylint: disable=import-outside-toplevel
+    models = {
+        "projects": todoist.models.Project,
+        "items": todoist.models.Item,
+        "labels": todoist.models.Label
+    }
+    for name in RESOURCES:
+        api.state[name] = [models[name](obj, api) for obj in resources.get(name, [])]
+
+
+def prime(api, cache_file="~/.config/todoist/cache"):
+    """ Loads the cached resources and sync token into api without syncing.
+    The reply to the next commit then holds everything changed since the
+    cache was written and the sdk merges it into api.state. Returns False,
+    leaving api alone, when the cache has no sync token. """
+    try:
+        state = read_cache(cache_file, ["resources", "sync_token"])
+    except (OSError, ValueError):
+        return False
+    if not state.get('sync_token'):
+        return False
+    api.sync_token = state['sync_token']
+    restore(api, state.get('resources', {}))
+    return True
+
+
 def get_projects(api):
     """ Get a list of projects and a dict for the useful info """
     projects = {}
@@ -71,8 +204,8 @@ def get_labels(api):
 
 
 def get_items(api):
-    """ Get a list of projects and a dict for the useful info """
-    items = {}
+    """ Get a store of the tasks that are not done, see store.TaskStore """
+    items = store.TaskStore()
     for item in api.state['items']:
         if item['is_deleted']:
             continue
@@ -83,94 +216,987 @@ def get_items(api):
 
         if item['project_id'] not in items:
             items[item['project_id']] = {}
-        items[item['project_id']][item['id']] = {
-            "content": item['content'],
-            "labels": item['labels']
-        }
-
-        index = 1
-        for proj_id in items:
-            for item_id in items[proj_id]:
-                items[proj_id][item_id].update({"index": index})
-                index += 1
+        items[item['project_id']][item['id']] = store.Task(item['content'], item['labels'])
+
+    # Number items in project order once everything has been grouped
+    index = 1
+    for proj_items in items.values():
+        for item in proj_items.values():
+            item.index = index
+            index += 1
     return items
 
 
-def save_state(projects, items, labels, cache_file="~/.config/todoist/cache"):
-    """ Saves relevant todo information as json into a cache file """
+# Tables written to the lookups section of the cache
+LOOKUP_TABLES = ("index", "label_items", "project_names", "label_names",
+                 "project_rank", "label_rank")
+
+
+def build_lookups(projects, items, labels):
+    """ Builds lookup tables so tasks, projects and labels can be found without
+    walking every item. Keys are strings as json would store them. """
+    lookups = {table: {} for table in LOOKUP_TABLES}
+    for proj_id in projects:
+        lookups["project_names"][projects[proj_id]['name'].lower()] = proj_id
+    for name, label_id in labels.items():
+        lookups["label_names"][str(label_id)] = name
+    lookups["project_rank"] = project_ranks(projects)
+    lookups["label_rank"] = label_ranks(labels)
+    for proj_id, proj_items in items.items():
+        for item_id, item in proj_items.items():
+            lookups["index"][str(item['index'])] = [proj_id, item_id]
+            for label_id in item['labels']:
+                lookups["label_items"].setdefault(str(label_id), []).append([proj_id, item_id])
+    return lookups
+
+
+def project_ranks(projects):
+    """ Returns the rank of each project id, as a string, with names in
+    natural order, so listings sort on plain integers """
+    ranked = sorted(projects, key=lambda proj_id: natural_sort(projects[proj_id]['name']))
+    return {str(proj_id): rank for rank, proj_id in enumerate(ranked)}
+
+
+def label_ranks(labels):
+    """ Returns the rank of each label id, as a string, with names in natural
+    order """
+    return {str(labels[name]): rank for rank, name in enumerate(sorted(labels, key=natural_sort))}
+
+
+def tokenize(text):
+    """ Returns the lowercased words in text """
+    return re.findall(r"\w+", text.lower())
+
+
+def search_entries(items):
+    """ Returns the index, project id, content and label ids of each item in
+    items by item id, ids as strings, which are what its postings hold """
+    entries = {}
+    for proj_id, proj_items in items.items():
+        proj_id = str(proj_id)
+        for item_id, item in proj_items.items():
+            entries[str(item_id)] = [item['index'], proj_id, item['content'],
+                                     list(map(str, item['labels']))]
+    return entries
+
+
+def token_section(token):
+    """ Returns the search index section holding the postings of token, and
+    of every other word starting with the same two letters """
+    return "w:" + token[:2]
+
+
+def posting_keys(entry):
+    """ Returns the section, and the word within it for word sections, of
+    each posting list an item with the search entry entry is in """
+    _, proj_id, content, labels = entry
+    keys = {(token_section(token), token) for token in tokenize(content)}
+    keys.add((f"p:{proj_id}", None))
+    keys.update((f"l:{label_id}", None) for label_id in labels)
+    return keys
+
+
+def update_search(search, items, previous=None):
+    """ Updates a search index built from previous, items by project as they
+    were, to match items and returns it. Without search a new index of items
+    is built. Only items whose index, project, content or labels differ have
+    their postings changed, so projects whose items are the same in both may
+    be left out of both. search maps section names to their value, or to
+    their undecoded json as read from the last cache, and only the sections
+    with postings of changed items are decoded.
+
+    The index is split into sections so a query reads only what it needs.
+    w:<letters> maps each word starting with those two letters to its
+    postings, and p:<project id> and l:<label id> hold the postings of a
+    project's and a label's items. A posting is an item's index, project id
+    and item id, ids as strings. """
+    search = dict(search or {})
+    current = search_entries(items)
+    last = search_entries(previous or {})
+    changed = [item_id for item_id, entry in current.items() if last.get(item_id) != entry]
+    changed += [item_id for item_id in last if item_id not in current]
+    if not changed:
+        return search
+
+    sections = {}
+
+    def section(name):
+        if name not in sections:
+            value = search.get(name)
+            if isinstance(value, bytes):
+                value = json.loads(value)
+            sections[name] = value or ({} if name.startswith("w:") else [])
+        return sections[name]
+
+    gone = {}
+    for item_id in changed:
+        if item_id in last:
+            for key in posting_keys(last[item_id]):
+                gone.setdefault(key, set()).add(item_id)
+    for (name, token), item_ids in gone.items():
+        postings = section(name)
+        if token is None:
+            postings[:] = [posting for posting in postings if posting[2] not in item_ids]
+            continue
+        kept = [posting for posting in postings.get(token, []) if posting[2] not in item_ids]
+        if kept:
+            postings[token] = kept
+        else:
+            postings.pop(token, None)
+
+    # Group the new postings by word first so each section is looked up once
+    # per word rather than once per item
+    added, lists = {}, {}
+    for item_id in changed:
+        if item_id not in current:
+            continue
+        index, proj_id, content, labels = current[item_id]
+        posting = [index, proj_id, item_id]
+        for token in set(tokenize(content)):
+            added.setdefault(token, []).append(posting)
+        lists.setdefault(f"p:{proj_id}", []).append(posting)
+        for label_id in labels:
+            lists.setdefault(f"l:{label_id}", []).append(posting)
+    for token, new in added.items():
+        section(token_section(token)).setdefault(token, []).extend(new)
+    for name, new in lists.items():
+        section(name).extend(new)
+
+    for name, postings in sections.items():
+        if postings:
+            search[name] = postings
+        else:
+            search.pop(name, None)
+    return search
+
+
+def search_built(search):
+    """ Returns True if search holds a search index update_search can update,
+    indexes written before it was split into sections are built again """
+    return any(name.startswith("p:") for name in search)
+
+
+def lookup(data, obj_id):
+    """ Returns data[obj_id], whose keys are strings once loaded from the cache
+    while ids stored as values or in lookups may be either """
+    if obj_id in data:
+        return data[obj_id]
+    if str(obj_id) in data:
+        return data[str(obj_id)]
+    if isinstance(obj_id, str) and obj_id.isdigit():
+        return data[int(obj_id)]
+    raise KeyError(obj_id)
+
+
+# The cache starts with CACHE_MAGIC, a version and a table of contents giving
+# the offset and length of each section, followed by the sections as json
+CACHE_MAGIC = b"TODOCACHE"
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct("<HI")
+CACHE_ENTRY = struct.Struct("<QQ")
+CACHE_NAME = struct.Struct("<H")
+
+# Sections split into one section per key, so each key can be read alone.
+# Caches written before resources was split hold it as one section.
+SPLIT_SECTIONS = ("items", "lookups", "search", "resources")
+# Sections load_state reads, the search index is only read by searches and
+# the raw resources only by syncs, exports and migrating
+STATE_SECTIONS = ("projects", "items", "labels", "lookups", "sync_token", "freed_indexes")
+
+
+def encode_section(value):
+    """ Returns value encoded as the json of a cache section, values already
+    encoded, such as read by read_raw_sections, are returned as they are """
+    if isinstance(value, bytes):
+        return value
+    return json.dumps(value, separators=(',', ':'), default=store.as_json).encode()
+
+
+def encode_cache(state):
+    """ Returns state encoded as a sectioned cache file """
+    sections = []
+    for key, value in state.items():
+        if key in SPLIT_SECTIONS and isinstance(value, dict):
+            sections += [(f"{key}.{sub}", sub_value) for sub, sub_value in value.items()]
+        else:
+            sections.append((key, value))
+
+    payloads = [encode_section(value) for _, value in sections]
+    names = [name.encode() for name, _ in sections]
+    offset = len(CACHE_MAGIC) + CACHE_HEADER.size
+    offset += sum(CACHE_NAME.size + len(name) + CACHE_ENTRY.size for name in names)
+
+    header = [CACHE_MAGIC, CACHE_HEADER.pack(CACHE_VERSION, len(sections))]
+    for name, payload in zip(names, payloads):
+        header += [CACHE_NAME.pack(len(name)), name, CACHE_ENTRY.pack(offset, len(payload))]
+        offset += len(payload)
+    return b"".join(header + payloads)
+
+
+def wanted(name, sections):
+    """ Returns True if section name is one of sections or nested under one """
+    return sections is None or any(name == s or name.startswith(s + ".") for s in sections)
+
+
+def read_cache(cache_file="~/.config/todoist/cache", sections=None):
+    """ Reads the named sections, or all of them, from a cache file. Sections
+    nested under items and lookups are named like items.<project id>. Caches
+    written as plain json are still read. """
+    with open(os.path.expanduser(cache_file), "rb") as f, \
+            metrics.phase("read_cache", sections=sections) as fields:
+        if metrics.enabled():
+            fields["file_bytes"] = os.fstat(f.fileno()).st_size
+        if f.read(len(CACHE_MAGIC)) == CACHE_MAGIC:
+            data = read_sections(f, sections)
+        else:
+            f.seek(0)
+            data = {}
+            for key, value in json.load(f).items():
+                if key in SPLIT_SECTIONS:
+                    value = {sub: v for sub, v in value.items()
+                             if wanted(f"{key}.{sub}", sections)}
+                    if value:
+                        data[key] = value
+                elif wanted(key, sections):
+                    data[key] = value
+
+    # Resources are only cached along with a sync token, so stay missing without one
+    for key in SPLIT_SECTIONS:
+        if key != "resources" and wanted(key, sections):
+            data.setdefault(key, {})
+    return data
+
+
+def iter_sections(mm):
+    """ Yields the name, offset and size of each section in a mapped
+    sectioned cache file """
+    pos = len(CACHE_MAGIC)
+    try:
+        version, count = CACHE_HEADER.unpack_from(mm, pos)
+        if version != CACHE_VERSION:
+            raise ValueError(f"Unsupported cache version {version}")
+        pos += CACHE_HEADER.size
+        for _ in range(count):
+            length, = CACHE_NAME.unpack_from(mm, pos)
+            pos += CACHE_NAME.size
+            name = mm[pos:pos + length].decode()
+            pos += length
+            offset, size = CACHE_ENTRY.unpack_from(mm, pos)
+            pos += CACHE_ENTRY.size
+            yield name, offset, size
+    except struct.error as e:
+        raise ValueError(f"Truncated cache: {e}")
+
+
+def read_sections(f, sections=None):
+    """ Reads the named sections from an open sectioned cache file """
+    data = {}
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for name, offset, size in iter_sections(mm):
+            if not wanted(name, sections):
+                continue
+            value = json.loads(mm[offset:offset + size])
+            key, _, sub = name.partition(".")
+            if key in SPLIT_SECTIONS and sub:
+                data.setdefault(key, {})[sub] = value
+            else:
+                data[key] = value
+    return data
+
+
+def read_raw(cache_file, name):
+    """ Returns the undecoded json of section name in a sectioned cache file,
+    or None if the file has no such section """
+    with open(os.path.expanduser(cache_file), "rb") as f:
+        if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for section, offset, size in iter_sections(mm):
+                if section == name:
+                    return mm[offset:offset + size]
+    return None
+
+
+def read_raw_sections(cache_file, key):
+    """ Returns the undecoded json of each section nested under key in a
+    sectioned cache file by its name under key, a plain json cache has none """
+    with open(os.path.expanduser(cache_file), "rb") as f:
+        if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            return {}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return {name[len(key) + 1:]: mm[offset:offset + size]
+                    for name, offset, size in iter_sections(mm)
+                    if name.startswith(key + ".")}
+
+
+def iter_array(cache_file, name, chunk_size=1 << 16):
+    """ Yields the elements of the json array in section name one at a time.
+    The section is decoded a chunk at a time, so memory does not grow with
+    the array. Caches written as plain json, or before the section was split
+    out, are read whole. """
+    with open(os.path.expanduser(cache_file), "rb") as f:
+        if f.read(len(CACHE_MAGIC)) == CACHE_MAGIC:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for section, offset, size in iter_sections(mm):
+                    if section == name:
+                        yield from decode_array(mm, offset, offset + size, chunk_size)
+                        return
+    key, _, sub = name.partition(".")
+    yield from read_cache(cache_file, [key]).get(key, {}).get(sub, [])
+
+
+JSON_SPACE = re.compile(r"[ \t\n\r]*")
+
+
+def decode_array(buf, start, end, chunk_size=1 << 16):
+    """ Yields the elements of the json array in buf[start:end], decoding
+    chunk_size bytes at a time """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    text, pos, read = "", 0, start
+    # What comes next: "[", "first" element or "]", an element, or "," or "]"
+    expect = "["
+    while True:
+        pos = JSON_SPACE.match(text, pos).end()
+        if pos < len(text) and expect != "element":
+            char = text[pos]
+            if expect == "[" and char == "[":
+                expect = "first"
+            elif expect in ("first", ",") and char == "]":
+                return
+            elif expect == "," and char == ",":
+                expect = "element"
+            elif expect == "first":
+                expect = "element"
+                continue
+            else:
+                raise ValueError(f"Malformed array at {char!r}")
+            pos += 1
+            continue
+        if pos < len(text):
+            try:
+                value, next_pos = decoder.raw_decode(text, pos)
+            except json.JSONDecodeError:
+                next_pos = None
+            # An element is only whole once what follows it is in the text,
+            # a number such as 1.5 decodes as 1 when cut after the 1
+            if next_pos is not None and (read >= end or next_pos < len(text)
+                                         and text[next_pos] in ",] \t\n\r"):
+                yield value
+                pos, expect = next_pos, ","
+                continue
+        if read >= end:
+            raise ValueError("Truncated array")
+        chunk = buf[read:min(read + chunk_size, end)]
+        read += len(chunk)
+        text = text[pos:] + utf8.decode(chunk, final=read >= end)
+        pos = 0
+
+
+def save_state(projects, items, labels, cache_file="~/.config/todoist/cache",
+               resources=None, sync_token=None, lookups=None):
+    """ Saves relevant todo information into a cache file and returns the
+    state written, whose items may have been renumbered """
     state = {
         "projects": projects,
         "items": items,
-        "labels": labels
+        "labels": labels,
+        "lookups": lookups or build_lookups(projects, items, labels)
     }
-    fh = open(os.path.expanduser(cache_file), "w")
-    fh.write(json.dumps(state))
-    fh.close()
-    return True
+    if sync_token:
+        state["sync_token"] = sync_token
+        state["resources"] = resources
+    with cache_lock(cache_file):
+        try:
+            last = read_cache(cache_file, ["freed_indexes"])
+            index = read_raw(cache_file, "lookups.index")
+            last_items = read_raw_sections(cache_file, "items")
+            search = read_raw_sections(cache_file, "search")
+        except (OSError, ValueError):
+            last, index, last_items, search = {}, None, {}, {}
+
+        # Number items against the cache as it is now, another todo may have
+        # written it since this state was built. When its index table is the
+        # one this state would write there is nothing to renumber.
+        state["freed_indexes"] = last.get("freed_indexes") or {}
+        index_json = encode_section(state["lookups"]["index"])
+        if index is not None and index != index_json:
+            state["freed_indexes"] = assign_indexes(items, json.loads(index),
+                                                    last.get("freed_indexes"))
+            if item_indexes(items) != table_indexes(state["lookups"]["index"]):
+                state["lookups"] = build_lookups(projects, items, labels)
+                index_json = encode_section(state["lookups"]["index"])
+
+        # Each project's items are encoded once, and those that encode as
+        # they are in the last cache have not changed. The search index is
+        # carried over undecoded and only updated for the projects that did.
+        encoded = {str(proj_id): encode_section(proj_items)
+                   for proj_id, proj_items in items.items()}
+        if search_built(search):
+            changed = {proj_id for proj_id in encoded.keys() | last_items.keys()
+                       if encoded.get(proj_id) != last_items.get(proj_id)}
+            state["search"] = update_search(
+                search, {proj_id: proj_items for proj_id, proj_items in items.items()
+                         if str(proj_id) in changed},
+                {proj_id: json.loads(last_items[proj_id])
+                 for proj_id in changed if proj_id in last_items})
+        else:
+            state["search"] = update_search(None, items)
+        with metrics.phase("write_cache") as fields:
+            data = encode_cache(dict(state, items=encoded,
+                                     lookups=dict(state["lookups"], index=index_json)))
+            fields["bytes"] = len(data)
+            write_atomic(os.path.expanduser(cache_file), data)
+        # Shell completion reads names and indexes from their own small file
+        with metrics.phase("write_completion"):
+            write_atomic(complete.index_file(cache_file),
+                         complete.encode(projects, items, labels))
+    return state
+
+
+@contextlib.contextmanager
+def cache_lock(cache_file="~/.config/todoist/cache"):
+    """ Holds an exclusive advisory lock on cache_file.lock so only one todo
+    writes the cache at a time. Readers never need it. """
+    with open(os.path.expanduser(cache_file) + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def write_atomic(path, data):
+    """ Writes data to a temporary file next to path and renames it over path,
+    so readers see either the old or the new file and never a partial one """
+    # Only writers need tempfile, keep it off the startup of readers and completion
+    import tempfile  # pylint: disable=import-outside-toplevel
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                     prefix="." + os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
 
 
 def load_state(cache_file="~/.config/todoist/cache"):
-    """ Load relevant todo information as json from a cache file """
-    with open(os.path.expanduser(cache_file), "r") as f:
-        data = json.load(f)
+    """ Load relevant todo information from a cache file """
+    data = read_cache(cache_file, STATE_SECTIONS)
+    if not set(LOOKUP_TABLES).issubset(data.get("lookups", {})):
+        data["lookups"] = build_lookups(data['projects'], data['items'], data['labels'])
     return data
 
 
+def migrate_cache(cache_file="~/.config/todoist/cache"):
+    """ Rewrites a plain json cache file in the sectioned format, returns
+    False if it already was """
+    with open(os.path.expanduser(cache_file), "rb") as f:
+        if f.read(len(CACHE_MAGIC)) == CACHE_MAGIC:
+            return False
+    data = load_state(cache_file)
+    resources = read_cache(cache_file, ["resources"]).get('resources')
+    save_state(data['projects'], data['items'], data['labels'], cache_file,
+               resources, data.get('sync_token'), data['lookups'])
+    return True
+
+
+def get_item(data, index):
+    """ Returns the project id, item id and item with index from state data,
+    or None if there is no such item """
+    try:
+        proj_id, item_id = data['lookups']['index'][str(index)]
+    except KeyError:
+        return None
+    return proj_id, item_id, lookup(lookup(data['items'], proj_id), item_id)
+
+
+def cache_max_age():
+    """ Returns how many seconds the cache is served before syncing again """
+    try:
+        return int(os.environ.get("TODOIST_CACHE_MAX_AGE", 60))
+    except ValueError:
+        return 60
+
+
+def cache_expired(cache_file="~/.config/todoist/cache", max_age=None):
+    """ Returns True if the cache file is missing or older than max_age seconds """
+    if max_age is None:
+        max_age = cache_max_age()
+    try:
+        mtime = os.path.getmtime(os.path.expanduser(cache_file))
+    except OSError:
+        return True
+    return time.time() - mtime > max_age
+
+
 def items_cache(cache_file="~/.config/todoist/cache"):
     """ Returns a list of items from the cache file """
-    return load_state(cache_file)['items']
+    return read_cache(cache_file, ["items"])['items']
 
 
 def projects_cache(cache_file="~/.config/todoist/cache"):
     """ Returns a list of projects from the cache file """
-    return load_state(cache_file)['projects']
+    return read_cache(cache_file, ["projects"])['projects']
 
 
 def labels_cache(cache_file="~/.config/todoist/cache"):
     """ Returns a list of labels from the cache file """
-    return load_state(cache_file)['labels']
+    return read_cache(cache_file, ["labels"])['labels']
+
+
+def build_state(api, previous=None):
+    """ Pulls todo items from api.state and returns them as a dict. Items in
+    previous, an earlier state, keep the index they had there. """
+    with metrics.phase("build_state") as fields:
+        projects = get_projects(api)
+        items = get_items(api)
+        labels = get_labels(api)
+        freed = {}
+        if previous is not None:
+            freed = assign_indexes(items, previous['lookups']['index'],
+                                   previous.get('freed_indexes'), getattr(api, 'temp_ids', {}))
+        lookups = build_lookups(projects, items, labels)
+        fields.update(projects=len(projects), labels=len(labels),
+                      items=len(lookups['index']))
+    return {"projects": projects, "items": items, "labels": labels, "lookups": lookups,
+            "freed_indexes": freed}
+
+
+def index_hold():
+    """ Returns how many seconds the index of a finished item is held before
+    a new item may reuse it """
+    try:
+        return int(os.environ.get("TODOIST_INDEX_HOLD", 86400))
+    except ValueError:
+        return 86400
+
+
+def assign_indexes(items, index, freed=None, temp_ids=None, now=None):
+    """ Gives items the index they have in index, the lookups index table of an
+    earlier state, so each item keeps its number across syncs. Temporary ids
+    in index are matched through temp_ids to the real ids they became.
+
+    The numbers of items that are gone are freed and held for index_hold()
+    seconds, so a number never refers to another item while scripts may
+    still use it. An item that comes back while its number is held gets it
+    back. Other new items take the lowest number held for longer, or else
+    the number after the highest in use or held. Returns the freed numbers
+    mapped to when they were freed and the id of the item that had them. """
+    temp_ids = temp_ids or {}
+    now = time.time() if now is None else now
+    freed = {int(i): entry for i, entry in (freed or {}).items()}
+    known = {str(temp_ids.get(item_id, item_id)): i
+             for item_id, i in table_indexes(index).items()}
+
+    kept = set()
+    new = []
+    for proj_items in items.values():
+        for item_id, item in proj_items.items():
+            if str(item_id) in known:
+                item['index'] = known[str(item_id)]
+                kept.add(str(item_id))
+            else:
+                new.append((str(item_id), item))
+
+    for item_id, i in known.items():
+        if item_id not in kept:
+            freed.setdefault(i, [now, item_id])
+
+    top = max([*known.values(), *freed], default=0)
+    held = {freed_id: i for i, (_, freed_id) in freed.items()}
+    for item_id, item in new:
+        if item_id in held:
+            item['index'] = held[item_id]
+            del freed[item['index']]
+
+    hold = index_hold()
+    reusable = sorted(i for i, (freed_at, _) in freed.items() if now - freed_at >= hold)
+    for item_id, item in new:
+        if item_id in held:
+            continue
+        if reusable:
+            item['index'] = reusable.pop(0)
+            del freed[item['index']]
+        else:
+            top += 1
+            item['index'] = top
+    return {str(i): entry for i, entry in freed.items()}
+
+
+def item_indexes(items):
+    """ Returns the id, as a string, of each item in items mapped to its index """
+    return {str(item_id): item['index']
+            for proj_items in items.values() for item_id, item in proj_items.items()}
+
+
+def table_indexes(index):
+    """ Returns the id, as a string, of each item in a lookups index table
+    mapped to its index """
+    return {str(item_id): int(i) for i, (_, item_id) in index.items()}
+
+
+class Snapshot:
+    """ The todo state for a single command. It is built from the api, or read
+    from the cache file when there is no api or with cached, the first time it
+    is used and is written back to the cache at most once.
+
+    Commands change the state as soon as they queue a change, see add_item and
+    the methods after it, and call reconcile once the commit has updated
+    api.state. Items keep their index throughout. """
+
+    def __init__(self, api=None, cache_file="~/.config/todoist/cache", cached=False):
+        self.api = api
+        self.cache_file = cache_file
+        self.cached = cached
+        self._data = None
+        self._saved = api is None or cached
+        self._from_cache = False
+        self._last = None
+        self._top = None
+        self._reusable = None
+
+    @property
+    def data(self):
+        """ The projects, items, labels and lookups for this command """
+        if self._data is None:
+            if self.api is None or self.cached:
+                try:
+                    self._data = load_state(self.cache_file)
+                    self._from_cache = True
+                except (OSError, ValueError):
+                    if self.api is None:
+                        raise
+                    self._data = build_state(self.api)
+            else:
+                self._data = build_state(self.api, self._previous())
+        return self._data
+
+    @property
+    def loaded(self):
+        """ True once the state has been built or read from the cache """
+        return self._data is not None
+
+    def _previous(self):
+        """ The last state, or the one in the cache, whose indexes a state
+        built from the api keeps """
+        if self._last is not None:
+            return self._last
+        try:
+            previous = read_cache(self.cache_file, ["lookups.index", "freed_indexes"])
+        except (OSError, ValueError):
+            return None
+        return previous if "index" in previous["lookups"] else None
+
+    def _changed(self):
+        """ Marks the state for saving """
+        self._saved = False
+
+    def _key(self, data, obj_id):
+        """ Returns the key data has, or should have, for obj_id. Keys are
+        strings once the state has been read from the cache. """
+        if obj_id in data:
+            return obj_id
+        if self._from_cache or str(obj_id) in data:
+            return str(obj_id)
+        return obj_id
+
+    def _next_index(self):
+        """ Returns the index for a new item as assign_indexes would give it,
+        the lowest number held for longer than index_hold() or else the
+        number after the highest in use or held """
+        data = self.data
+        freed = data.setdefault('freed_indexes', {})
+        if self._top is None:
+            now, hold = time.time(), index_hold()
+            self._top = max(map(int, [*data['lookups']['index'], *freed]), default=0)
+            self._reusable = sorted((int(i) for i, (freed_at, _) in freed.items()
+                                     if now - freed_at >= hold), reverse=True)
+        while self._reusable:
+            index = self._reusable.pop()
+            if freed.pop(str(index), None) is not None:
+                return index
+        self._top += 1
+        return self._top
+
+    def _free(self, item_id, item):
+        """ Holds the index of an item that is gone, as assign_indexes does """
+        self.data.setdefault('freed_indexes', {})[str(item['index'])] = \
+            [time.time(), str(item_id)]
+
+    def _index_item(self, proj_id, item_id, item):
+        """ Adds item to the index and label_items lookups """
+        lookups = self.data['lookups']
+        lookups['index'][str(item['index'])] = [proj_id, item_id]
+        for label_id in item['labels']:
+            lookups['label_items'].setdefault(str(label_id), []).append([proj_id, item_id])
+
+    def _unindex_item(self, item_id, item):
+        """ Removes item from the index and label_items lookups """
+        lookups = self.data['lookups']
+        lookups['index'].pop(str(item['index']), None)
+        for label_id in item['labels']:
+            entries = lookups['label_items'].get(str(label_id), [])
+            entries[:] = [entry for entry in entries if str(entry[1]) != str(item_id)]
+
+    def add_project(self, proj_id, name):
+        """ Adds a project created by a queued command """
+        projects = self.data['projects']
+        projects[self._key(projects, proj_id)] = {"name": name}
+        lookups = self.data['lookups']
+        lookups['project_names'][name.lower()] = proj_id
+        lookups['project_rank'] = project_ranks(projects)
+        self._changed()
+
+    def add_label(self, label_id, name):
+        """ Adds a label created by a queued command """
+        labels = self.data['labels']
+        labels[name] = label_id
+        lookups = self.data['lookups']
+        lookups['label_names'][str(label_id)] = name
+        lookups['label_rank'] = label_ranks(labels)
+        self._changed()
+
+    def add_item(self, proj_id, item_id, content, labels):
+        """ Adds an item queued to be added with the next index, see
+        _next_index, which it keeps once the commit gives it a real id, and
+        returns the index. Saving may still renumber it when another todo
+        has taken the number since, see index_of. """
+        items = self.data['items']
+        proj_items = items.setdefault(self._key(items, proj_id), {})
+        item = store.Task(content, labels, self._next_index())
+        proj_items[self._key(proj_items, item_id)] = item
+        self._index_item(proj_id, item_id, item)
+        self._changed()
+        return item['index']
+
+    def remove_item(self, proj_id, item_id):
+        """ Removes an item queued to be completed """
+        items = self.data['items']
+        proj_items = items.get(self._key(items, proj_id), {})
+        item = proj_items.pop(self._key(proj_items, item_id), None)
+        if item is not None:
+            self._unindex_item(item_id, item)
+            self._free(item_id, item)
+        self._changed()
+
+    def move_item(self, proj_id, item_id, new_proj_id):
+        """ Moves an item queued to be moved to new_proj_id, keeping its index """
+        items = self.data['items']
+        proj_items = items.get(self._key(items, proj_id), {})
+        key = self._key(proj_items, item_id)
+        if key in proj_items:
+            item = proj_items.pop(key)
+            items.setdefault(self._key(items, new_proj_id), {})[key] = item
+            self._unindex_item(item_id, item)
+            self._index_item(new_proj_id, item_id, item)
+        self._changed()
+
+    def remove_project(self, proj_id):
+        """ Removes a project queued to be archived along with its items """
+        projects = self.data['projects']
+        project = projects.pop(self._key(projects, proj_id), None)
+        proj_items = self.data['items'].pop(self._key(self.data['items'], proj_id), {})
+        for item_id, item in proj_items.items():
+            self._unindex_item(item_id, item)
+            self._free(item_id, item)
+        lookups = self.data['lookups']
+        if project is not None:
+            lookups['project_names'].pop(project['name'].lower(), None)
+        lookups['project_rank'] = project_ranks(projects)
+        self._changed()
+
+    def remove_label(self, name):
+        """ Removes a label queued to be deleted from the labels and its items """
+        labels = self.data['labels']
+        label_id = labels.pop(name, None)
+        for proj_items in self.data['items'].values():
+            for item in proj_items.values():
+                item['labels'] = [i for i in item['labels'] if str(i) != str(label_id)]
+        lookups = self.data['lookups']
+        lookups['label_items'].pop(str(label_id), None)
+        lookups['label_names'].pop(str(label_id), None)
+        lookups['label_rank'] = label_ranks(labels)
+        self._changed()
+
+    def reconcile(self):
+        """ Rebuilds the state from api.state once a commit has brought it up
+        to date, keeping the index of every item already in the state """
+        self._data = build_state(self.api, self.data)
+        self._top = self._reusable = None
+        self._saved = False
+        self._from_cache = False
+
+    def refresh(self):
+        """ Rebuilds the state from the api the next time it is used, call
+        after a sync has changed api.state """
+        if self._data is not None:
+            self._last = self.data
+        self._data = None
+        self._top = self._reusable = None
+        self._saved = self.api is None
+        self._from_cache = False
+
+    def save(self):
+        """ Writes the state to the cache file unless it is already there """
+        if self._saved:
+            return False
+        data = self.data
+        resources = {name: [getattr(obj, 'data', obj) for obj in self.api.state[name]]
+                     for name in RESOURCES}
+        state = save_state(data['projects'], data['items'], data['labels'], self.cache_file,
+                           resources, getattr(self.api, 'sync_token', None), data['lookups'])
+        # Saving renumbers new items against the cache as it is on disk
+        data['lookups'] = state['lookups']
+        data['freed_indexes'] = state['freed_indexes']
+        self._top = self._reusable = None
+        self._saved = True
+        return True
+
+    @contextlib.contextmanager
+    def search(self):
+        """ Yields a search index of the state, see update_search. While the
+        state is the one in the cache file the index is read from there a
+        section at a time instead of being built again. """
+        data = self.data
+        cached = None
+        if self._saved and (self._from_cache or not self.cached):
+            try:
+                cached = query.CachedSearch(self.cache_file)
+            except (OSError, ValueError):
+                pass
+        if cached is not None and search_built(cached):
+            try:
+                yield cached
+            finally:
+                cached.close()
+            return
+        if cached is not None:
+            cached.close()
+        yield update_search(None, data['items'])
+
+    def index_of(self, item_id):
+        """ Returns the index of the item with item_id, which may be the
+        temporary id it was queued with, or None if there is no such item """
+        item_id = getattr(self.api, 'temp_ids', {}).get(item_id, item_id)
+        for proj_items in self.data['items'].values():
+            key = self._key(proj_items, item_id)
+            if key in proj_items:
+                return proj_items[key]['index']
+        return None
+
+
+def snapshot(api, cache_file="~/.config/todoist/cache"):
+    """ Returns api if it is already a Snapshot, otherwise wraps it in one """
+    if isinstance(api, Snapshot):
+        return api
+    return Snapshot(api, cache_file)
 
 
 def sync(api, cache_file="~/.config/todoist/cache"):
-    """ Pulls todo items from api.state and returns them as a dict """
-    projects = get_projects(api)
-    items = get_items(api)
-    labels = get_labels(api)
-    save_state(projects, items, labels, cache_file)
-    return {"projects": projects, "items": items, "labels": labels}
+    """ Pulls todo items from api.state, saves them to the cache and returns
+    them as a dict """
+    snap = snapshot(api, cache_file)
+    snap.save()
+    return snap.data
+
+
+def get_state(api, cache_file="~/.config/todoist/cache"):
+    """ Returns the state of a Snapshot, syncs from api, or reads the cache
+    file when api is None """
+    if isinstance(api, Snapshot):
+        return api.data
+    if api is None:
+        return load_state(cache_file)
+    return sync(api, cache_file)
+
+
+def format_item(item, project_name, label_names):
+    """ Formats an item as a list row. label_names maps label ids, as strings,
+    to names so each row only looks at its own labels. """
+    i_labels = ' '.join(['@' + label_names[str(label_id)] for label_id in item['labels']
+                         if str(label_id) in label_names])
+    return f"[{item['index']}] {project_name} - {item['content']} {i_labels}"
+
+
+def item_key(data, sort, proj_id, item):
+    """ Returns the sort key of an item row, its index or with sort="project"
+    its project's name in natural order and then its index """
+    if sort == "project":
+        return data['lookups']['project_rank'][str(proj_id)], item['index']
+    return item['index']
+
+
+def sort_records(records, limit=None):
+    """ Sorts records on their first field, keeping only the first limit """
+    with metrics.phase("sort", limit=limit) as fields:
+        if limit is None:
+            records = sorted(records, key=operator.itemgetter(0))
+        else:
+            records = heapq.nsmallest(limit, records, key=operator.itemgetter(0))
+        fields["rows"] = len(records)
+    return records
+
+
+def cache_source(api, cache_file="~/.config/todoist/cache"):
+    """ Returns api and cache_file, or for a Snapshot without an api that has
+    not read its state yet None and its cache file, so the state can be read
+    from the cache a section at a time as for api None """
+    if isinstance(api, Snapshot) and api.api is None and not api.loaded:
+        return None, api.cache_file
+    return api, cache_file
+
+
+def get_sections(api, sections, cache_file="~/.config/todoist/cache"):
+    """ Returns the state as get_state does, but when it would be read from
+    the cache file, see cache_source, only the named sections are read.
+    Caches written before their lookups are read whole. """
+    api, cache_file = cache_source(api, cache_file)
+    if api is not None:
+        return get_state(api, cache_file)
+    data = read_cache(cache_file, sections)
+    tables = [name[len("lookups."):] for name in sections if name.startswith("lookups.")]
+    if not set(tables).issubset(data.get("lookups", {})):
+        return load_state(cache_file)
+    return data
 
 
-def list_projects(api, cache_file="~/.config/todoist/cache"):
-    """ output a list of projects """
-    data = sync(api, cache_file)
+def iter_projects(api, cache_file="~/.config/todoist/cache", limit=None):
+    """ Yields each project with its number of items, counted from the index
+    so no item has to be read """
+    data = get_sections(api, ["projects", "lookups.index", "lookups.project_rank"], cache_file)
     projects = data['projects']
-    items = data['items']
-    output = []
-    for proj_id in projects:
-        try:
-            count = len(items[proj_id])
-        except KeyError:
-            count = 0
-        output.append(f"{projects[proj_id]['name']} ({count})")
+    project_rank = data['lookups']['project_rank']
+    counts = collections.Counter(str(proj_id) for proj_id, _ in data['lookups']['index'].values())
 
-    return sorted(output, key=natural_sort)
+    records = ((project_rank[str(proj_id)], proj_id) for proj_id in projects)
+    for _, proj_id in sort_records(records, limit):
+        yield f"{projects[proj_id]['name']} ({counts[str(proj_id)]})"
 
 
-def list_labels(api, cache_file="~/.config/todoist/cache"):
-    """ outputs a list of labels """
-    labels = sync(api, cache_file)['labels']
-    items = sync(api, cache_file)['items']
-    output = []
+def list_projects(api, cache_file="~/.config/todoist/cache", limit=None):
+    """ output a list of projects """
+    return list(iter_projects(api, cache_file, limit))
 
-    for name, label_id in labels.items():
-        count = 0
-        for proj_id in items:
-            for item_id in items[proj_id]:
-                if label_id in items[proj_id][item_id]['labels']:
-                    count += 1
-        output.append(f"{name} ({count})")
 
-    return sorted(output, key=natural_sort)
+def iter_labels(api, cache_file="~/.config/todoist/cache", limit=None):
+    """ Yields each label with its number of items """
+    data = get_sections(api, ["labels", "lookups.label_items", "lookups.label_rank"], cache_file)
+    label_items = data['lookups']['label_items']
+    label_rank = data['lookups']['label_rank']
+
+    records = ((label_rank[str(label_id)], name, label_id)
+               for name, label_id in data['labels'].items())
+    for _, name, label_id in sort_records(records, limit):
+        count = len(label_items.get(str(label_id), []))
+        yield f"{name} ({count})"
+
+
+def list_labels(api, cache_file="~/.config/todoist/cache", limit=None):
+    """ outputs a list of labels """
+    return list(iter_labels(api, cache_file, limit))
 
 
 def list_cache_projects(cache_file="~/.config/todoist/cache"):
@@ -184,157 +1210,130 @@ def list_cache_projects(cache_file="~/.config/todoist/cache"):
     return sorted(output, key=natural_sort)
 
 
-def list_items_project(api, project, cache_file="~/.config/todoist/cache"):
-    """ Outputs a list of items associated with project """
-    data = sync(api, cache_file)
-    items = data['items']
-    projects = data['projects']
-    labels = data['labels']
+def match_projects(projects, project):
+    """ Returns the id of the project named project, or else the ids of every
+    project whose name contains it, ignoring case """
     proj_ids = []
-    output = []
 
     for proj_id in projects:
         if project.lower() == projects[proj_id]['name'].lower():
-            proj_ids = [proj_id]
-            break
+            return [proj_id]
 
         if project.lower() in projects[proj_id]['name'].lower():
             proj_ids.append(proj_id)
 
-    if not proj_ids:
-        return []
+    return proj_ids
 
-    for proj_id in proj_ids:
 
-        if proj_id not in items:
-            continue
-
-        for item_id in items[proj_id]:
-            temp_labels = []
-            try:
-                project_name = projects[proj_id]['name']
-                content = items[proj_id][item_id]['content']
-                index = items[proj_id][item_id]['index']
-
-                for key, value in labels.items():
-                    if value in items[proj_id][item_id]['labels']:
-                        temp_labels.append('@' + key)
-
-            except KeyError:
-                continue
+def match_labels(labels, label):
+    """ Returns the id of the label named label, or else the ids of every
+    label whose name contains it, ignoring case """
+    label_ids = []
 
-            i_labels = ' '.join(temp_labels)
+    for name in labels:
+        if label.lower() == name.lower():
+            return [labels[name]]
 
-            output.append(f"[{index}] {project_name} - {content} {i_labels}".rstrip(" "))
+        if label.lower() in name.lower():
+            label_ids.append(labels[name])
 
-    return sorted(output, key=natural_sort)
+    return label_ids
 
 
-def list_items_label(api, label, cache_file="~/.config/todoist/cache"):
-    """ Outputs a list of items associated with label """
-    data = sync(api, cache_file)
+def iter_items_project(api, project, cache_file="~/.config/todoist/cache", limit=None,
+                       sort="index"):
+    """ Yields the items associated with project sorted on sort """
+    data = get_state(api, cache_file)
     items = data['items']
     projects = data['projects']
-    labels = data['labels']
-    label_ids = []
-    output = []
+    label_names = data['lookups']['label_names']
+    proj_ids = match_projects(projects, project)
 
-    for name in labels:
-        if label.lower() == name.lower():
-            label_ids = [labels[name]]
-            break
+    records = ((item_key(data, sort, proj_id, item), proj_id, item)
+               for proj_id in proj_ids if proj_id in items
+               for item in items[proj_id].values())
 
-        if label.lower() in name.lower():
-            label_ids.append(labels[name])
+    for _, proj_id, item in sort_records(records, limit):
+        yield format_item(item, projects[proj_id]['name'], label_names).rstrip(" ")
 
-    if not label_ids:
-        return []
 
-    for label_id in label_ids:
-        for proj_id in items:
-            for item_id in items[proj_id]:
-                if label_id in items[proj_id][item_id]['labels']:
-                    temp_labels = []
+def list_items_project(api, project, cache_file="~/.config/todoist/cache", limit=None,
+                       sort="index"):
+    """ Outputs a list of items associated with project """
+    return list(iter_items_project(api, project, cache_file, limit, sort))
 
-                    try:
-                        project_name = projects[proj_id]['name']
-                        content = items[proj_id][item_id]['content']
-                        index = items[proj_id][item_id]['index']
 
-                        for item_label_id in items[proj_id][item_id]['labels']:
-                            name = ' '.join([l for l in labels if labels[l] == item_label_id])
-                            temp_labels.append('@' + name)
+def iter_items_label(api, label, cache_file="~/.config/todoist/cache", limit=None,
+                     sort="index"):
+    """ Yields the items associated with label sorted on sort """
+    data = get_state(api, cache_file)
+    items = data['items']
+    projects = data['projects']
+    labels = data['labels']
+    label_ids = match_labels(labels, label)
 
-                    except KeyError:
-                        continue
+    def records():
+        for label_id in label_ids:
+            for proj_id, item_id in data['lookups']['label_items'].get(str(label_id), []):
+                try:
+                    project = lookup(projects, proj_id)
+                    item = lookup(lookup(items, proj_id), item_id)
+                except KeyError:
+                    continue
+                yield item_key(data, sort, proj_id, item), project, item
 
-                    i_labels = ' '.join(temp_labels)
+    for _, project, item in sort_records(records(), limit):
+        yield format_item(item, project['name'], data['lookups']['label_names'])
 
-                    output.append(f"[{index}] {project_name} - {content} {i_labels}")
 
-    return sorted(output, key=natural_sort)
+def list_items_label(api, label, cache_file="~/.config/todoist/cache", limit=None,
+                     sort="index"):
+    """ Outputs a list of items associated with label """
+    return list(iter_items_label(api, label, cache_file, limit, sort))
 
 
-def list_items_all(api, cache_file="~/.config/todoist/cache"):
-    """ List all items """
-    data = sync(api, cache_file)
+def iter_items_all(api, cache_file="~/.config/todoist/cache", limit=None, sort="index"):
+    """ Yields all items sorted on sort """
+    data = get_state(api, cache_file)
     items = data['items']
-    labels = data['labels']
+    label_names = data['lookups']['label_names']
     projects = data['projects']
-    output = []
-    for proj_id in items:
-        for item_id in items[proj_id]:
-            temp_labels = []
-            try:
-                project_name = projects[proj_id]['name']
-                content = items[proj_id][item_id]['content']
-                index = items[proj_id][item_id]['index']
 
-                for key, value in labels.items():
-                    if value in items[proj_id][item_id]['labels']:
-                        temp_labels.append('@' + key)
+    records = ((item_key(data, sort, proj_id, item), proj_id, item)
+               for proj_id in items if proj_id in projects
+               for item in items[proj_id].values())
 
-            except KeyError:
-                continue
-
-            i_labels = ' '.join(temp_labels)
+    for _, proj_id, item in sort_records(records, limit):
+        yield format_item(item, projects[proj_id]['name'], label_names)
 
-            output.append(f"[{index}] {project_name} - {content} {i_labels}")
 
-    return sorted(output, key=natural_sort)
+def list_items_all(api, cache_file="~/.config/todoist/cache", limit=None, sort="index"):
+    """ List all items """
+    return list(iter_items_all(api, cache_file, limit, sort))
 
 
 def get_proj_id(api, project):
     """ Takes the api object and a project name and returns its id """
-    projects = sync(api)['projects']
-
-    for proj_id in projects:
-        if projects[proj_id]['name'].lower() == project.lower():
-            project_id = proj_id
-    try:
-        return project_id
-    except NameError:
-        return None
+    project_names = get_state(api)['lookups']['project_names']
+    return project_names.get(project.lower())
 
 
 def get_label_id(api, label):
     """ Takes the api object and a label name and returns its id """
-    labels = sync(api)['labels']
-
-    try:
-        return labels[label]
-    except NameError:
-        return None
+    return get_state(api)['labels'].get(label)
 
 
 def create_project(api, name):
     """ Takes the api and the name of a project and creates it and returns
     the new project's id """
-    api.projects.add(name)
-    api.commit()
+    snap = snapshot(api)
+    project = snap.api.projects.add(name)
+    snap.add_project(project['id'], name)
+    schedule.commit(snap.api)
+    snap.reconcile()
     print("Created Project: {}".format(name))
 
-    return get_proj_id(api, name)
+    return project['id']
 
 
 def archive_project(api):
@@ -344,9 +1343,12 @@ def archive_project(api):
         exit(0)
 
     name = sys.argv[2]
-    proj_id = get_proj_id(api, name)
-    api.projects.archive(proj_id)
-    api.commit()
+    snap = snapshot(api)
+    proj_id = get_proj_id(snap, name)
+    snap.api.projects.archive(proj_id)
+    snap.remove_project(proj_id)
+    schedule.commit(snap.api)
+    snap.reconcile()
     print("Archived Project: {}".format(name))
     return True
 
@@ -364,105 +1366,226 @@ def delete(api):
 
 def delete_label(api, name):
     """ Delete label """
-    label_id = get_label_id(api, name)
-    api.labels.delete(label_id)
-    api.commit()
+    snap = snapshot(api)
+    label_id = get_label_id(snap, name)
+    snap.api.labels.delete(label_id)
+    snap.remove_label(name)
+    schedule.commit(snap.api)
+    snap.reconcile()
     print("Deleted Label: {}".format(name))
 
 
 def create_label(api, name):
     """ Takes the api and the name of a project and creates it and returns
     the new project's id """
-    api.labels.add(name)
-    api.commit()
+    snap = snapshot(api)
+    label = snap.api.labels.add(name)
+    snap.add_label(label['id'], name)
+    schedule.commit(snap.api)
+    snap.reconcile()
     print("Created Label: {}".format(name))
 
-    return get_label_id(api, name)
+    return label['id']
+
+
+def queue_add(snap, project_name, words, project_ids, label_ids):
+    """ Queues a task along with any project or labels it needs without
+    committing and returns the task's temporary id. project_ids maps
+    lowercased project names to ids and label_ids maps label names to ids,
+    both gain the temporary ids of anything created so later tasks can
+    refer to them. """
+    labels = [t.strip('@') for t in words if t.startswith('@')]
+    task = ' '.join([w for w in words if not w.startswith('@')])
+
+    project_id = project_ids.get(project_name.lower())
+    if project_id is None:
+        project_id = snap.api.projects.add(project_name)['id']
+        project_ids[project_name.lower()] = project_id
+        snap.add_project(project_id, project_name)
+        print("Created Project: {}".format(project_name))
+
+    item_label_ids = []
+    for label in labels:
+        if label not in label_ids:
+            label_ids[label] = snap.api.labels.add(label)['id']
+            snap.add_label(label_ids[label], label)
+            print("Created Label: {}".format(label))
+        item_label_ids.append(label_ids[label])
+
+    if item_label_ids:
+        item = snap.api.items.add(task, project_id, labels=item_label_ids)
+    else:
+        item = snap.api.items.add(task, project_id)
+    snap.add_item(project_id, item['id'], task, item_label_ids)
+    return item['id']
 
 
 def add_item(api):
     """ Takes a todoist api object, the project name, and the task and adds
     the task to todoist """
 
-    label_list = get_labels(api)
-
     if len(sys.argv) < 4:
         print_help()
         exit(0)
 
-    project_name = sys.argv[2]
-    labels = [t for t in sys.argv[3:] if t.startswith('@')]
-    task = ' '.join([w for w in sys.argv[3:] if w not in labels])
-    labels = [t.strip('@') for t in labels]
+    snap = snapshot(api)
+    item_id = queue_add(snap, sys.argv[2], sys.argv[3:],
+                        dict(snap.data['lookups']['project_names']), dict(snap.data['labels']))
+    schedule.commit(snap.api)
+    snap.reconcile()
+    # The index is only settled once the cache has been written
+    snap.save()
+    print(f"Task added as [{snap.index_of(item_id)}]")
+
+
+def confirmed():
+    """ Removes --yes from the command line and returns whether it was there """
+    if "--yes" not in sys.argv:
+        return False
+    sys.argv.remove("--yes")
+    return True
 
-    project_id = get_proj_id(api, project_name)
-    label_ids = []
-    if not project_id:
-        project_id = create_project(api, project_name)
-    if labels != []:
-        for label in labels:
-            if label not in label_list:
-                label_ids.append(create_label(api, label))
-            else:
-                label_ids.append(label_list[label])
 
-        api.items.add(task, project_id, labels=label_ids)
-    else:
-        api.items.add(task, project_id)
-    api.commit()
-    print("Task added")
+def select_items(snap, selection, yes=False):
+    """ Returns the items of snap's state selected by selection, see
+    query.select, or prints the reason and exits if there are none """
+    try:
+        with snap.search() as search:
+            selected = query.select(selection, snap.data, yes, search)
+    except query.QueryError as e:
+        print(f"Error: {e}.")
+        exit(1)
+    if not selected:
+        print(f"Error: nothing matches {selection}.")
+        exit(1)
+    return selected
 
 
 def done(api):
-    """ Takes a todoist api object, the project name, and the task and adds
-    the task to todoist """
+    """ Marks the items selected by the rest of the command line as done,
+    with a single command and commit however many there are """
 
-    if len(sys.argv) != 3:
+    yes = confirmed()
+    if len(sys.argv) < 3:
         print_help()
         exit(0)
 
-    index = int(sys.argv[2])
-    items = items_cache()
+    snap = snapshot(api)
+    selected = select_items(snap, ' '.join(sys.argv[2:]), yes)
 
-    for proj_id in items:
-        for item_id in items[proj_id]:
-            if items[proj_id][item_id]['index'] == index:
-                selected_id = item_id
-                content = items[proj_id][item_id]['content']
-                break
-
-    api.items.complete([selected_id])
-    api.commit()
-    print(f"Marking [{index}] {content} as done")
+    snap.api.items.complete([item_id for _, _, item_id, _ in selected])
+    for _, proj_id, item_id, _ in selected:
+        snap.remove_item(proj_id, item_id)
+    schedule.commit(snap.api)
+    snap.reconcile()
+    for index, _, _, item in selected:
+        print(f"Marking [{index}] {item['content']} as done")
 
     return True
 
 
 def move(api):
-    """ Move item to another project """
+    """ Moves the items selected by the first argument to the project named by
+    the rest, with a single command and commit however many there are """
 
+    yes = confirmed()
     if len(sys.argv) < 4:
         print_help()
         exit(0)
 
-    index = int(sys.argv[2])
+    snap = snapshot(api)
     new_proj = ' '.join(sys.argv[3:])
-    items = items_cache()
-    new_proj_id = get_proj_id(api, new_proj)
+    new_proj_id = get_proj_id(snap, new_proj)
 
     if new_proj_id is None:
         print(f"Error: {new_proj} does not exist.")
         exit(1)
 
-    for proj_id in items:
-        for item_id in items[proj_id]:
-            if items[proj_id][item_id]['index'] == index:
-                content = items[proj_id][item_id]['content']
-                project_items = {proj_id: [item_id]}
-                break
+    selected = select_items(snap, sys.argv[2], yes)
+    project_items = {}
+    for _, proj_id, item_id, _ in selected:
+        project_items.setdefault(proj_id, []).append(item_id)
 
-    api.items.move(project_items, new_proj_id)
-    api.commit()
-    print(f"Moved [{index}] {content} to {new_proj}")
+    snap.api.items.move(project_items, new_proj_id)
+    for _, proj_id, item_id, _ in selected:
+        snap.move_item(proj_id, item_id, new_proj_id)
+    schedule.commit(snap.api)
+    snap.reconcile()
+    for index, _, _, item in selected:
+        print(f"Moved [{index}] {item['content']} to {new_proj}")
 
     return True
+
+
+# Most commands the sync api accepts in one request
+BATCH_SIZE = 100
+
+
+def commit_batch(snap, *id_maps):
+    """ Commits the queued commands and swaps temporary ids in id_maps for the
+    real ids the api assigned """
+    schedule.commit(snap.api)
+    temp_ids = getattr(snap.api, 'temp_ids', {})
+    for id_map in id_maps:
+        for name, obj_id in id_map.items():
+            id_map[name] = temp_ids.get(obj_id, obj_id)
+
+
+def batch(api, lines):
+    """ Queues add, done, move and archive commands, one per line written as
+    they would be on the command line, and commits them in as few round trips
+    as possible. Returns the number of commands queued. """
+    snap = snapshot(api)
+    project_ids = dict(snap.data['lookups']['project_names'])
+    label_ids = dict(snap.data['labels'])
+    count = 0
+
+    for line_number, line in enumerate(lines, 1):
+        args = shlex.split(line)
+        if not args or args[0].startswith('#'):
+            continue
+
+        action = args[0].lower()
+        # Commands referring to a temporary id must share its commit
+        needed = 1
+        if action == 'add' and len(args) >= 3:
+            needed += args[1].lower() not in project_ids
+            needed += len({w.strip('@') for w in args[2:] if w.startswith('@')} - set(label_ids))
+        if len(snap.api.queue) + needed > BATCH_SIZE:
+            commit_batch(snap, project_ids, label_ids)
+
+        if action == 'add' and len(args) >= 3:
+            queue_add(snap, args[1], args[2:], project_ids, label_ids)
+        elif action == 'done' and len(args) == 2 and args[1].isdigit():
+            found = get_item(snap.data, args[1])
+            if found is None:
+                print(f"Error: line {line_number}: [{args[1]}] does not exist.")
+                continue
+            snap.api.items.complete([found[1]])
+            snap.remove_item(found[0], found[1])
+        elif action == 'move' and len(args) >= 3 and args[1].isdigit():
+            found = get_item(snap.data, args[1])
+            new_proj = ' '.join(args[2:])
+            new_proj_id = project_ids.get(new_proj.lower())
+            if found is None or new_proj_id is None:
+                print(f"Error: line {line_number}: cannot move [{args[1]}] to {new_proj}.")
+                continue
+            snap.api.items.move({found[0]: [found[1]]}, new_proj_id)
+            snap.move_item(found[0], found[1], new_proj_id)
+        elif action == 'archive' and len(args) == 2:
+            proj_id = project_ids.get(args[1].lower())
+            if proj_id is None:
+                print(f"Error: line {line_number}: {args[1]} does not exist.")
+                continue
+            snap.api.projects.archive(proj_id)
+            snap.remove_project(proj_id)
+        else:
+            print(f"Error: line {line_number}: cannot parse {line.strip()}")
+            continue
+
+        count += 1
+
+    commit_batch(snap, project_ids, label_ids)
+    snap.reconcile()
+    print(f"Queued {count} commands")
+    return count
@@ -0,0 +1,85 @@
+""" Syncs several todoist accounts at once and lists them together. Each
+account is a file in ~/.config/todoist/accounts holding its api key and is
+cached in a file next to it named <account>.cache. """
+
+import itertools
+import os
+import todoistcli
+
+ACCOUNTS = "~/.config/todoist/accounts"
+
+
+class AccountError(KeyError):
+    """ Raised for accounts that are not configured """
+
+
+def load_accounts(accounts_dir=ACCOUNTS):
+    """ Returns each configured account's name mapped to its api key file and
+    cache file, sorted by name """
+    path = os.path.expanduser(accounts_dir)
+    try:
+        names = sorted(name for name in os.listdir(path)
+                       if not name.startswith(".") and "." not in name)
+    except FileNotFoundError:
+        return {}
+    return {name: (os.path.join(path, name), os.path.join(path, name + ".cache"))
+            for name in names}
+
+
+def account(name, accounts_dir=ACCOUNTS):
+    """ Returns the api key file and cache file of the account called name """
+    try:
+        return load_accounts(accounts_dir)[name]
+    except KeyError:
+        raise AccountError(f"no account named {name} in {accounts_dir}") from None
+
+
+def make_session(size):
+    """ Returns a requests session keeping up to size connections open, so
+    accounts syncing at the same time do not wait on each other for one """
+    import requests  # pylint: disable=import-outside-toplevel
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def connect_all(accounts, api_endpoint="https://todoist.com"):
+    """ Syncs every account in accounts, as returned by load_accounts, at the
+    same time and saves their caches. Returns each account's Snapshot. """
+    import concurrent.futures  # pylint: disable=import-outside-toplevel
+
+    if not accounts:
+        return {}
+    session = make_session(len(accounts))
+
+    def connect(name):
+        api_key_file, cache_file = accounts[name]
+        snap = todoistcli.Snapshot(
+            todoistcli.connect(cache_file, api_key_file, session, api_endpoint), cache_file)
+        snap.save()
+        return snap
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(accounts)) as pool:
+        snaps = dict(zip(accounts, pool.map(connect, accounts)))
+    return snaps
+
+
+def snapshots(accounts, refresh=False, max_age=None, api_endpoint="https://todoist.com"):
+    """ Returns each account's Snapshot. Accounts whose cache is expired, or
+    all of them with refresh, are synced together first, the rest are read
+    from their caches. """
+    stale = {name: files for name, files in accounts.items()
+             if refresh or todoistcli.cache_expired(files[1], max_age)}
+    synced = connect_all(stale, api_endpoint)
+    return {name: synced[name] if name in synced else todoistcli.Snapshot(None, files[1])
+            for name, files in accounts.items()}
+
+
+def iter_merged(snaps, lines, limit=None):
+    """ Yields lines(snap) for each account's Snapshot, each line tagged with
+    its account, stopping after limit lines """
+    merged = (f"{name}: {line}" for name, snap in snaps.items() for line in lines(snap))
+    return itertools.islice(merged, limit)
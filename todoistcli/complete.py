@@ -0,0 +1,124 @@
+""" Completes todo command lines for the shell from the completion index, a
+small file save_state writes next to the cache. It only reads that file, so
+completing never syncs, reads the cache or loads the todoist sdk.
+
+The index holds one sorted line per project, label and item,
+    p<tab>lowercased name<tab>name
+    l<tab>lowercased name<tab>name
+    i<tab>index<tab>index<tab>content
+so the entries starting with a prefix are found by bisecting. """
+
+import bisect
+import os
+from todoistcli import accounts
+
+ACTIONS = ("add", "archive", "batch", "cache", "daemon", "delete", "done", "export", "labels",
+           "list", "move", "projects", "query", "search", "sync", "watch")
+OPTIONS = ("--account", "--accounts", "--cprofile", "--format", "--label", "--limit",
+           "--profile", "--project", "--refresh", "--sort", "--yes")
+# Options followed by a value
+VALUE_OPTIONS = ("--account", "--cprofile", "--format", "--label", "--limit", "--project",
+                 "--sort")
+# What completes the value of an option, like wanted
+OPTION_VALUES = {"--format": ("ndjson", "csv"), "--label": "l", "--project": "p",
+                 "--sort": ("project",)}
+
+
+def index_file(cache_file="~/.config/todoist/cache"):
+    """ Returns the path of the completion index of cache_file """
+    return os.path.expanduser(cache_file) + ".complete"
+
+
+def encode(projects, items, labels):
+    """ Returns the completion index of a state as bytes """
+    lines = [f"p\t{clean(project['name']).lower()}\t{clean(project['name'])}"
+             for project in projects.values()]
+    lines += [f"l\t{clean(name).lower()}\t{clean(name)}" for name in labels]
+    for proj_items in items.values():
+        for item in proj_items.values():
+            index = item['index']
+            lines.append(f"i\t{index}\t{index}\t{clean(item['content'])}")
+    lines.sort()
+    return ("\n".join(lines) + "\n").encode()
+
+
+def clean(text):
+    """ Returns text on one line without tabs """
+    return text if text.isprintable() else " ".join(text.split())
+
+
+def read(path):
+    """ Returns the sorted lines of a completion index, or no lines if there
+    is no index yet """
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read().splitlines()
+    except OSError:
+        return []
+
+
+def lookup(lines, kind, prefix):
+    """ Returns the value and description of each entry of kind whose key
+    starts with prefix, ignoring case """
+    start = f"{kind}\t{prefix.lower()}"
+    matches = []
+    for i in range(bisect.bisect_left(lines, start), len(lines)):
+        if not lines[i].startswith(start):
+            break
+        matches.append(lines[i].split("\t")[2:])
+    if kind == "i":
+        matches.sort(key=lambda fields: int(fields[0]))
+    return matches
+
+
+def candidates(words, cache_file="~/.config/todoist/cache"):
+    """ Returns what the last of words, the words after todo, may complete to,
+    each as a list of its value and perhaps a description """
+    *before, word = words or [""]
+    if before and before[-1] == "--account":
+        return [[name] for name in accounts.load_accounts() if name.startswith(word)]
+    if word.startswith("-") and not (before and before[-1] in VALUE_OPTIONS):
+        return [[option] for option in OPTIONS if option.startswith(word)]
+
+    args = [arg for i, arg in enumerate(before)
+            if not arg.startswith("--") and not (i and before[i - 1] in VALUE_OPTIONS)]
+    if "--account" in before:
+        name = before[before.index("--account") + 1]
+        cache_file = accounts.load_accounts().get(name, (None, cache_file))[1]
+
+    completes = OPTION_VALUES.get(before[-1]) if before and before[-1] in VALUE_OPTIONS \
+        else wanted(args)
+    if isinstance(completes, tuple):
+        return [[keyword] for keyword in completes if keyword.startswith(word)]
+    if completes is None:
+        return []
+    return lookup(read(index_file(cache_file)), completes, word)
+
+
+def wanted(args):
+    """ Returns what completes the word after args: "p" for project names,
+    "l" for label names, "i" for item indexes, a tuple of keywords or None """
+    if not args:
+        return ACTIONS
+    action, count = args[0], len(args)
+    if action in ("add", "archive") and count == 1:
+        return "p"
+    if action in ("list", "watch"):
+        return ("label", "project") if count == 1 else {"label": "l", "project": "p"}.get(args[1])
+    if action == "cache" and count == 1:
+        return ("migrate", "projects", "requests")
+    if action == "delete":
+        return ("label",) if count == 1 else "l"
+    if action == "done":
+        return "i"
+    if action == "move":
+        return "i" if count == 1 else "p"
+    return None
+
+
+def main(words):
+    """ Prints the completions of words, one per line with any description
+    after a tab """
+    for fields in candidates(words):
+        print("\t".join(fields))
+    return 0
@@ -0,0 +1,118 @@
+""" Keeps the todoist state in memory and answers todo commands over a unix socket """
+
+import json
+import os
+import socket
+
+SOCKET = "~/.config/todoist/daemon.sock"
+
+
+def request(argv, refresh=False, socket_path=SOCKET):
+    """ Sends argv to a running daemon and returns its output and exit status,
+    or None when no daemon is listening """
+    path = os.path.expanduser(socket_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    # Once connected the command may have run, so never fall back after this
+    try:
+        with sock:
+            sock.sendall(json.dumps({"argv": argv, "refresh": refresh}).encode())
+            sock.shutdown(socket.SHUT_WR)
+            reply = json.loads(sock.makefile("rb").read())
+        return reply["output"], reply["status"]
+    except (OSError, ValueError, KeyError) as e:
+        return f"Error: no reply from the todo daemon: {e}\n", 1
+
+
+def run(dispatch, argv):
+    """ Runs dispatch(argv) and returns what it printed and its exit status """
+    import contextlib  # pylint: disable=import-outside-toplevel
+    import io  # pylint: disable=import-outside-toplevel
+
+    output = io.StringIO()
+    status = 0
+    with contextlib.redirect_stdout(output):
+        try:
+            dispatch(argv)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 0
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"Error: {e}")
+            status = 1
+    return output.getvalue(), status
+
+
+def listening(socket_path=SOCKET):
+    """ Returns True if a daemon is accepting connections on socket_path """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(os.path.expanduser(socket_path))
+        except OSError:
+            return False
+    return True
+
+
+def make_server(dispatch, sync, lock, socket_path=SOCKET, refresh=None):
+    """ Returns a server answering todo commands on socket_path by calling
+    dispatch(argv), holding lock while each command runs. Commands sent with
+    refresh call refresh(), or sync() without it, first. """
+    # Only the daemon needs these, keep them off the client's startup path
+    import socketserver  # pylint: disable=import-outside-toplevel
+
+    path = os.path.expanduser(socket_path)
+    if os.path.exists(path):
+        os.unlink(path)
+
+    class Handler(socketserver.StreamRequestHandler):
+        """ Runs one command sent by request() """
+        def handle(self):
+            message = json.loads(self.rfile.read())
+            with lock:
+                if message.get("refresh"):
+                    (refresh or sync)()
+                output, status = run(dispatch, message["argv"])
+            self.wfile.write(json.dumps({"output": output, "status": status}).encode())
+
+    server = socketserver.UnixStreamServer(path, Handler)
+    os.chmod(path, 0o600)
+    return server
+
+
+def serve(dispatch, sync, interval, socket_path=SOCKET, refresh=None):
+    """ Answers todo commands on socket_path by calling dispatch(argv) and
+    calls sync() every interval seconds until interrupted, see make_server
+    for refresh """
+    import threading  # pylint: disable=import-outside-toplevel
+
+    if listening(socket_path):
+        print(f"Error: a todo daemon is already listening on {socket_path}")
+        return False
+
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def sync_loop():
+        while not stop.wait(interval):
+            with lock:
+                try:
+                    sync()
+                except (OSError, ValueError) as e:
+                    print(f"Error: sync failed: {e}")
+
+    server = make_server(dispatch, sync, lock, socket_path, refresh)
+    thread = threading.Thread(target=sync_loop, daemon=True)
+    thread.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        os.unlink(os.path.expanduser(socket_path))
+    return True
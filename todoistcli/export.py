@@ -0,0 +1,78 @@
+""" Exports the cached items as json lines or csv. Items are read one at a
+time from the raw resources in the cache, with every field todoist sent, so
+memory stays the same however many there are. Only project and label names
+are held to join them. """
+
+import csv
+import io
+import json
+import todoistcli
+
+FORMATS = ("ndjson", "csv")
+
+# csv columns, the fields todoist sends for items with the project name, the
+# label names and due dates in between
+CSV_FIELDS = ("id", "project_id", "project", "section_id", "parent_id", "content",
+              "label_names", "priority", "due_date", "due_string", "date_added",
+              "date_completed", "responsible_uid", "checked")
+
+
+def iter_records(cache_file="~/.config/todoist/cache", project=None, label=None):
+    """ Yields each item list would show, or only those in projects matching
+    project or with labels matching label, as a dict of its fields with the
+    name of its project as project and the names of its labels as label_names """
+    data = todoistcli.read_cache(cache_file, ["projects", "labels"])
+    projects = {str(proj_id): proj['name'] for proj_id, proj in data['projects'].items()}
+    label_names = {str(label_id): name for name, label_id in data['labels'].items()}
+    proj_ids = None if project is None else \
+        {str(proj_id) for proj_id in todoistcli.match_projects(data['projects'], project)}
+    label_ids = None if label is None else \
+        {str(label_id) for label_id in todoistcli.match_labels(data['labels'], label)}
+
+    for item in todoistcli.iter_array(cache_file, "resources.items"):
+        if item.get('is_deleted') or item.get('in_history') or item.get('is_archived'):
+            continue
+        proj_id = str(item['project_id'])
+        if proj_id not in projects or proj_ids is not None and proj_id not in proj_ids:
+            continue
+        labels = [str(label_id) for label_id in item.get('labels', [])]
+        if label_ids is not None and label_ids.isdisjoint(labels):
+            continue
+        item['project'] = projects[proj_id]
+        item['label_names'] = [label_names[i] for i in labels if i in label_names]
+        yield item
+
+
+def ndjson_lines(records):
+    """ Yields each record as a line of json """
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+
+
+def csv_lines(records):
+    """ Yields a header and then each record as a line of csv """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="")
+    writer.writerow(CSV_FIELDS)
+    yield buffer.getvalue()
+    for record in records:
+        buffer.seek(0)
+        buffer.truncate()
+        due = record.get('due') or {}
+        row = {**record, "label_names": ",".join(record['label_names']),
+               "due_date": due.get('date'), "due_string": due.get('string')}
+        writer.writerow([row.get(field, "") for field in CSV_FIELDS])
+        yield buffer.getvalue()
+
+
+def iter_export(cache_file="~/.config/todoist/cache", fmt="ndjson", project=None,
+                label=None):
+    """ Yields the lines of an export in fmt, one of FORMATS. Raises ValueError
+    for caches holding no raw items, which are only saved with a sync token,
+    rather than export nothing. """
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format {fmt}, use {' or '.join(FORMATS)}")
+    if not todoistcli.read_cache(cache_file, ["sync_token"]).get('sync_token'):
+        raise ValueError("the cache holds no items to export, run todo sync first")
+    lines = ndjson_lines if fmt == "ndjson" else csv_lines
+    return lines(iter_records(cache_file, project, label))
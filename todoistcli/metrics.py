@@ -0,0 +1,78 @@
+""" Times the phases of a todo command, with their sizes and counts, and writes
+each one as a json line. Profiling is off unless enable() is called, as todo
+does for --profile or TODOIST_PROFILE, and then costs almost nothing. """
+
+import contextlib
+import json
+import os
+import sys
+import time
+
+PROFILE_ENV = "TODOIST_PROFILE"
+CPROFILE_ENV = "TODOIST_CPROFILE"
+
+# The file json lines are written to, None while profiling is off
+SINK = None
+STARTED = time.perf_counter()
+
+
+def enable(target="-"):
+    """ Starts writing json lines to target, a file appended to or - for stderr """
+    global SINK  # pylint: disable=global-statement
+    if target in ("-", "1", ""):
+        SINK = sys.stderr
+    else:
+        SINK = open(os.path.expanduser(target), "a", buffering=1)
+
+
+def enabled():
+    """ Returns True while profiling, so callers only measure sizes then """
+    return SINK is not None
+
+
+def emit(name, **fields):
+    """ Writes one json line for the phase or event name """
+    if SINK is None:
+        return
+    SINK.write(json.dumps({"phase": name, **fields}, default=str) + "\n")
+    SINK.flush()
+
+
+@contextlib.contextmanager
+def phase(name, **fields):
+    """ Times the block and emits it with fields, which the block may add to
+    through the dict it is given """
+    if SINK is None:
+        yield fields
+        return
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        emit(name, ms=round((time.perf_counter() - start) * 1000, 3), **fields)
+
+
+def http_hook(response, *args, **kwargs):  # pylint: disable=unused-argument
+    """ A requests response hook emitting each request's size and latency """
+    emit("http", url=response.request.path_url, status=response.status_code,
+         bytes=len(response.content), ms=round(response.elapsed.total_seconds() * 1000, 3))
+
+
+def total(action):
+    """ Emits the time since this module was imported and the cpu time the
+    process has used, which includes starting the interpreter """
+    emit("total", action=action, ms=round((time.perf_counter() - STARTED) * 1000, 3),
+         cpu_ms=round(time.process_time() * 1000, 3))
+
+
+def start_cprofile(path):
+    """ Profiles the rest of the process and dumps the stats to path at exit,
+    for python -m pstats or snakeviz """
+    import atexit  # pylint: disable=import-outside-toplevel
+    import cProfile  # pylint: disable=import-outside-toplevel
+
+    profiler = cProfile.Profile()
+    atexit.register(profiler.dump_stats, os.path.expanduser(path))
+    atexit.register(profiler.disable)
+    profiler.enable()
+    return profiler
@@ -0,0 +1,337 @@
+""" Searches cached items with queries such as
+    fix and (project:work or @urgent) and not label:someday
+
+Words match whole words in an item's content, word* matches words starting
+with word. project:name or #name match items in projects matching name and
+label:name or @name match items with labels matching name, in the same way
+list project and list label match them. Terms next to each other must all
+match, or and not combine them and parentheses group them.
+
+Commands that change several items take a selection, either indexes and
+ranges such as 3-40,52 or a query. A query matching items by what they lack,
+such as not @someday, or matching more than one item only selects once
+confirmed. """
+
+import json
+import mmap
+import os
+import re
+import shlex
+import todoistcli
+
+# Sections of the cache every query reads, the search index is read a
+# section at a time as the query needs it and items per listed project
+SECTIONS = ["projects", "labels", "lookups.label_names", "lookups.project_rank"]
+
+# Indexes and ranges of indexes separated by commas or spaces
+INDEXES = re.compile(r"\s*\d+(-\d+)?([,\s]+\d+(-\d+)?)*\s*")
+# Selections made of what indexes are made of, which are never queries
+INDEX_LIKE = re.compile(r"[\d,\s-]+")
+
+
+class QueryError(ValueError):
+    """ Raised for queries that cannot be parsed """
+
+
+def split(query):
+    """ Splits a query into words and parentheses """
+    lexer = shlex.shlex(query, posix=True, punctuation_chars="()")
+    lexer.whitespace_split = True
+    lexer.commenters = ""
+    try:
+        return list(lexer)
+    except ValueError as e:
+        raise QueryError(str(e))
+
+
+def parse(query):
+    """ Parses a query into a tree of ("or", a, b), ("and", a, b), ("not", a),
+    ("word", word), ("prefix", word), ("project", name) and ("label", name) """
+    tokens = split(query)
+    if not tokens:
+        raise QueryError("empty query")
+    node, pos = parse_or(tokens, 0)
+    if pos != len(tokens):
+        raise QueryError(f"unexpected {tokens[pos]}")
+    return node
+
+
+def parse_or(tokens, pos):
+    """ Parses terms joined by or """
+    node, pos = parse_and(tokens, pos)
+    while pos < len(tokens) and tokens[pos].lower() == "or":
+        right, pos = parse_and(tokens, pos + 1)
+        node = ("or", node, right)
+    return node, pos
+
+
+def parse_and(tokens, pos):
+    """ Parses terms next to each other or joined by and """
+    node, pos = parse_not(tokens, pos)
+    while pos < len(tokens) and tokens[pos].lower() != "or" and tokens[pos] != ")":
+        if tokens[pos].lower() == "and":
+            pos += 1
+        right, pos = parse_not(tokens, pos)
+        node = ("and", node, right)
+    return node, pos
+
+
+def parse_not(tokens, pos):
+    """ Parses a term, negated by not or a leading - """
+    if pos >= len(tokens):
+        raise QueryError("query ends early")
+    token = tokens[pos]
+    if token.lower() == "not":
+        node, pos = parse_not(tokens, pos + 1)
+        return ("not", node), pos
+    if token == "(":
+        node, pos = parse_or(tokens, pos + 1)
+        if pos >= len(tokens) or tokens[pos] != ")":
+            raise QueryError("missing )")
+        return node, pos + 1
+    if token == ")" or token.lower() in ("and", "or"):
+        raise QueryError(f"unexpected {token}")
+    if token.startswith("-") and len(token) > 1:
+        return ("not", parse_term(token[1:])), pos + 1
+    return parse_term(token), pos + 1
+
+
+def parse_term(token):
+    """ Parses a single word, project or label term """
+    lowered = token.lower()
+    for prefix, kind in (("project:", "project"), ("#", "project"),
+                         ("label:", "label"), ("@", "label")):
+        if lowered.startswith(prefix) and len(token) > len(prefix):
+            return (kind, token[len(prefix):])
+    if token.endswith("*") and len(token) > 1:
+        return ("prefix", lowered[:-1])
+    words = todoistcli.tokenize(token)
+    if not words:
+        raise QueryError(f"nothing to search for in {token}")
+    node = ("word", words[0])
+    for word in words[1:]:
+        node = ("and", node, ("word", word))
+    return node
+
+
+class CachedSearch:
+    """ The search index of a sectioned cache file, see update_search, each
+    section decoded the first time it is asked for. The file stays open
+    until close so every section comes from the same write of the cache. """
+
+    def __init__(self, cache_file):
+        self.file = open(os.path.expanduser(cache_file), "rb")
+        self.mm = None
+        self.sections = {}
+        self.read = {}
+        if self.file.read(len(todoistcli.CACHE_MAGIC)) == todoistcli.CACHE_MAGIC:
+            try:
+                self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.sections = {name[len("search."):]: (offset, size)
+                                 for name, offset, size in todoistcli.iter_sections(self.mm)
+                                 if name.startswith("search.")}
+            except ValueError:
+                self.close()
+                raise
+
+    def __iter__(self):
+        return iter(self.sections)
+
+    def get(self, name, default=None):
+        """ Returns section name, or default if there is no such section """
+        if name not in self.sections:
+            return default
+        if name not in self.read:
+            offset, size = self.sections[name]
+            self.read[name] = json.loads(self.mm[offset:offset + size])
+        return self.read[name]
+
+    def close(self):
+        """ Closes the cache file """
+        if self.mm is not None:
+            self.mm.close()
+        self.file.close()
+
+
+def postings(entries):
+    """ Returns the index and project id of each item in a posting list by
+    item id """
+    return {item_id: (index, proj_id) for index, proj_id, item_id in entries}
+
+
+def evaluate(node, data):
+    """ Returns the index and project id of the items matching the query tree
+    node in data by item id, all ids as strings """
+    kind = node[0]
+    if kind == "or":
+        matches = evaluate(node[1], data)
+        matches.update(evaluate(node[2], data))
+        return matches
+    if kind == "and":
+        left, right = evaluate(node[1], data), evaluate(node[2], data)
+        return {item_id: left[item_id] for item_id in left.keys() & right.keys()}
+    if kind == "not":
+        excluded = evaluate(node[1], data)
+        return {item_id: position for item_id, position in everything(data).items()
+                if item_id not in excluded}
+
+    search = data['search']
+    if kind == "word":
+        return postings(search.get(todoistcli.token_section(node[1]), {}).get(node[1], []))
+    if kind == "prefix":
+        start = todoistcli.token_section(node[1])
+        return {item_id: position
+                for name in search if name.startswith(start)
+                for token, entries in search.get(name).items() if token.startswith(node[1])
+                for item_id, position in postings(entries).items()}
+    if kind == "project":
+        names = [f"p:{proj_id}"
+                 for proj_id in todoistcli.match_projects(data['projects'], node[1])]
+    else:
+        names = [f"l:{label_id}"
+                 for label_id in todoistcli.match_labels(data['labels'], node[1])]
+    return {item_id: position for name in names
+            for item_id, position in postings(search.get(name, [])).items()}
+
+
+def negated(node):
+    """ Returns True if the query tree node matches items by what they lack,
+    as queries rooted in not do, rather than by a term they have """
+    if node[0] == "not":
+        return True
+    if node[0] == "and":
+        return negated(node[1]) and negated(node[2])
+    if node[0] == "or":
+        return negated(node[1]) or negated(node[2])
+    return False
+
+
+def everything(data):
+    """ Returns the index and project id of every item in data by item id """
+    search = data['search']
+    return {item_id: position for name in search if name.startswith("p:")
+            for item_id, position in postings(search.get(name)).items()}
+
+
+def query_data(api, cache_file="~/.config/todoist/cache"):
+    """ Returns the state a query needs along with its search index. Without
+    an api, see cache_source, the search index is read from the cache file a
+    section at a time and items are left out. """
+    api, cache_file = todoistcli.cache_source(api, cache_file)
+    if api is not None:
+        data = todoistcli.get_state(api, cache_file)
+        return dict(data, search=todoistcli.update_search(None, data['items']))
+    search = CachedSearch(cache_file)
+    data = todoistcli.read_cache(cache_file, SECTIONS)
+    if not todoistcli.search_built(search) or \
+            any(sub not in data["lookups"] for sub in ("label_names", "project_rank")):
+        # Caches written before the search index was split or these lookups existed
+        search.close()
+        data = todoistcli.load_state(cache_file)
+        return dict(data, search=todoistcli.update_search(None, data['items']))
+    data['search'] = search
+    return data
+
+
+def iter_search(api, query, cache_file="~/.config/todoist/cache", limit=None,
+                sort="index"):
+    """ Yields the items matching query sorted on sort. Matches are ranked on
+    their postings first so only the items listed are read from the cache. """
+    api, cache_file = todoistcli.cache_source(api, cache_file)
+    data = query_data(api, cache_file)
+    try:
+        matches = evaluate(parse(query), data)
+    finally:
+        if isinstance(data['search'], CachedSearch):
+            data['search'].close()
+    projects = data['projects']
+    lookups = data['lookups']
+
+    def records():
+        for item_id, (index, proj_id) in matches.items():
+            if sort == "project":
+                yield (lookups['project_rank'][proj_id], index), (proj_id, item_id)
+            else:
+                yield index, (proj_id, item_id)
+
+    ranked = [pair for _, pair in todoistcli.sort_records(records(), limit)]
+
+    if 'items' in data:
+        items = data['items']
+    else:
+        sections = [f"items.{proj_id}" for proj_id in {proj_id for proj_id, _ in ranked}]
+        items = todoistcli.read_cache(cache_file, sections)['items'] if sections else {}
+
+    for proj_id, item_id in ranked:
+        try:
+            project = todoistcli.lookup(projects, proj_id)
+            item = todoistcli.lookup(todoistcli.lookup(items, proj_id), item_id)
+        except KeyError:
+            continue
+        yield todoistcli.format_item(item, project['name'], lookups['label_names'])
+
+
+def search(api, query, cache_file="~/.config/todoist/cache", limit=None, sort="index"):
+    """ Returns a list of the items matching query """
+    return list(iter_search(api, query, cache_file, limit, sort))
+
+
+def parse_indexes(selection):
+    """ Returns the indexes listed alone and the (first, last) ranges in an
+    index selection such as 3-40,52, or None if selection is not one """
+    if not INDEXES.fullmatch(selection):
+        return None
+    single, ranges = set(), []
+    for part in re.split(r"[,\s]+", selection.strip()):
+        first, _, last = part.partition("-")
+        if last:
+            ranges.append((int(first), int(last)))
+        else:
+            single.add(int(first))
+    return single, ranges
+
+
+def select(selection, data, confirmed=False, search=None):
+    """ Returns the index, project id, item id and item of each item in data,
+    a state such as Snapshot.data, selected by selection, sorted on index. An
+    index listed alone must exist, ranges skip the indexes that do not.
+    Selections that look like indexes but do not parse as them raise
+    QueryError, as do queries that are negated, see negated, or match more
+    than one item unless confirmed. Queries are matched against search, the
+    search index of data, which is built when there is none. """
+    indexes = parse_indexes(selection)
+    table = data["lookups"]["index"]
+    if indexes is None:
+        if INDEX_LIKE.fullmatch(selection):
+            raise QueryError(f"{selection.strip()} is not a list of indexes")
+        node = parse(selection)
+        if search is None:
+            search = todoistcli.update_search(None, data['items'])
+        matches = evaluate(node, dict(data, search=search))
+        # Postings hold ids as strings, the index holds them as data does
+        listed = [str(index) for item_id, (index, _) in matches.items()
+                  if str(table.get(str(index), (None, None))[1]) == item_id]
+    else:
+        single, ranges = indexes
+        missing = [index for index in single if str(index) not in table]
+        if missing:
+            raise QueryError(f"[{min(missing)}] does not exist")
+        if sum(last - first + 1 for first, last in ranges) < len(table):
+            # Look up the indexes selected rather than test every index
+            listed = {str(index) for index in single}
+            listed.update(str(index) for first, last in ranges
+                          for index in range(first, last + 1) if str(index) in table)
+        else:
+            listed = [index for index in table if int(index) in single or
+                      any(first <= int(index) <= last for first, last in ranges)]
+
+    selected = sorted((int(index), *table[index]) for index in listed)
+    if indexes is None and selected and not confirmed and \
+            (negated(node) or len(selected) > 1):
+        count = "1 item" if len(selected) == 1 else f"{len(selected)} items"
+        raise QueryError(f"the query {selection} matches {count}, add --yes to go ahead")
+
+    items = data["items"]
+    return [(index, proj_id, item_id,
+             todoistcli.lookup(todoistcli.lookup(items, proj_id), item_id))
+            for index, proj_id, item_id in selected]
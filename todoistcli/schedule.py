@@ -0,0 +1,284 @@
+""" Paces, coalesces and retries the requests todo sends todoist. Every sync and
+commit of an api from connect goes through its Scheduler. Requests take a
+token from a bucket kept in a small file next to the cache, so every todo
+talking to the same account shares one pace however many run at once, and a
+429 holds all of them off for as long as todoist asks. Failed requests are
+sent again with the same commands, whose uuids let todoist skip the ones it
+already ran. Commands leave the queue once todoist has answered or the
+request has failed for good, so a change reported as failed is never sent
+later without being asked for. """
+
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import time
+from todoistcli import metrics
+
+# todoist allows 450 requests every 15 minutes, TODOIST_RATE and
+# TODOIST_BURST override the requests per second and the burst
+RATE = 0.5
+BURST = 50
+RATE_ENV = "TODOIST_RATE"
+BURST_ENV = "TODOIST_BURST"
+
+# Retries of a failed request, waiting BACKOFF seconds and doubling up to
+# MAX_BACKOFF unless todoist says how long to wait
+RETRIES = 4
+BACKOFF = 1
+MAX_BACKOFF = 30
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Seconds a sync stays fresh enough to answer syncs asked for after it
+WINDOW = 2
+
+COUNTERS = ("requests", "commands", "coalesced", "retries", "throttled", "failed", "waited")
+
+# The last response each thread received, for the rate limit headers of
+# requests that succeeded
+RESPONSE = threading.local()
+
+
+class RequestError(OSError):
+    """ Raised when todoist refuses a request or it still fails after retrying """
+
+
+def http_hook(response, *args, **kwargs):  # pylint: disable=unused-argument
+    """ A requests response hook noting the response and raising for error
+    statuses, before the sdk takes an error for sync data """
+    RESPONSE.last = response
+    if response.status_code >= 400:
+        # Read the error so its connection goes back to the pool
+        response.content  # pylint: disable=pointless-statement
+        response.raise_for_status()
+
+
+def rate_env(name, default):
+    """ Returns the number in environment variable name, or default """
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def retry_after(response):
+    """ Returns the seconds response asks to wait before trying again, from
+    its Retry-After header or the retry_after todoist puts in the body """
+    if response is None:
+        return None
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        pass
+    try:
+        return float(response.json()["error_extra"]["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def exhausted(response):
+    """ Returns the seconds until the limit resets when response says no
+    requests are left, from X-RateLimit-Remaining and X-RateLimit-Reset """
+    if response is None or response.headers.get("X-RateLimit-Remaining") != "0":
+        return None
+    try:
+        return float(response.headers["X-RateLimit-Reset"])
+    except (KeyError, ValueError):
+        return None
+
+
+class Bucket:
+    """ A token bucket shared through the file at path. It is kept as the time
+    the bucket is next full, each request pushing it on by 1 / rate, and a
+    request waits while that is more than burst requests away. The file also
+    keeps running totals of the counters. """
+
+    def __init__(self, path, rate=RATE, burst=BURST, clock=time.time):
+        self.path = os.path.expanduser(path)
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+
+    @contextlib.contextmanager
+    def _state(self):
+        """ Yields the state in the file, locked, and writes it back """
+        with open(self.path, "a+") as state_fh:
+            fcntl.flock(state_fh, fcntl.LOCK_EX)
+            state_fh.seek(0)
+            try:
+                state = json.loads(state_fh.read())
+            except ValueError:
+                state = {}
+            state.setdefault("full_at", 0)
+            state.setdefault("totals", dict.fromkeys(COUNTERS, 0))
+            yield state
+            state_fh.seek(0)
+            state_fh.truncate()
+            state_fh.write(json.dumps(state))
+
+    def take(self):
+        """ Takes a token and returns the seconds to wait before using it """
+        with self._state() as state:
+            now = self.clock()
+            full_at = max(state["full_at"], now)
+            state["full_at"] = full_at + 1 / self.rate
+            return max(0, full_at - (self.burst - 1) / self.rate - now)
+
+    def pause(self, seconds):
+        """ Empties the bucket so no request is sent for seconds """
+        with self._state() as state:
+            full_at = self.clock() + seconds + (self.burst - 1) / self.rate
+            state["full_at"] = max(state["full_at"], full_at)
+
+    def count(self, counts):
+        """ Adds counts to the running totals """
+        with self._state() as state:
+            for name, value in counts.items():
+                state["totals"][name] = state["totals"].get(name, 0) + value
+
+
+class Scheduler:
+    """ Sends the syncs and commits of api. counters holds the requests todoist
+    answered and the commands in them, syncs answered without a request,
+    retries, 429s, requests that failed for good and the seconds spent
+    waiting on the bucket or between retries. """
+
+    def __init__(self, api, bucket, retries=RETRIES, window=WINDOW, sleep=time.sleep,
+                 clock=time.monotonic):
+        self.api = api
+        self.bucket = bucket
+        self.retries = retries
+        self.window = window
+        self.sleep = sleep
+        self.clock = clock
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self._synced = None
+
+    def _wait(self, seconds):
+        """ Sleeps for seconds and returns how long that was """
+        if seconds <= 0:
+            return 0
+        self.sleep(seconds)
+        return seconds
+
+    def send(self, commands=None):
+        """ Sends one sync with commands, pacing it and retrying it until
+        todoist answers, and returns the reply """
+        counts = dict.fromkeys(COUNTERS, 0)
+        error = None
+        try:
+            for attempt in range(self.retries + 1):
+                counts["waited"] += self._wait(self.bucket.take())
+                RESPONSE.last = None
+                try:
+                    with metrics.phase("request", attempt=attempt,
+                                       commands=len(commands or [])):
+                        reply = self.api.sync(commands=commands)
+                except OSError as e:
+                    error = e
+                    response = getattr(e, "response", None)
+                    status = getattr(response, "status_code", None)
+                else:
+                    counts["requests"] += 1
+                    counts["commands"] += len(commands or [])
+                    self._synced = self.clock()
+                    reset = exhausted(RESPONSE.last)
+                    if reset is not None:
+                        self.bucket.pause(reset)
+                    return reply
+
+                if status is not None and status not in RETRY_STATUS:
+                    counts["failed"] += 1
+                    raise RequestError(f"todoist refused the request: {error}") from error
+                if attempt == self.retries:
+                    break
+                counts["retries"] += 1
+                delay = retry_after(response)
+                if delay is None:
+                    delay = min(BACKOFF * 2 ** attempt, MAX_BACKOFF)
+                if status == 429:
+                    # Every todo on this account waits, not only this one
+                    counts["throttled"] += 1
+                    self.bucket.pause(delay)
+                else:
+                    counts["waited"] += self._wait(delay)
+
+            counts["failed"] += 1
+            raise RequestError(f"todoist did not answer after {self.retries} retries: "
+                               f"{error}") from error
+        finally:
+            for name in COUNTERS:
+                self.counters[name] += counts[name]
+            counts["waited"] = round(counts["waited"], 3)
+            self.bucket.count(counts)
+            metrics.emit("schedule", **self.counters)
+
+    def commit(self):
+        """ Sends the queued commands in one request, which also syncs, and
+        removes them from the queue once todoist has answered or the request
+        has failed for good. Raises the sdk's SyncError for commands todoist
+        rejected, as commit does. """
+        if not self.api.queue:
+            return None
+        commands = list(self.api.queue)
+        try:
+            reply = self.send(commands)
+        finally:
+            # Retrying is over either way, a failed change is not sent later
+            del self.api.queue[:len(commands)]
+        for uuid, status in reply.get("sync_status", {}).items():
+            if status != "ok":
+                import todoist.api  # pylint: disable=import-outside-toplevel
+                raise todoist.api.SyncError(uuid, status)
+        return reply
+
+    def sync(self, window=None):
+        """ Syncs api. Queued commands go along as a commit, and a sync asked
+        for within window seconds of the last reply, by default the
+        scheduler's, is answered as though nothing changed since, without a
+        request. """
+        if self.api.queue:
+            return self.commit()
+        window = self.window if window is None else window
+        if self._synced is not None and self.clock() - self._synced < window:
+            self.counters["coalesced"] += 1
+            self.bucket.count({"coalesced": 1})
+            return {"sync_token": self.api.sync_token, "full_sync": False}
+        return self.send()
+
+
+def attach(api, cache_file="~/.config/todoist/cache"):
+    """ Gives api a Scheduler pacing it with the bucket of cache_file and
+    returns it """
+    bucket = Bucket(os.path.expanduser(cache_file) + ".rate",
+                    rate_env(RATE_ENV, RATE), rate_env(BURST_ENV, BURST))
+    if http_hook not in api.session.hooks["response"]:
+        api.session.hooks["response"].append(http_hook)
+    api.scheduler = Scheduler(api, bucket)
+    return api.scheduler
+
+
+def iter_totals(cache_file="~/.config/todoist/cache"):
+    """ Yields the running totals of the counters of every todo using
+    cache_file, one line each """
+    try:
+        with open(os.path.expanduser(cache_file) + ".rate") as state_fh:
+            totals = json.load(state_fh).get("totals", {})
+    except (OSError, ValueError):
+        totals = {}
+    for name in COUNTERS:
+        yield f"{name}: {totals.get(name, 0)}"
+
+
+def commit(api):
+    """ Commits api's queued commands through its Scheduler, apis without
+    one commit directly """
+    scheduler = getattr(api, "scheduler", None)
+    return api.commit() if scheduler is None else scheduler.commit()
+
+
+def sync(api, window=None):
+    """ Syncs api through its Scheduler, apis without one sync directly """
+    scheduler = getattr(api, "scheduler", None)
+    return api.sync() if scheduler is None else scheduler.sync(window)
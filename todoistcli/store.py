@@ -0,0 +1,109 @@
+""" Compact storage for the items held in memory, such as by the daemon.
+
+Each item is a Task, a record with slots in place of a dict, and items with
+the same labels share one tuple of label ids. A Task is read and written like
+the dict it replaces, item['content'], so the rest of todoistcli works on
+items built from the api and on items read from the cache alike. """
+
+# Task fields in the order the cache stores them
+FIELDS = ("content", "labels", "index")
+
+# Every distinct tuple of label ids, shared by the tasks that have it
+LABEL_SETS = {}
+
+
+def intern_labels(labels):
+    """ Returns labels as a tuple shared by every task with the same labels """
+    labels = tuple(labels)
+    return LABEL_SETS.setdefault(labels, labels)
+
+
+class Task:
+    """ An item's content, label ids and index """
+    __slots__ = FIELDS
+
+    def __init__(self, content, labels=(), index=None):
+        self.content = content
+        self.labels = intern_labels(labels)
+        self.index = index
+
+    def __getitem__(self, key):
+        if key not in FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in FIELDS:
+            raise KeyError(key)
+        setattr(self, key, intern_labels(value) if key == "labels" else value)
+
+    def __contains__(self, key):
+        return key in FIELDS
+
+    def __iter__(self):
+        return iter(FIELDS)
+
+    def __len__(self):
+        return len(FIELDS)
+
+    def __eq__(self, other):
+        if not isinstance(other, (Task, dict)):
+            return NotImplemented
+        return (self.content, self.labels, self.index) == \
+            (other.get("content"), tuple(other.get("labels", ())), other.get("index"))
+
+    def __repr__(self):
+        return f"Task({self.content!r}, {self.labels!r}, {self.index!r})"
+
+    def get(self, key, default=None):
+        """ Returns the field key, or default if there is no such field """
+        return getattr(self, key) if key in FIELDS else default
+
+    def keys(self):
+        """ Returns the field names, as a dict would """
+        return FIELDS
+
+    def items(self):
+        """ Returns each field name and value, as a dict would """
+        return [(key, getattr(self, key)) for key in FIELDS]
+
+    def as_dict(self):
+        """ Returns the task as the dict the cache stores """
+        return {"content": self.content, "labels": self.labels, "index": self.index}
+
+
+def as_json(obj):
+    """ Encodes tasks for json.dumps, passed as its default """
+    try:
+        return obj.as_dict()
+    except AttributeError:
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class TaskStore(dict):
+    """ Tasks by project id and item id. It is the dict get_items always
+    returned, with views by project and label added. """
+
+    def tasks(self):
+        """ Yields the project id, item id and task of every task """
+        for proj_id, proj_tasks in self.items():
+            for item_id, task in proj_tasks.items():
+                yield proj_id, item_id, task
+
+    def project(self, proj_id):
+        """ Returns the tasks of a project by item id """
+        return self.get(proj_id, {})
+
+    def label(self, label_id):
+        """ Yields the project id, item id and task of every task with label_id """
+        for proj_id, item_id, task in self.tasks():
+            if label_id in task['labels']:
+                yield proj_id, item_id, task
+
+    def as_dicts(self):
+        """ Returns the tasks as plain nested dicts, as items were before """
+        return {proj_id: {item_id: {"content": task['content'],
+                                    "labels": list(task['labels']),
+                                    "index": task.get('index')}
+                          for item_id, task in proj_tasks.items()}
+                for proj_id, proj_tasks in self.items()}
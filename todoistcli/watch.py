@@ -0,0 +1,108 @@
+""" Watches todoist for changes and prints the rows they add, complete, move or
+edit. One api session polls for what changed since its last sync, waiting
+longer between polls while nothing changes. A poll that finds nothing costs
+one small request, the state is only rebuilt, listed and saved for polls that
+bring changes. """
+
+import os
+import re
+import sys
+import time
+import todoistcli
+
+# Seconds between polls, growing by BACKOFF after each poll without changes,
+# TODOIST_WATCH_MIN and TODOIST_WATCH_MAX override the bounds
+MIN_INTERVAL = 2
+MAX_INTERVAL = 60
+BACKOFF = 2
+
+ROW_INDEX = re.compile(r"\[(\d+)\]")
+
+
+def interval_env(name, default):
+    """ Returns the number of seconds in environment variable name, or default """
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def next_interval(interval, changed, shortest=MIN_INTERVAL, longest=MAX_INTERVAL):
+    """ Returns how long to wait before the next poll """
+    if changed:
+        return shortest
+    return min(interval * BACKOFF, longest)
+
+
+def poll(api):
+    """ Syncs api and returns True if todoist sent changed projects, items or
+    labels, or None if the sync failed """
+    try:
+        # Polls are already spaced out, never answer one from the last reply
+        response = todoistcli.schedule.sync(api, window=0)
+    except OSError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return None
+    if not isinstance(response, dict) or "error" in response:
+        error = response.get("error") if isinstance(response, dict) else response
+        print(f"Error: {error}", file=sys.stderr)
+        return None
+    return any(response.get(name) for name in todoistcli.RESOURCES)
+
+
+def rows(snap, view):
+    """ Returns the rows view lists from snap, keyed by index, and the project
+    id of every item, keyed by index """
+    listed = {}
+    for line in view(snap):
+        listed[ROW_INDEX.match(line).group(1)] = line
+    positions = {index: str(proj_id)
+                 for index, (proj_id, _) in snap.data['lookups']['index'].items()}
+    return listed, positions
+
+
+def diff(before, after):
+    """ Yields the rows that changed between two results of rows, marked +
+    when added, - when completed or no longer listed, > when moved to
+    another project and ~ when edited. Rows are in index order. """
+    (old_rows, old_positions), (new_rows, new_positions) = before, after
+    for index in sorted(old_rows.keys() | new_rows.keys(), key=int):
+        old, new = old_rows.get(index), new_rows.get(index)
+        if old == new:
+            continue
+        if old is None:
+            yield f"+ {new}"
+        elif new is None:
+            yield f"- {old}"
+        elif old_positions.get(index) != new_positions.get(index):
+            yield f"> {new}"
+        else:
+            yield f"~ {new}"
+
+
+def watch(snap, view, polls=None, sleep=time.sleep):
+    """ Prints what view lists from snap and then, after each poll that brings
+    changes, the rows that changed. Stops after polls polls, forever without
+    it, or once stdout is closed. """
+    shortest = interval_env("TODOIST_WATCH_MIN", MIN_INTERVAL)
+    longest = interval_env("TODOIST_WATCH_MAX", MAX_INTERVAL)
+    current = rows(snap, view)
+    if not todoistcli.print_formatted_output(current[0].values()):
+        return False
+    snap.save()
+
+    interval = shortest
+    count = 0
+    while polls is None or count < polls:
+        sleep(interval)
+        count += 1
+        changed = poll(snap.api)
+        interval = next_interval(interval, changed, shortest, longest)
+        if not changed:
+            continue
+        snap.refresh()
+        previous, current = current, rows(snap, view)
+        if not todoistcli.print_formatted_output(diff(previous, current)):
+            return False
+        snap.save()
+    return True